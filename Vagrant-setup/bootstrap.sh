@@ -53,6 +53,9 @@ set_environment_vars() {
     echo "RKC_DB_PORT=$RKC_DB_PORT" >> /etc/environment
     echo "RKC_KEYWORD_PATH=$RKC_KEYWORD_PATH" >> /etc/environment
     echo "RKC_REPORT_PATH=$RKC_REPORT_PATH" >> /etc/environment
+    echo "RKC_PAGE_PATH=$RKC_PAGE_PATH" >> /etc/environment
+    echo "RKC_PRELOAD_LANGUAGES=$RKC_PRELOAD_LANGUAGES" >> /etc/environment
+    echo "RKC_METRICS_PORT=$RKC_METRICS_PORT" >> /etc/environment
 }
 
 setup_permissions() {
@@ -65,11 +68,15 @@ setup_permissions() {
 
     chown --recursive "$testing_user":"${testing_group}" "$RKC_REPORT_PATH"
     chmod --recursive g+rw "$RKC_REPORT_PATH"
+
+    chown --recursive "$testing_user":"${testing_group}" "$RKC_PAGE_PATH"
+    chmod --recursive g+rw "$RKC_PAGE_PATH"
 }
 
 setup_keyword_dir() {
     mkdir --parents "$RKC_KEYWORD_PATH"
     mkdir --parents "$RKC_REPORT_PATH"
+    mkdir --parents "$RKC_PAGE_PATH"
 }
 
 base_setup() {
@@ -104,6 +111,8 @@ dependencies() {
     pip_install "beautifulsoup4"
     pip_install "hazm"
     pip_install "lxml"
+    # CSS selectors in the site extractors (sites.json)
+    pip_install "cssselect"
     pip_install "polyglot"
 
     # required for polyglot but not in pip requrements?
@@ -111,6 +111,24 @@ CREATE TABLE feeds (
 );
 GRANT ALL PRIVILEGES ON TABLE feeds TO $RKC_DB_USER;
 
+DROP TABLE if exists collector_nodes;
+-- Create the collector nodes table (heartbeats of collectors sharing the feeds)
+CREATE TABLE collector_nodes (
+        node varchar (100) PRIMARY KEY,
+        heartbeat timestamptz NOT NULL
+);
+GRANT ALL PRIVILEGES ON TABLE collector_nodes TO $RKC_DB_USER;
+
+DROP TABLE if exists feed_validators;
+-- Create the feed validators table (conditional GET cache)
+CREATE TABLE feed_validators (
+        url varchar (500) PRIMARY KEY,
+        etag varchar (500),
+        last_modified varchar (100),
+        content_hash char (40)
+);
+GRANT ALL PRIVILEGES ON TABLE feed_validators TO $RKC_DB_USER;
+
 
 DROP TABLE if exists entries;
 -- Create the entries table
@@ -122,9 +140,15 @@ CREATE TABLE entries (
         scraped boolean NOT NULL,
         feed varchar (200) NOT NULL,
         url varchar (500) PRIMARY KEY,
-        term_file varchar (36)
+        term_file varchar (36),
+        page_digest char (40),
+        claimed_until timestamptz,
+        attempts integer NOT NULL DEFAULT 0,
+        retry_after timestamptz
 );
 GRANT ALL PRIVILEGES ON TABLE entries TO $RKC_DB_USER;
+-- Only unparsed entries are claimed by the parsers
+CREATE INDEX entries_unscraped ON entries (retry_after) WHERE scraped = false;
 
 
 
@@ -132,10 +156,21 @@ DROP TABLE if exists terms;
 -- Create the terms table
 CREATE TABLE terms (
         term varchar (150) PRIMARY KEY,
-        censored boolean
+        censored boolean,
+        id bigserial UNIQUE
 );
 GRANT ALL PRIVILEGES ON TABLE terms TO $RKC_DB_USER;
 
+DROP TABLE if exists term_counts;
+-- Create the hourly term counts table (articles per term id per hour)
+CREATE TABLE term_counts (
+        term_id bigint NOT NULL,
+        bucket timestamptz NOT NULL,
+        count integer NOT NULL,
+        PRIMARY KEY (term_id, bucket)
+);
+GRANT ALL PRIVILEGES ON TABLE term_counts TO $RKC_DB_USER;
+
 DROP TABLE if exists censorship;
 -- Create the censorship table
 CREATE TABLE censorship (
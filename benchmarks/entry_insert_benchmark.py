@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+"""Compare per-row and batched entry inserts against a local Postgres.
+
+The benchmark connects with the usual RKC_DB_* environment variables and
+works on a temporary "entries" table, which shadows the real one for the
+length of the session, so no stored data is touched.
+
+    python benchmarks/entry_insert_benchmark.py --entries 5000 --batch-size 500
+"""
+
+import argparse
+from datetime import datetime
+from os import environ, path
+import sys
+import time
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             "..", "rss_keyword_collector"))
+
+import psycopg2
+
+from db import EntryWriter
+
+
+def connect():
+    return psycopg2.connect(host=environ['RKC_DB_HOST'],
+                            port=environ['RKC_DB_PORT'],
+                            database=environ['RKC_DB_NAME'],
+                            user=environ['RKC_DB_USER'],
+                            password=environ['RKC_DB_PASS'])
+
+
+def reset_table(conn):
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE IF EXISTS pg_temp.entries")
+    cursor.execute("CREATE TEMP TABLE entries ("
+                   "title varchar (500) NOT NULL, "
+                   "language varchar (15), "
+                   "description varchar (1000), "
+                   "published timestamptz, "
+                   "scraped boolean NOT NULL, "
+                   "feed varchar (200) NOT NULL, "
+                   "url varchar (500) PRIMARY KEY, "
+                   "term_file varchar (36))")
+    conn.commit()
+
+
+def make_entries(count, duplicates):
+    entries = []
+    for i in range(count):
+        # Every n-th entry repeats an earlier link to exercise ON CONFLICT.
+        link = i - 1 if duplicates and i and i % duplicates == 0 else i
+        entries.append({"link": "http://localhost/article/{0}".format(link),
+                        "language": "en",
+                        "description": "Description of article {0}".format(i),
+                        "title": "Article {0}".format(i),
+                        "pubDate": datetime.now(),
+                        "url": "http://localhost/feed.xml"})
+    return entries
+
+
+def per_row(conn, entries):
+    cursor = conn.cursor()
+    for entry in entries:
+        cursor.execute("INSERT INTO entries "
+                       "(url, language, description, "
+                       "title, published, scraped, feed) "
+                       "VALUES "
+                       "(%s, %s, %s, %s, %s, 'false', %s) "
+                       "ON CONFLICT (url) DO NOTHING ",
+                       EntryWriter._row(entry))
+        # The service commits every runOperation on its own.
+        conn.commit()
+
+
+def batched(conn, entries, batch_size):
+    writer = EntryWriter(None, batch_size)
+    inserted, skipped = writer._write(conn.cursor(), entries)
+    conn.commit()
+    return len(inserted), skipped
+
+
+def main(args):
+    conn = connect()
+    entries = make_entries(args.entries, args.duplicates)
+    runs = [("per-row", lambda: per_row(conn, entries)),
+            ("batched", lambda: batched(conn, entries, args.batch_size))]
+    for name, run in runs:
+        reset_table(conn)
+        start = time.time()
+        result = run()
+        elapsed = time.time() - start
+        print("{0:>8}: {1} entries in {2:.2f}s ({3:.0f} rows/s)".format(
+            name, len(entries), elapsed, len(entries) / elapsed))
+        if result is not None:
+            print("          inserted {0}, skipped {1}".format(*result))
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--duplicates", type=int, default=10,
+                        help="Repeat every n-th link (0 for none).")
+    main(parser.parse_args())
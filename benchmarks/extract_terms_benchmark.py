@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+"""Measure ExtractTerms throughput (terms per second) per language.
+
+Each --text argument pairs a language code with a UTF-8 text file, e.g. the
+output of ExtractText for a saved article. The text is run through the term
+extractor that loaded its tokenizer, stop words and NER model on every call
+(kept below) and through the current ExtractTerms, which uses the process
+wide language resource registry.
+
+    python benchmarks/extract_terms_benchmark.py --text en=article_en.txt \\
+        --text fa=article_fa.txt --repeat 20
+"""
+
+import argparse
+import codecs
+from os import path
+import re
+import sys
+import time
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             "..", "rss_keyword_collector"))
+
+from parse import ExtractTerms
+
+
+def legacy_terms(raw, language):
+    """The term extractor used before the language resource registry."""
+    if language == "fa":
+        from hazm import word_tokenize
+    else:
+        from nltk import word_tokenize
+    from nltk.corpus import stopwords
+    from polyglot.text import Text
+
+    tokens = word_tokenize(raw)
+    lowered = [x.lower() for x in tokens]
+    unicode_non_words = re.compile('\W+', re.UNICODE)
+    plain = [re.sub(unicode_non_words, '', x) for x in lowered]
+    unique_words = set(plain)
+    if language in ("en", "fa"):
+        stop_words = stopwords.words({"en": "english", "fa": "persian"}[language])
+        unique_words = [x for x in unique_words if x not in stop_words]
+    keywords = [x for x in unique_words if len(x) > 1]
+    entities = []
+    if len(raw) >= 50:
+        entities = [u" ".join(ent) for ent in Text(raw).entities]
+    return keywords + entities
+
+
+def current_terms(raw, language):
+    return ExtractTerms(raw, language, remove_stopwords=True).terms
+
+
+def timed(extract, raw, language, repeat):
+    start = time.time()
+    terms = 0
+    for _ in range(repeat):
+        terms += len(extract(raw, language))
+    return terms, time.time() - start
+
+
+def main(args):
+    for pair in args.text:
+        language, filename = pair.split("=", 1)
+        with codecs.open(filename, encoding="utf-8") as text:
+            raw = text.read()
+        for name, extract in [("before", legacy_terms), ("after", current_terms)]:
+            terms, elapsed = timed(extract, raw, language, args.repeat)
+            print("{0} {1:>6}: {2:.0f} terms/s ({3:.1f} ms/article)".format(
+                language, name, terms / elapsed, 1000 * elapsed / args.repeat))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--text", action="append", required=True,
+                        metavar="LANG=FILE")
+    parser.add_argument("--repeat", type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+"""Check and time ExtractText.extractor_generic against the old extractor.
+
+Every file in the pages directory is treated as a saved article. The text
+returned by the current single-pass extractor is compared with the text
+returned by the previous BeautifulSoup prettify/reparse extractor (kept
+below) and any page where they differ is listed. The script exits with a
+non-zero status when a page does not match.
+
+    python benchmarks/extract_text_benchmark.py tests/pages/ --repeat 5
+"""
+
+import argparse
+from os import listdir, path
+import sys
+import time
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             "..", "rss_keyword_collector"))
+
+from bs4 import BeautifulSoup, Comment
+
+from parse import ExtractText
+
+
+def legacy_extractor_generic(raw):
+    """The three-parse extractor used before the single-pass lxml version."""
+    html_obj = BeautifulSoup(raw, 'lxml')
+    comments = html_obj.findAll(text=lambda text: isinstance(text, Comment))
+    [comment.extract() for comment in comments]
+    html_obj = BeautifulSoup(html_obj.prettify(), 'lxml')
+    for unwanted in html_obj(["script", "style"]):
+        unwanted.extract()
+    html_obj = BeautifulSoup(html_obj.prettify(), 'lxml')
+    text = html_obj.get_text()
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return '\n'.join(chunk for chunk in chunks if chunk)
+
+
+def current_extractor_generic(raw):
+    extractor = ExtractText.__new__(ExtractText)
+    return extractor.extractor_generic(raw)[0]
+
+
+def load_pages(directory):
+    pages = []
+    for name in sorted(listdir(directory)):
+        with open(path.join(directory, name), "rb") as page:
+            pages.append((name, page.read()))
+    return pages
+
+
+def timed(extractor, pages, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        for name, raw in pages:
+            extractor(raw)
+    return time.time() - start
+
+
+def main(args):
+    pages = load_pages(args.pages)
+    mismatches = []
+    for name, raw in pages:
+        if legacy_extractor_generic(raw) != current_extractor_generic(raw):
+            mismatches.append(name)
+    print("{0} of {1} pages match the old extractor".format(
+        len(pages) - len(mismatches), len(pages)))
+    for name in mismatches:
+        print("  differs: {0}".format(name))
+
+    legacy = timed(legacy_extractor_generic, pages, args.repeat)
+    current = timed(current_extractor_generic, pages, args.repeat)
+    count = len(pages) * args.repeat
+    print("  legacy: {0:.3f}s ({1:.1f} pages/s)".format(legacy, count / legacy))
+    print("  single: {0:.3f}s ({1:.1f} pages/s)".format(current, count / current))
+    print(" speedup: {0:.1f}x".format(legacy / current))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pages", help="Directory of saved HTML pages.")
+    parser.add_argument("--repeat", type=int, default=3)
+    sys.exit(main(parser.parse_args()))
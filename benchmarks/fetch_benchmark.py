@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+"""Compare sequential and concurrent feed downloads.
+
+A local stand-in server listens on several ports (each port is treated as a
+separate host) and answers every request with a small RSS document after a
+configurable delay. A few "slow" hosts can be given a much larger delay to
+show that they no longer hold up the rest of the cycle.
+
+    python benchmarks/fetch_benchmark.py --feeds 300 --hosts 30 --latency 0.05
+"""
+
+import argparse
+from os import path
+import sys
+import time
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             "..", "rss_keyword_collector"))
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, inlineCallbacks
+from twisted.web import resource, server
+from twisted.web.client import getPage
+
+from fetch import PageFetcher
+
+FEED = b"""<?xml version="1.0"?>
+<rss version="2.0"><channel><title>Benchmark</title>
+<item><title>Item</title><link>http://localhost/item</link></item>
+</channel></rss>"""
+
+
+class SlowFeed(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, latency):
+        resource.Resource.__init__(self)
+        self.latency = latency
+
+    def render_GET(self, request):
+        def finish():
+            request.setHeader(b"content-type", b"application/rss+xml")
+            request.write(FEED)
+            request.finish()
+        call = reactor.callLater(self.latency, finish)
+        request.notifyFinish().addErrback(lambda _: call.active() and call.cancel())
+        return server.NOT_DONE_YET
+
+
+def start_hosts(count, latency, slow_hosts, slow_latency):
+    ports = []
+    for i in range(count):
+        delay = slow_latency if i < slow_hosts else latency
+        port = reactor.listenTCP(0, server.Site(SlowFeed(delay)),
+                                 interface="127.0.0.1")
+        ports.append(port)
+    return ports
+
+
+def feed_urls(ports, feeds):
+    urls = []
+    for i in range(feeds):
+        port = ports[i % len(ports)].getHost().port
+        urls.append("http://127.0.0.1:{0}/feed/{1}".format(port, i))
+    return urls
+
+
+@inlineCallbacks
+def sequential(urls):
+    for url in urls:
+        yield getPage(url)
+
+
+def concurrent(urls, args):
+    fetcher = PageFetcher(args.max_concurrent, args.per_host, args.timeout)
+    return DeferredList([fetcher.fetch(url) for url in urls])
+
+
+@inlineCallbacks
+def main(args):
+    ports = start_hosts(args.hosts, args.latency,
+                        args.slow_hosts, args.slow_latency)
+    urls = feed_urls(ports, args.feeds)
+    try:
+        runs = [("concurrent", lambda: concurrent(urls, args))]
+        if not args.skip_sequential:
+            runs.insert(0, ("sequential", lambda: sequential(urls)))
+        for name, run in runs:
+            start = time.time()
+            yield run()
+            elapsed = time.time() - start
+            print("{0:>10}: {1} feeds in {2:.2f}s ({3:.1f} feeds/s)".format(
+                name, len(urls), elapsed, len(urls) / elapsed))
+    finally:
+        for port in ports:
+            port.stopListening()
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--feeds", type=int, default=300)
+    parser.add_argument("--hosts", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds each host waits before answering.")
+    parser.add_argument("--slow-hosts", type=int, default=2)
+    parser.add_argument("--slow-latency", type=float, default=1.0)
+    parser.add_argument("--max-concurrent", type=int, default=50)
+    parser.add_argument("--per-host", type=int, default=2)
+    parser.add_argument("--timeout", type=int, default=30)
+    parser.add_argument("--skip-sequential", action="store_true")
+    reactor.callWhenRunning(main, parser.parse_args())
+    reactor.run()
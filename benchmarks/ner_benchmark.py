@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+"""Compare per-article and batched named entity recognition on a fixed corpus.
+
+The corpus is a directory of UTF-8 text files in one language, e.g. the
+output of ExtractText for saved articles. Every file is run through
+ExtractTerms.get_entities one at a time and through
+ExtractTerms.get_entities_batch in batches of --batch-size. Both must find
+the same entities.
+
+    python benchmarks/ner_benchmark.py corpus_en/ --lang en --batch-size 16
+"""
+
+import argparse
+import codecs
+from os import listdir, path
+import sys
+import time
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             "..", "rss_keyword_collector"))
+
+from language import resources
+from parse import ExtractTerms
+
+
+def load_corpus(directory):
+    texts = []
+    for name in sorted(listdir(directory)):
+        with codecs.open(path.join(directory, name), encoding="utf-8") as text:
+            texts.append(text.read())
+    return texts
+
+
+def per_article(texts, language, batch_size):
+    return [ExtractTerms.get_entities(raw, language=language) for raw in texts]
+
+
+def batched(texts, language, batch_size):
+    entities = []
+    for start in range(0, len(texts), batch_size):
+        entities += ExtractTerms.get_entities_batch(texts[start:start + batch_size],
+                                                    language)
+    return entities
+
+
+def main(args):
+    texts = load_corpus(args.corpus)
+    # Load the model outside of the timings
+    resources.ner_batch_tagger(args.lang)
+    results = {}
+    for name, run in [("per article", per_article), ("batched", batched)]:
+        start = time.time()
+        for _ in range(args.repeat):
+            results[name] = run(texts, args.lang, args.batch_size)
+        elapsed = (time.time() - start) / args.repeat
+        print("{0:>11}: {1:.1f} articles/s ({2:.1f} ms/article)".format(
+            name, len(texts) / elapsed, 1000 * elapsed / len(texts)))
+    if results["per article"] != results["batched"]:
+        print("Entities differ!")
+        return 1
+    print("{0} articles, {1} entities".format(
+        len(texts), sum(len(found) for found in results["batched"])))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", help="Directory of UTF-8 text files.")
+    parser.add_argument("--lang", default="en")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    sys.exit(main(parser.parse_args()))
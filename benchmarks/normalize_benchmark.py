@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+"""Compare the token normalization pipeline with the old list-based steps.
+
+Tokens are read from a UTF-8 text file (split on whitespace) or, without
+one, generated from a fixed vocabulary. Both implementations get the same
+tokens and stop words and must return the same keywords. Peak allocated
+memory is reported where tracemalloc is available (Python 3).
+
+    python benchmarks/normalize_benchmark.py --tokens 50000 --repeat 20
+"""
+
+import argparse
+import codecs
+from os import path
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             "..", "rss_keyword_collector"))
+
+from parse import normalize_tokens
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+STOP_WORDS = frozenset([u"the", u"a", u"of", u"and", u"to", u"in", u"is"])
+
+
+def legacy_normalize(tokens, stop_words):
+    """The steps each language extractor used to copy."""
+    lowered = [x.lower() for x in tokens]
+    unicode_non_words = re.compile('\W+', re.UNICODE)
+    plain = [re.sub(unicode_non_words, '', x) for x in lowered]
+    unique_words = set(plain)
+    words_no_stop = [x for x in unique_words if x not in stop_words]
+    return [x for x in words_no_stop if len(x) > 1]
+
+
+def make_tokens(count, filename=None):
+    if filename:
+        with codecs.open(filename, encoding="utf-8") as text:
+            return text.read().split()
+    random.seed(0)
+    vocabulary = [u"Word{0}".format(i) for i in range(count // 5)]
+    vocabulary += list(STOP_WORDS) + [u",", u".", u"“", u"x"]
+    return [random.choice(vocabulary) + random.choice([u"", u",", u"'s"])
+            for _ in range(count)]
+
+
+def measure(normalize, tokens, repeat):
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        normalize(tokens, STOP_WORDS)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    start = time.time()
+    for _ in range(repeat):
+        normalize(tokens, STOP_WORDS)
+    return (time.time() - start) / repeat, peak
+
+
+def main(args):
+    tokens = make_tokens(args.tokens, args.text)
+    if sorted(legacy_normalize(tokens, STOP_WORDS)) != sorted(normalize_tokens(tokens, STOP_WORDS)):
+        print("Keyword lists differ!")
+        return 1
+    print("{0} tokens".format(len(tokens)))
+    for name, normalize in [("legacy", legacy_normalize),
+                            ("pipeline", normalize_tokens)]:
+        elapsed, peak = measure(normalize, tokens, args.repeat)
+        memory = "" if peak is None else ", peak {0:.0f} KiB".format(peak / 1024.0)
+        print("{0:>9}: {1:.2f} ms{2}".format(name, elapsed * 1000, memory))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=50000)
+    parser.add_argument("--text", help="UTF-8 text file to take tokens from.")
+    parser.add_argument("--repeat", type=int, default=20)
+    sys.exit(main(parser.parse_args()))
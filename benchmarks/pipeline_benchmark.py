@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+"""Run the collect, parse and report stages end to end on a fixed corpus.
+
+Everything runs offline. A local stand-in server serves a generated corpus
+(fixed by --seed) of RSS feeds and article pages. Half of the feeds carry
+BBC-style Persian pages on www.bbc.com urls, which are parsed by the
+site extractor for www.bbc.com. The rest carry English pages that go
+through the generic extractor, and a PDF that the parser drops. Every
+request is sent to the stand-in server through a proxy agent, so the
+article urls keep their real hosts.
+
+The database is the in-process stand-in in standin_db.py, so database
+timings are not representative (entry_insert_benchmark.py measures
+Postgres). The parse stage needs the parser's real dependencies (NLTK,
+hazm and polyglot with the en and fa models).
+
+The benchmark reports:
+- wall time and throughput of each stage;
+- p50 and p99 latency of each instrumented step (see metrics.py);
+- peak RSS of the main process and of the largest worker over the whole
+  run (the stages share the process, so RSS is not split by stage).
+With --output, the results are saved as JSON, so runs can be compared
+across commits. With --queue, the parser takes new entries from an
+EntryQueue while the feeds are collected, and the time from an entry being
+stored to its terms being stored is reported as pipeline.latency.
+
+    python benchmarks/pipeline_benchmark.py --feeds 20 --items 25 --output results.json
+"""
+
+import argparse
+import json
+from os import environ, path
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             "..", "rss_keyword_collector"))
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.web.client import ProxyAgent
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from metrics import metrics
+from pipeline import EntryQueue
+from standin_db import StandInPool
+
+ENGLISH_WORDS = (u"government minister election report police city market "
+                 u"water school health court border festival protest energy "
+                 u"internet newspaper village airport budget weather").split()
+ENGLISH_NAMES = (u"John Smith|Maria Garcia|London|Tehran|United Nations|"
+                 u"World Bank|Paris|Ali Rezaei|Red Cross|Berlin").split(u"|")
+PERSIAN_WORDS = (u"دولت وزیر انتخابات گزارش پلیس شهر بازار آب مدرسه سلامت "
+                 u"دادگاه مرز جشنواره اعتراض انرژی اینترنت روزنامه روستا").split()
+PERSIAN_NAMES = u"تهران|لندن|سازمان ملل|علی رضایی|پاریس|مشهد".split(u"|")
+
+
+def make_sentence(rng, words, names):
+    sentence = [rng.choice(words) for _ in range(rng.randint(8, 20))]
+    sentence.insert(rng.randint(0, len(sentence)), rng.choice(names))
+    return u" ".join(sentence) + u"."
+
+
+def english_page(rng, title):
+    paragraphs = u"".join(u"<p>{0}</p>".format(u" ".join(
+        make_sentence(rng, ENGLISH_WORDS, ENGLISH_NAMES) for _ in range(4)))
+        for _ in range(rng.randint(5, 15)))
+    return (u"<html lang=\"en\"><head><title>{0}</title>"
+            u"<script>var tracking = 1;</script></head><body>"
+            u"<div class=\"nav\">Home News Sport</div><h1>{0}</h1>"
+            u"<div class=\"article\">{1}</div></body></html>").format(title, paragraphs)
+
+
+def bbc_page(rng, title):
+    paragraphs = u"".join(u"<p>{0}</p>".format(
+        make_sentence(rng, PERSIAN_WORDS, PERSIAN_NAMES))
+        for _ in range(rng.randint(5, 15)))
+    return (u"<html lang=\"fa\"><head><title>{0} - BBC Persian</title></head>"
+            u"<body><div class=\"navigation\">BBC</div>"
+            u"<h1 class=\"story-body__h1\">{0}</h1>"
+            u"<div class=\"story-body\"><div class=\"story-body__inner\">{1}"
+            u"<figure><img src=\"x.jpg\"/></figure></div></div>"
+            u"</body></html>").format(title, paragraphs)
+
+
+def make_corpus(feeds, items, seed):
+    """ Generate the feeds and pages served by the stand-in server.
+
+    Returns:
+        Tuple (feed urls, {url: (content type, body)}).
+    """
+    rng = random.Random(seed)
+    corpus = {}
+    feed_urls = []
+    for feed in range(feeds):
+        bbc = feed % 2 == 0
+        if bbc:
+            feed_url = "http://www.bbc.com/persian/feed{0}.xml".format(feed)
+        else:
+            feed_url = "http://news{0}.example.org/rss.xml".format(feed)
+        feed_urls.append(feed_url)
+        entries = []
+        for item in range(items):
+            if bbc:
+                url = "http://www.bbc.com/persian/world-{0}-{1}".format(feed, item)
+                title = make_sentence(rng, PERSIAN_WORDS, PERSIAN_NAMES)[:60]
+                page = bbc_page(rng, title)
+            else:
+                url = "http://news{0}.example.org/story/{1}".format(feed, item)
+                title = make_sentence(rng, ENGLISH_WORDS, ENGLISH_NAMES)[:60]
+                page = english_page(rng, title)
+            corpus[url] = ("text/html; charset=utf-8", page.encode("utf-8"))
+            entries.append(u"<item><title>{0}</title><link>{1}</link>"
+                           u"<guid>{1}</guid><description>{0}</description>"
+                           u"<pubDate>Mon, 06 Sep 2010 16:45:00 +0000</pubDate>"
+                           u"</item>".format(title, url))
+        if not bbc:
+            # A linked document that is not a page, dropped by the parser
+            # without being downloaded in full
+            url = "http://news{0}.example.org/report.pdf".format(feed)
+            corpus[url] = ("application/pdf", b"%PDF-1.4 " + b"0" * 4096)
+            entries.append(u"<item><title>Annual report</title><link>{0}</link>"
+                           u"<guid>{0}</guid><description>Annual report</description>"
+                           u"</item>".format(url))
+        document = (u"<?xml version=\"1.0\" encoding=\"utf-8\"?>"
+                    u"<rss version=\"2.0\"><channel><title>Feed {0}</title>"
+                    u"<language>{1}</language>{2}</channel></rss>").format(
+                        feed, "fa" if bbc else "en", u"".join(entries))
+        corpus[feed_url] = ("application/rss+xml", document.encode("utf-8"))
+    return feed_urls, corpus
+
+
+class CorpusResource(Resource):
+    """Serves the corpus to requests made through a proxy agent (absolute urls)."""
+
+    isLeaf = True
+
+    def __init__(self, corpus):
+        Resource.__init__(self)
+        self.corpus = corpus
+
+    def render_GET(self, request):
+        url = request.uri.decode("ascii") if isinstance(request.uri, bytes) else request.uri
+        if url not in self.corpus:
+            request.setResponseCode(404)
+            return b"Not found"
+        content_type, body = self.corpus[url]
+        request.setHeader(b"Content-Type", content_type.encode("ascii"))
+        return body
+
+
+def peak_rss_kb():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 1024 if sys.platform == "darwin" else 1
+    return {"main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            "largest_worker": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale}
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=path.dirname(path.abspath(__file__))
+                                       ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@inlineCallbacks
+def drained(parser, queue):
+    """Wait until the parser has parsed everything offered to the queue."""
+    while (len(queue) or parser.queue_wait is None or
+           parser.in_flight.tokens < parser.in_flight.limit):
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+
+@inlineCallbacks
+def run_pipeline(args, results):
+    feed_urls, corpus = make_corpus(args.feeds, args.items, args.seed)
+    server = reactor.listenTCP(0, Site(CorpusResource(corpus)), interface="127.0.0.1")
+    endpoint = TCP4ClientEndpoint(reactor, "127.0.0.1", server.getHost().port)
+    database = StandInPool(feed_urls)
+    work_dir = tempfile.mkdtemp(prefix="rkc_benchmark")
+    environ['RKC_KEYWORD_PATH'] = path.join(work_dir, "keywords")
+    environ['RKC_REPORT_PATH'] = path.join(work_dir, "reports")
+    environ.pop('RKC_PAGE_PATH', None)
+    # Imported late so the services see the environment set above
+    from feed import FeedCollector
+    from fetch import PageFetcher
+    from parse import EntryParser
+    from reporting import ReporterWriter
+
+    stages = results["stages"]
+    try:
+        queue = EntryQueue(args.queue) if args.queue else None
+        collector = FeedCollector(database, queue=queue)
+        collector.fetcher = PageFetcher(agent=ProxyAgent(endpoint),
+                                        max_bytes=collector.fetcher.max_bytes)
+        parser = EntryParser(database, workers=args.workers,
+                             preload=args.languages.split(","))
+        parser.fetcher = PageFetcher(agent=ProxyAgent(endpoint),
+                                     max_bytes=parser.fetcher.max_bytes,
+                                     content_types=parser.fetcher.content_types)
+        if queue is not None:
+            parser.consume(queue)
+        start = time.time()
+        yield collector.run()
+        elapsed = time.time() - start
+        stages["collect"] = {"seconds": elapsed, "feeds": len(feed_urls),
+                             "entries": len(database.entries),
+                             "entries_per_second": len(database.entries) / elapsed}
+
+        # With a queue, part of the parsing overlaps the collect stage and
+        # this stage only covers what is left
+        start = time.time()
+        if queue is not None:
+            yield drained(parser, queue)
+        yield parser.run()
+        elapsed = time.time() - start
+        parsed = sum(1 for entry in database.entries.values() if entry["scraped"])
+        dropped = sum(1 for entry in database.entries.values()
+                      if not entry["scraped"] and entry["attempts"] >= parser.max_attempts)
+        stages["parse"] = {"seconds": elapsed, "entries": parsed,
+                           "dropped": dropped,
+                           "failed": len(database.entries) - parsed - dropped,
+                           "terms": len(database.terms),
+                           "entries_per_second": parsed / elapsed}
+        yield parser.stop()
+
+        reporter = ReporterWriter(database)
+        start = time.time()
+        yield reporter.update_files()
+        elapsed = time.time() - start
+        stages["report"] = {"seconds": elapsed, "terms": len(database.terms),
+                            "terms_per_second": len(database.terms) / elapsed}
+    finally:
+        server.stopListening()
+        shutil.rmtree(work_dir)
+        reactor.stop()
+
+
+def main(args):
+    metrics.keep_samples = True
+    results = {"commit": commit(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "config": vars(args),
+               "stages": {}}
+
+    def failed(failure):
+        results["error"] = failure.getErrorMessage()
+        failure.printTraceback()
+    reactor.callWhenRunning(lambda: run_pipeline(args, results).addErrback(failed))
+    reactor.run()
+
+    snapshot = metrics.snapshot()
+    results["latency"] = snapshot["histograms"]
+    results["counters"] = snapshot["counters"]
+    results["peak_rss_kb"] = peak_rss_kb()
+
+    for stage, figures in sorted(results["stages"].items()):
+        print(u"{0:>8}: {1}".format(stage, u", ".join(
+            u"{0} {1:.1f}".format(name, value) if isinstance(value, float)
+            else u"{0} {1}".format(name, value)
+            for name, value in sorted(figures.items()))))
+    for name, summary in sorted(results["latency"].items()):
+        print(u"{0:>32}: {count:6d} timed, p50 {p50:.4f}s, p99 {p99:.4f}s".format(
+            name, **summary))
+    print(u"Peak RSS: {main} KiB main, {largest_worker} KiB largest worker".format(
+        **results["peak_rss_kb"]))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=1, sort_keys=True)
+    return 1 if "error" in results else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--feeds", type=int, default=20)
+    parser.add_argument("--items", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--languages", default="en,fa",
+                        help="Languages preloaded by the parser.")
+    parser.add_argument("--queue", type=int, default=0,
+                        help="Size of the entry queue from the collector to the parser "
+                             "(0 leaves the parser to poll the database).")
+    parser.add_argument("--output", help="File to save the results to as JSON.")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+"""An in-process stand-in for the Postgres database, for benchmarks.
+
+StandInPool answers the statements the feed collector, entry parser and
+report writer send, from plain Python containers. It only understands
+those statements, anything else raises NotImplementedError so a query
+added to the services cannot silently go unanswered. Interactions run
+synchronously in the reactor thread, so database timings measured with it
+say nothing about Postgres.
+"""
+
+from collections import OrderedDict
+import time
+
+from twisted.internet.defer import maybeDeferred
+
+from metrics import metrics
+
+
+def _text(value):
+    # psycopg2 hands text back as UTF-8 bytes under Python 2
+    if bytes is str and isinstance(value, unicode):  # noqa: F821
+        return value.encode("utf-8")
+    return value
+
+
+class StandInCursor(object):
+    """The cursor handed to runInteraction callables."""
+
+    def __init__(self, database):
+        self.database = database
+        self.bound = []
+        self.rows = []
+        self.description = None
+        self.open_cursor = None
+
+    def mogrify(self, template, row):
+        # The rows are kept as they are, the statement refers to them by index
+        self.bound.append(row)
+        return "@{0}".format(len(self.bound) - 1)
+
+    def execute(self, query, args=None):
+        query = " ".join(query.split())
+        rows = self.database.execute(self, query, args or ())
+        self.description = None if rows is None else [("column",)]
+        self.rows = rows or []
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def bound_rows(self, query):
+        values = query.split(" VALUES ", 1)[1].split(" ON CONFLICT", 1)[0]
+        return [self.bound[int(value.strip()[1:])] for value in values.split(",")]
+
+
+class StandInPool(object):
+    """ Stands in for an adbapi.ConnectionPool holding the service's tables.
+
+    Interactions are timed into the metrics registry under the same names
+    as TimedConnectionPool uses.
+    """
+
+    def __init__(self, feeds):
+        """
+        Args:
+        feeds (list): Urls of the rows of the feeds table.
+        """
+        self.feeds = list(feeds)
+        self.validators = {}
+        # url -> dict of the entry's columns
+        self.entries = OrderedDict()
+        # term -> [id, censored]
+        self.terms = OrderedDict()
+        self.term_counts = {}
+        self.statements = 0
+
+    def runInteraction(self, interaction, *args, **kw):
+        owner = getattr(interaction, "__self__", None)
+        name = interaction.__name__.lstrip("_")
+        if owner is not None and owner is not self:
+            # type() of an old-style instance (e.g. a ClientFactory) is "instance"
+            name = "{0}.{1}".format(owner.__class__.__name__, name)
+        with metrics.timer("db." + name):
+            return maybeDeferred(interaction, StandInCursor(self), *args, **kw)
+
+    def runQuery(self, query, args=None):
+        return self.runInteraction(self._runQuery, query, args)
+
+    def runOperation(self, query, args=None):
+        return self.runInteraction(self._runOperation, query, args)
+
+    @staticmethod
+    def _runQuery(txn, query, args):
+        txn.execute(query, args)
+        return txn.fetchall()
+
+    @staticmethod
+    def _runOperation(txn, query, args):
+        txn.execute(query, args)
+
+    def execute(self, txn, query, args):
+        self.statements += 1
+        if query.startswith("DECLARE chunked_rows NO SCROLL CURSOR FOR "):
+            txn.open_cursor = iter(self.select(query[len("DECLARE chunked_rows "
+                                                         "NO SCROLL CURSOR FOR "):],
+                                               args))
+            return None
+        if query.startswith("FETCH FORWARD"):
+            return [row for _, row in zip(range(args[0]), txn.open_cursor)]
+        if query == "CLOSE chunked_rows":
+            txn.open_cursor = None
+            return None
+        if query.startswith("SELECT"):
+            return self.select(query, args)
+        if query.startswith("INSERT INTO feed_validators"):
+            self.validators[args[0]] = tuple(args[1:])
+            return None
+        if query.startswith("INSERT INTO entries"):
+            inserted = []
+            for url, language, description, title, published, feed in txn.bound_rows(query):
+                url = _text(url)
+                if url not in self.entries:
+                    self.entries[url] = {"language": language, "title": title,
+                                         "feed": feed, "scraped": False,
+                                         "term_file": None, "page_digest": None,
+                                         "claimed_until": None,
+                                         "attempts": 0, "retry_after": None}
+                    inserted.append((url,))
+            return inserted
+        if query.startswith("INSERT INTO terms"):
+            inserted = []
+            for (term,) in txn.bound_rows(query):
+                if term not in self.terms:
+                    self.terms[term] = [len(self.terms) + 1, False]
+                    inserted.append((_text(term), self.terms[term][0]))
+            return inserted
+        if query.startswith("INSERT INTO term_counts"):
+            for term_id, bucket, count in txn.bound_rows(query):
+                self.term_counts[(term_id, bucket)] = self.term_counts.get((term_id, bucket), 0) + count
+            return None
+        if query.startswith("UPDATE entries SET claimed_until = now() +"):
+            if "url = ANY(" in query:
+                return self.claim_urls(*args)
+            return self.claim(*args)
+        if query.startswith("UPDATE entries SET term_file"):
+            entry = self.entries[_text(args[2])]
+            entry.update(term_file=args[0], page_digest=args[1], scraped=True,
+                         claimed_until=None)
+            return None
+        if query.startswith("UPDATE entries SET claimed_until = NULL, attempts"):
+            self.entries[_text(args[1])].update(claimed_until=None, attempts=args[0])
+            return None
+        if query.startswith("UPDATE entries SET claimed_until = NULL, page_digest"):
+            entry = self.entries[_text(args[2])]
+            entry.update(claimed_until=None,
+                         page_digest=args[0] or entry["page_digest"],
+                         retry_after=time.time() + args[1] * 2 ** (entry["attempts"] - 1))
+            return None
+        raise NotImplementedError(query)
+
+    def select(self, query, args):
+        if query == "SELECT url FROM feeds":
+            return [(url,) for url in self.feeds]
+        if query.startswith("SELECT url, etag, last_modified, content_hash FROM feed_validators"):
+            return [(url,) + validator for url, validator in self.validators.items()]
+        if query.startswith("SELECT term, id FROM (SELECT term, id FROM terms ORDER BY id DESC"):
+            newest = sorted(self.terms.items(), key=lambda item: -item[1][0])[:args[0]]
+            return sorted((_text(term), term_id) for term, (term_id, _) in newest)
+        if query == "SELECT term, id FROM terms WHERE term = ANY(%s)":
+            return [(_text(term), self.terms[term][0])
+                    for term in args[0] if term in self.terms]
+        if query.startswith("SELECT id, term FROM terms WHERE censored = "):
+            censored = query.split("censored = ")[1].startswith("true")
+            return [(term_id, _text(term))
+                    for term, (term_id, term_censored) in self.terms.items()
+                    if term_censored == censored and term_id > args[0]]
+        raise NotImplementedError(query)
+
+    def claim_urls(self, lease, urls):
+        now = time.time()
+        claimed = []
+        for url in urls:
+            entry = self.entries.get(_text(url))
+            if (entry is None or entry["scraped"] or
+                    (entry["claimed_until"] or 0) >= now):
+                continue
+            entry["claimed_until"] = now + lease
+            entry["attempts"] += 1
+            claimed.append((_text(url), entry["page_digest"]))
+        return claimed
+
+    def claim(self, lease, max_attempts, limit):
+        now = time.time()
+        claimed = []
+        for url, entry in self.entries.items():
+            if len(claimed) >= limit:
+                break
+            if (entry["scraped"] or entry["attempts"] >= max_attempts or
+                    (entry["claimed_until"] or 0) >= now or
+                    (entry["retry_after"] or 0) > now):
+                continue
+            entry["claimed_until"] = now + lease
+            entry["attempts"] += 1
+            claimed.append((url, entry["page_digest"]))
+        return claimed
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+from datetime import datetime
+
+from twisted.enterprise import adbapi
+
+from metrics import metrics
+
+
+# The size of the terms.term column
+TERM_LENGTH = 150
+
+
+class TimedConnectionPool(adbapi.ConnectionPool):
+    """ An adbapi.ConnectionPool that times every interaction.
+
+    Interactions are timed from the call until the result is back in the
+    reactor, which includes any wait for a free connection. They are named
+    after the method run, e.g. "db.EntryWriter.write" or "db.runQuery".
+    """
+
+    # Interactions started and not finished, across all pools
+    in_flight = 0
+
+    def runInteraction(self, interaction, *args, **kw):
+        owner = getattr(interaction, "__self__", None)
+        name = interaction.__name__.lstrip("_")
+        if owner is not None and owner is not self:
+            # type() of an old-style instance (e.g. a ClientFactory) is "instance"
+            name = "{0}.{1}".format(owner.__class__.__name__, name)
+        TimedConnectionPool.in_flight += 1
+        result = adbapi.ConnectionPool.runInteraction(self, interaction, *args, **kw)
+        result.addBoth(self._finished)
+        return metrics.time_deferred("db." + name, result)
+
+    @staticmethod
+    def _finished(result):
+        TimedConnectionPool.in_flight -= 1
+        return result
+
+
+metrics.gauge("db.in_flight", lambda: TimedConnectionPool.in_flight)
+
+
+def insert_many(txn, statement, template, rows, suffix=""):
+    """ Run a single multi-row INSERT inside an interaction.
+
+    Each row is bound to the template by the database driver, so values are
+    escaped the same way as a normal parameterised query.
+
+    Args:
+        txn (adbapi.Transaction): The cursor of a runInteraction call.
+        statement (str): The start of the query, e.g. "INSERT INTO terms (term) VALUES ".
+        template (str): The placeholder for one row, e.g. "(%s)".
+        rows (list): A sequence of parameter tuples, one per row.
+        suffix (str): Anything to follow the values, e.g. "ON CONFLICT DO NOTHING".
+
+    Returns:
+        The rows produced by a RETURNING clause in the suffix (if any).
+    """
+    if not rows:
+        return []
+    values = ",".join(txn.mogrify(template, row) for row in rows)
+    txn.execute(" ".join([statement, values, suffix]))
+    if txn.description is None:
+        return []
+    return txn.fetchall()
+
+
+def fetch_chunks(txn, query, chunk_size=10000, args=None):
+    """ Read a query's result in chunks through a server side cursor.
+
+    Only one chunk of rows is held in memory at a time, whatever the size of
+    the result. Must be used inside a runInteraction call.
+
+    Yields:
+        Lists of at most chunk_size rows.
+    """
+    txn.execute("DECLARE chunked_rows NO SCROLL CURSOR FOR " + query, args)
+    try:
+        while True:
+            txn.execute("FETCH FORWARD %s FROM chunked_rows", (chunk_size,))
+            rows = txn.fetchall()
+            if not rows:
+                break
+            yield rows
+    finally:
+        txn.execute("CLOSE chunked_rows")
+
+
+class EntryWriter(object):
+
+    def __init__(self, dbconn, batch_size=500):
+        """
+        Args:
+        dbconn (adbapi.ConnectionPool): Pool used to write the entries.
+        batch_size (int): Maximum number of entries sent in one INSERT.
+        """
+        self.dbpool = dbconn
+        self.batch_size = batch_size
+
+    def write(self, entries):
+        """ Insert parsed feed entries, skipping any url already stored.
+
+        All batches are written inside one transaction.
+
+        Args:
+            entries (list): Entry dicts as built by FeedCollector.parse_entries.
+
+        Returns:
+            A Deferred that fires with a tuple (inserted, skipped) where
+            inserted lists the urls of the entries stored and skipped counts
+            the entries dropped as duplicates.
+        """
+        return self.dbpool.runInteraction(self._write, list(entries))
+
+    def _write(self, txn, entries):
+        inserted = []
+        for start in range(0, len(entries), self.batch_size):
+            rows = [self._row(entry)
+                    for entry in entries[start:start + self.batch_size]]
+            stored = insert_many(txn,
+                                 "INSERT INTO entries "
+                                 "(url, language, description, "
+                                 "title, published, scraped, feed) "
+                                 "VALUES",
+                                 "(%s, %s, %s, %s, %s, 'false', %s)",
+                                 rows,
+                                 "ON CONFLICT (url) DO NOTHING "
+                                 "RETURNING url")
+            inserted += [row[0] for row in stored]
+        return inserted, len(entries) - len(inserted)
+
+    @staticmethod
+    def _row(entry):
+        return (entry.get('link', ""),
+                entry.get('language', ""),
+                entry.get('description', ""),
+                entry.get('title', ""),
+                entry.get('pubDate', datetime.now()),
+                entry.get('url', ""))
@@ -13,19 +13,190 @@
 # ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
 # FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
 
+import calendar
+from collections import Counter, OrderedDict, namedtuple
 from datetime import datetime
 import feedparser
+import hashlib
+from io import BytesIO
+from lxml import etree
+import time
 
 from twisted.application import service
-from twisted.enterprise import adbapi
-from twisted.internet import task, protocol
-from twisted.internet.defer import inlineCallbacks
-from twisted.web.client import getPage
+from twisted.internet import protocol
+from twisted.internet.defer import DeferredList, inlineCallbacks, returnValue
+
+from db import EntryWriter, TimedConnectionPool
+from fetch import PageFetcher
+from metrics import metrics
+from schedule import FeedScheduler
+from shard import ShardMembership
+
+# The result of polling a feed once.
+#   outcome: "failed", "not modified", "unchanged" or "parsed".
+#   inserted: Number of new entries stored.
+#   validator: The (etag, last_modified, content_hash) to send next time.
+#   ttl: The channel's ttl in minutes, or None.
+#   skip_hours: The GMT hours the channel asks not to be polled in.
+#   lags: Seconds between publication and discovery of each new entry
+#         that has a publication date.
+Poll = namedtuple("Poll", ["outcome", "inserted", "validator", "ttl",
+                           "skip_hours", "lags"])
+
+# feedparser's date parser, which understands the date formats feeds use
+parse_date = getattr(feedparser, "_parse_date", None)
+
+# Namespaces of the item elements read: plain RSS 2.0, Atom, Dublin Core
+# and RSS 1.0. Extension elements with the same local name (media:title,
+# itunes:summary, ...) are left out.
+ENTRY_NAMESPACES = frozenset([None,
+                              "http://www.w3.org/2005/Atom",
+                              "http://purl.org/dc/elements/1.1/",
+                              "http://purl.org/rss/1.0/"])
+
+# RSS and Atom item elements -> the entry field they fill. The first
+# element found for a field is kept.
+ENTRY_FIELDS = {"title": "title",
+                "link": "link",
+                "description": "description",
+                "summary": "description",
+                "content": "description",
+                "author": "author",
+                "creator": "author",
+                "category": "category",
+                "guid": "guid",
+                "id": "guid",
+                "comments": "comments",
+                "pubDate": "pubDate",
+                "published": "pubDate",
+                "date": "pubDate"}
+
+# Item elements only used when none of the ENTRY_FIELDS elements for their
+# field is found
+FALLBACK_FIELDS = {"updated": "pubDate"}
+
+
+def feed_hints(body):
+    """ Read the polling hints of an RSS channel.
+
+    Only the channel's own elements are read, parsing stops at the first item.
+
+    Returns:
+        Tuple (ttl, skip_hours) where ttl is in minutes (or None) and
+        skip_hours is a frozenset of GMT hours.
+    """
+    ttl, skip_hours = None, set()
+    try:
+        for event, element in etree.iterparse(BytesIO(body),
+                                              events=("start", "end"),
+                                              recover=True):
+            name = etree.QName(element).localname
+            if name in ("item", "entry"):
+                break
+            if event == "start":
+                continue
+            text = (element.text or "").strip()
+            if name == "ttl" and text.isdigit():
+                ttl = int(text)
+            elif name == "hour" and text.isdigit() and int(text) < 24:
+                skip_hours.add(int(text))
+    except etree.LxmlError:
+        pass
+    return ttl, frozenset(skip_hours)
+
+
+def entry_key(entry):
+    """The guid of an entry, or its link when it has none."""
+    return entry.get("guid") or entry.get("link", "")
+
+
+def stream_entries(body, seen=(), stop_after=3):
+    """ Read the items of an RSS or Atom feed one at a time.
+
+    Feeds list their newest items first, so reading stops once stop_after
+    items in a row have keys in seen. Items are dropped from the tree as
+    soon as they are read.
+
+    Args:
+        body (bytes): The feed document.
+        seen (set): Keys (see entry_key) of entries already stored.
+        stop_after (int): Number of seen items in a row that ends the read.
+
+    Returns:
+        Tuple (entries, language, stopped) where entries lists the unseen
+        entries as dicts, language is the channel's language and stopped
+        is True when reading ended early.
+    """
+    entries, language, in_a_row = [], "", 0
+    item = entry = fallbacks = None
+    for event, element in etree.iterparse(BytesIO(body), events=("start", "end"),
+                                          recover=True):
+        qname = etree.QName(element)
+        name = qname.localname
+        if qname.namespace not in ENTRY_NAMESPACES:
+            continue
+        if name in ("item", "entry"):
+            if event == "start":
+                item, entry, fallbacks = element, {}, {}
+                continue
+            for field, text in fallbacks.items():
+                entry.setdefault(field, text)
+            if entry_key(entry) in seen:
+                in_a_row += 1
+                if in_a_row >= stop_after:
+                    return entries, language, True
+            else:
+                in_a_row = 0
+                entries.append(entry)
+            item = entry = fallbacks = None
+            # Free the items already read
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        elif event == "start":
+            continue
+        elif entry is None:
+            if name == "language" and not language:
+                language = (element.text or "").strip()
+        elif element.getparent() is not item:
+            # Only the item's own elements, not those of an Atom <source>
+            # or an <author>'s <name>
+            continue
+        elif name in ENTRY_FIELDS and ENTRY_FIELDS[name] not in entry:
+            href = element.get("href")
+            if name == "link" and href is not None:
+                # Atom links, only the article itself is wanted
+                if element.get("rel", "alternate") == "alternate":
+                    entry["link"] = href
+            else:
+                text = element_text(element)
+                if text:
+                    entry[ENTRY_FIELDS[name]] = text
+        elif name in FALLBACK_FIELDS and FALLBACK_FIELDS[name] not in fallbacks:
+            text = element_text(element)
+            if text:
+                fallbacks[FALLBACK_FIELDS[name]] = text
+    return entries, language, False
+
+
+def element_text(element):
+    """ The stripped text of an item element.
+
+    An Atom <author> is read from its <name> child rather than as all its
+    text run together.
+    """
+    if etree.QName(element).localname == "author":
+        for child in element:
+            if (isinstance(child.tag, str) and etree.QName(child).localname == "name"
+                    and etree.QName(child).namespace in ENTRY_NAMESPACES):
+                element = child
+                break
+    return u"".join(element.itertext()).strip()
 
 
 class FeedService(service.Service):
 
-    def __init__(self, feed_db, interval=30):
+    def __init__(self, feed_db, interval=30, queue=None, shard_node=None):
         """
         Args:
         feed (named_tuple):
@@ -36,80 +207,184 @@ class FeedService(service.Service):
             host: The host where the database can be reached
             port: The port used to access the database
         interval (int): Number of minutes between feed queries (rounded to nearest minute).
+        queue (EntryQueue): Queue new entries are handed to the parser through.
+        shard_node (str): This collector's name when several collectors share
+                          the feeds (None polls every feed).
         """
         self.interval = int(interval / 60)
         if self.interval <= 60:
             self.interval = 60
 
-        self.dbpool = adbapi.ConnectionPool(feed_db.dbmodule,
-                                            host = feed_db.host,
-                                            port = feed_db.port,
-                                            database = feed_db.name,
-                                            user = feed_db.user,
-                                            password = feed_db.password,
-                                            cp_noisy = True)
+        self.dbpool = TimedConnectionPool(feed_db.dbmodule,
+                                          host = feed_db.host,
+                                          port = feed_db.port,
+                                          database = feed_db.name,
+                                          user = feed_db.user,
+                                          password = feed_db.password,
+                                          cp_noisy = True)
         # Create a feed collector
-        self.feed_collector = FeedCollector(self.dbpool)
-        # Every [interval] run the collector
-        self.call = task.LoopingCall(self.startService).start(self.interval)
+        self.feed_collector = FeedCollector(self.dbpool, queue=queue)
+        # Only poll this node's share of the feeds
+        self.shard = None
+        if shard_node is not None:
+            self.shard = ShardMembership(self.dbpool, shard_node)
+        # Poll each feed on its own schedule, busy feeds as often as every
+        # [interval] and quiet ones less often
+        self.scheduler = FeedScheduler(self.feed_collector,
+                                       min_interval=self.interval,
+                                       shard=self.shard)
 
     def startService(self):
         print("Starting Feed Collector")
-        self.feed_collector.run()
+        if self.shard is not None:
+            self.shard.start()
+        self.scheduler.start()
 
     def stopService(self):
-        # stop the reactor.call
-        if self.call:
-            self.call.cancel()
+        self.scheduler.stop()
+        if self.shard is not None:
+            # Leave straight away so the other nodes take over this share
+            return self.shard.stop()
 
 class FeedCollector(protocol.ClientFactory):
-    def __init__(self, dbconn):
+    def __init__(self, dbconn, max_concurrent=50, per_host=2, timeout=30,
+                 batch_size=500, incremental=True, seen_limit=2000, queue=None,
+                 max_bytes=10 * 1024 * 1024):
+        """
+        Args:
+        dbconn (adbapi.ConnectionPool): Pool used for all feed and entry queries.
+        max_concurrent (int): Maximum number of feeds downloaded at once.
+        per_host (int): Maximum number of feeds downloaded from one host at once.
+        timeout (int): Number of seconds before a feed download is abandoned.
+        batch_size (int): Maximum number of entries written in one INSERT.
+        incremental (bool): Stream feeds and stop reading at the entries
+                            already stored, instead of parsing every entry
+                            with feedparser.
+        seen_limit (int): Number of entry keys remembered per feed in incremental mode.
+        queue (EntryQueue): Queue the urls of newly stored entries are offered
+                            to, so a parser can start on them straight away.
+        max_bytes (int): Largest feed downloaded, larger ones are abandoned.
+        """
         self.dbpool = dbconn
-        self.feeds = set()
+        self.fetcher = PageFetcher(max_concurrent, per_host, timeout,
+                                   max_bytes=max_bytes)
+        self.entry_writer = EntryWriter(dbconn, batch_size)
+        self.incremental = incremental
+        self.seen_limit = seen_limit
+        self.queue = queue
+        # feed url -> OrderedDict of the keys of its stored entries, oldest first
+        self.seen = {}
+        self.stats = Counter()
+        metrics.gauge("feed.fetch_in_flight", lambda: self.fetcher.in_flight)
 
     @inlineCallbacks
     def run(self):
         feeds = yield self.get_feed_list()
         #print(feeds)
-        for url in feeds:
-            page = yield getPage(url[0])
-            entry_feeds = self.parse_entries(page, url)
-            for entry_name, entry_items in entry_feeds.iteritems():
-                #print(entry_name)
-                entry = yield self.update_entries(entry_items)
+        validators = yield self.get_validators()
+        self.stats = Counter()
+        collecting = [self.collect(url[0], validators.get(url[0]))
+                      for url in feeds]
+        results = yield DeferredList(collecting, consumeErrors=True)
+        for success, poll in results:
+            self.stats[poll.outcome if success else "failed"] += 1
+        print("Collected {0} feeds: {1} not modified, {2} unchanged, "
+              "{3} parsed ({4} stopped early), {5} new entries, "
+              "{6} duplicates".format(
+                  len(results), self.stats["not modified"],
+                  self.stats["unchanged"], self.stats["parsed"],
+                  self.stats["stopped early"], self.stats["inserted"],
+                  self.stats["skipped"]))
 
+    @inlineCallbacks
+    def collect(self, url, validator=None):
+        """Download a single feed and store any entries found in it.
 
-    def query_feeds(self):
-        for feed in self.feeds:
-            page = getPage(feed)
-            page.addCallback(self.update_feed, url=feed)
-            yield page, feed
+        Args:
+            url (str): The feed's URL.
+            validator (tuple): The (etag, last_modified, content_hash) stored
+                               the last time this feed was parsed, if any.
 
-    def update_feed(self, page, url):
-        feed = feedparser.parse(page)
-        channel_info = {}
-        channel_items = ["title", "description",
-                         "language", "lastBuildDate",
-                         "ttl", "pubDate", "copyright",
-                         "webMaster", "managingEditor"]
-
-        channel_info = {item: feed.feed.get(item, "") for item in channel_items}
-
-        db = self.dbpool.runOperation("UPDATE feeds "
-                                      "SET title = %s, "
-                                      "language = %s, "
-                                      "description = %s "
-                                      "WHERE url = %s",
-                                      (channel_info['title'],
-                                       channel_info['language'],
-                                       channel_info['description'],
-                                       url))
-        return db
+        Returns:
+            A Deferred that fires with a Poll.
+        """
+        etag, last_modified, content_hash = validator or (None, None, None)
+        unchanged = Poll("unchanged", 0, validator, None, frozenset(), [])
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        try:
+            page = yield self.fetcher.fetch(url, headers)
+        except Exception as err:
+            metrics.count("feed.failed")
+            print(u"Could not fetch feed {0}: {1}".format(url, err))
+            returnValue(unchanged._replace(outcome="failed"))
+        if page.code == 304:
+            returnValue(unchanged._replace(outcome="not modified"))
+
+        new_etag = page.headers.getRawHeaders("etag", [None])[0]
+        new_last_modified = page.headers.getRawHeaders("last-modified", [None])[0]
+        new_hash = hashlib.sha1(page.body).hexdigest()
+        new_validator = (new_etag, new_last_modified, new_hash)
+        if new_hash == content_hash:
+            # Servers without validators still send the same bytes back,
+            # keep any validators they did send and skip the parse.
+            if (new_etag, new_last_modified) != (etag, last_modified):
+                yield self.update_validator(url, *new_validator)
+            returnValue(unchanged._replace(validator=new_validator))
+
+        with metrics.timer("feed.parse"):
+            if self.incremental:
+                entry_feeds = self.stream_new_entries(page.body, url)
+            else:
+                entry_feeds = self.parse_entries(page.body, url)
+        inserted, skipped = yield self.update_entries(entry_feeds.values())
+        metrics.count("feed.new_entries", len(inserted))
+        if self.queue is not None:
+            self.queue.offer(inserted)
+        self.stats["inserted"] += len(inserted)
+        self.stats["skipped"] += skipped
+        # Only remember the feed once its entries are stored so that a
+        # failed insert is retried on the next poll.
+        yield self.update_validator(url, *new_validator)
+        self.remember(url, entry_feeds.values())
+        ttl, skip_hours = feed_hints(page.body)
+        returnValue(Poll("parsed", len(inserted), new_validator, ttl,
+                         skip_hours, self.lags(entry_feeds.values(), inserted)))
+
+    @staticmethod
+    def lags(entries, inserted):
+        """Seconds from publication to now of the inserted entries that have a date."""
+        now = time.time()
+        inserted = set(inserted)
+        return [max(now - calendar.timegm(entry["published_parsed"]), 0.0)
+                for entry in entries
+                if entry.get("link", "") in inserted and entry.get("published_parsed")]
 
 
     def get_feed_list(self):
         return self.dbpool.runQuery("SELECT url FROM feeds")
 
+    def get_validators(self):
+        """Map each feed url to its stored (etag, last_modified, content_hash)."""
+        validators = self.dbpool.runQuery("SELECT url, etag, last_modified, "
+                                          "content_hash FROM feed_validators")
+        validators.addCallback(lambda rows: {row[0]: row[1:] for row in rows})
+        return validators
+
+    def update_validator(self, url, etag, last_modified, content_hash):
+        db = self.dbpool.runOperation("INSERT INTO feed_validators "
+                                      "(url, etag, last_modified, content_hash) "
+                                      "VALUES (%s, %s, %s, %s) "
+                                      "ON CONFLICT (url) DO UPDATE SET "
+                                      "etag = EXCLUDED.etag, "
+                                      "last_modified = EXCLUDED.last_modified, "
+                                      "content_hash = EXCLUDED.content_hash",
+                                      (url, etag, last_modified, content_hash))
+        return db
+
     def parse_entries(self, page, feed_url):
         feed = feedparser.parse(page)
 
@@ -124,6 +399,7 @@ class FeedCollector(protocol.ClientFactory):
             entries[entry["title"]]["pubDate"] = entry.get("pubDate", datetime.now())
             entries[entry["title"]]["scraped"] = datetime.now()
             entries[entry["title"]]["url"] = feed_url
+            entries[entry["title"]]["published_parsed"] = entry.get("published_parsed")
 
             # Enforcing the database string limits
             entries[entry["title"]]["description"] = entries[entry["title"]]["description"][0:1000]
@@ -135,19 +411,55 @@ class FeedCollector(protocol.ClientFactory):
                 entries[entry["title"]][item] = feed.feed.get(item, "")
         return entries
 
-    def update_entries(self, entry):
-        #print("updating entries")
-        # print(entry)
-        db = self.dbpool.runOperation("INSERT INTO entries "
-                                  "(url, language, description, "
-                                      "title, published, scraped, feed) "
-                                      "VALUES "
-                                      "(%s, %s, %s, %s, %s, 'false', %s) "
-                                      "ON CONFLICT (url) DO NOTHING ",
-                                      (entry.get('link', ""),
-                                       entry.get('language', ""),
-                                       entry.get('description', ""),
-                                       entry.get('title', ""),
-                                       entry.get('pubDate', datetime.now()),
-                                       entry.get('url', ""),))
-        return db
+    def stream_new_entries(self, page, feed_url):
+        """ Read a feed's entries up to the ones already stored.
+
+        Falls back to parse_entries when the feed cannot be streamed.
+
+        Returns:
+            A dict of entry dicts as built by parse_entries.
+        """
+        seen = self.seen.get(feed_url, ())
+        try:
+            items, language, stopped = stream_entries(page, seen)
+        except (etree.LxmlError, ValueError) as err:
+            print(u"Could not stream feed {0}: {1}".format(feed_url, err))
+            return self.parse_entries(page, feed_url)
+        if stopped:
+            self.stats["stopped early"] += 1
+        now = datetime.now()
+        entries = {}
+        for item in items:
+            entry = {item_name: item.get(item_name, "") for item_name in
+                     ["title", "link", "description", "author",
+                      "category", "guid", "comments"]}
+            # Only pass on dates that could be parsed, so a malformed date
+            # cannot fail the feed's whole INSERT
+            entry["published_parsed"] = None
+            if "pubDate" in item and parse_date is not None:
+                entry["published_parsed"] = parse_date(item["pubDate"])
+            entry["pubDate"] = now
+            if entry["published_parsed"]:
+                entry["pubDate"] = datetime.fromtimestamp(
+                    calendar.timegm(entry["published_parsed"]))
+            entry["language"] = language
+            entry["url"] = feed_url[0:512]
+            # Enforcing the database string limits
+            entry["description"] = entry["description"][0:1000]
+            entry["title"] = entry["title"][0:500]
+            entries[entry["title"] or entry_key(entry)] = entry
+        return entries
+
+    def remember(self, feed_url, entries):
+        """Keep the keys of a feed's stored entries for the next incremental read."""
+        if not self.incremental:
+            return
+        seen = self.seen.setdefault(feed_url, OrderedDict())
+        for entry in entries:
+            seen[entry_key(entry)] = True
+        while len(seen) > self.seen_limit:
+            seen.popitem(last=False)
+
+    def update_entries(self, entries):
+        """Store a feed's entries. Fires with (inserted urls, skipped)."""
+        return self.entry_writer.write(entries)
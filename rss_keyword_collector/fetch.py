@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+from collections import namedtuple
+import codecs
+import re
+from urlparse import urlparse
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.protocol import Protocol
+from twisted.web import error
+from twisted.web.client import (Agent, BrowserLikeRedirectAgent,
+                                HTTPConnectionPool, PartialDownloadError,
+                                ResponseDone)
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from metrics import metrics
+
+# A downloaded page.
+#   code (int): The HTTP status of the final response (e.g. 200 or 304).
+#   headers (Headers): The response headers.
+#   body (str): The raw response body.
+#   encoding (str): The charset declared by the headers or the start of the
+#                   body, or None.
+#   lang (str): The language declared by the start of the body or the
+#               headers, or None.
+Page = namedtuple("Page", ["url", "code", "headers", "body", "encoding", "lang"])
+
+USER_AGENT = b"rss_keyword_collector"
+
+# Content types of the pages articles are read from
+HTML_TYPES = frozenset([b"text/html", b"application/xhtml+xml"])
+
+# Charset and language are looked for in this much of the start of a body
+SNIFF_BYTES = 4096
+
+BYTE_ORDER_MARKS = [(codecs.BOM_UTF8, "utf-8"),
+                    (codecs.BOM_UTF16_LE, "utf-16"),
+                    (codecs.BOM_UTF16_BE, "utf-16")]
+META_CHARSET = re.compile(br"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.I)
+HTML_LANG = re.compile(br"""<html\b[^>]*?\slang\s*=\s*["']?([\w-]+)""", re.I)
+
+
+class PageTooLarge(Exception):
+    """The response body is larger than the fetcher's max_bytes."""
+
+
+class UnwantedContent(Exception):
+    """The response is not of a content type the fetcher accepts."""
+
+
+def sniff(head, headers=None):
+    """ Find the charset and language a page declares.
+
+    The charset comes from the Content-Type header, a byte order mark or a
+    <meta> tag, the language from the lang attribute of <html> or the
+    Content-Language header.
+
+    Args:
+        head (str): The start of the body, SNIFF_BYTES is enough.
+        headers (Headers): The response headers, if any.
+
+    Returns:
+        Tuple (encoding, lang), either of which can be None. The encoding is
+        the declared label of a charset Python knows, which the page may
+        still not decode with.
+    """
+    encoding = None
+    content_type = _header(headers, b"content-type")
+    if b"charset=" in content_type.lower():
+        encoding = content_type.lower().split(b"charset=", 1)[1].split(b";")[0]
+        encoding = encoding.strip(b"\"' ")
+    if not encoding:
+        for mark, name in BYTE_ORDER_MARKS:
+            if head.startswith(mark):
+                encoding = name.encode("ascii")
+                break
+    if not encoding:
+        found = META_CHARSET.search(head)
+        encoding = found.group(1) if found else None
+    if encoding:
+        # Keep the label as declared (e.g. "euc-kr"), Python's own codec
+        # names (e.g. "euc_kr") are not understood by lxml or iconv
+        try:
+            encoding = encoding.decode("ascii").lower()
+            codecs.lookup(encoding)
+        except (LookupError, UnicodeDecodeError):
+            encoding = None
+
+    found = HTML_LANG.search(head)
+    lang = found.group(1) if found else _header(headers, b"content-language").split(b",")[0]
+    lang = lang.strip().decode("ascii", "ignore") or None
+    return encoding, lang
+
+
+def _header(headers, name):
+    if headers is None:
+        return b""
+    return headers.getRawHeaders(name, [b""])[0]
+
+
+class LimitedBody(Protocol):
+    """ Reads a response body like readBody, giving up past max_bytes.
+
+    A response can also be turned down before any of its body is read by
+    passing the exception to fail with as reject. finished fires with the
+    body.
+    """
+
+    def __init__(self, response, max_bytes=None, reject=None):
+        self.finished = Deferred(self.cancel)
+        self.status = response.code
+        self.message = response.phrase
+        self.max_bytes = max_bytes
+        self.reject = reject
+        self.chunks = []
+        self.size = 0
+
+    def connectionMade(self):
+        if self.finished.called:
+            # Cancelled before the body started
+            self.transport.stopProducing()
+        elif self.reject is not None:
+            self._give_up(self.reject)
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self._give_up(PageTooLarge(u"More than {0} bytes".format(self.max_bytes)))
+            return
+        self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        body = b"".join(self.chunks)
+        if reason.check(ResponseDone):
+            self.finished.callback(body)
+        elif reason.check(PotentialDataLoss):
+            self.finished.errback(PartialDownloadError(self.status, self.message, body))
+        else:
+            self.finished.errback(reason)
+
+    def _give_up(self, reason):
+        # Drop what was read and close the connection rather than read the
+        # rest of the body
+        self.chunks = []
+        self.transport.stopProducing()
+        self.finished.errback(reason)
+
+    def cancel(self, finished):
+        self.chunks = []
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+
+class PageFetcher(object):
+
+    def __init__(self, max_concurrent=50, per_host=2, timeout=30, agent=None,
+                 max_bytes=None, content_types=None):
+        """
+        Args:
+        max_concurrent (int): Maximum number of requests in flight at once.
+        per_host (int): Maximum number of requests in flight to any single netloc.
+        timeout (int): Number of seconds before a single request is abandoned.
+        agent (IAgent): Agent used for the requests instead of the default
+                        one, e.g. a ProxyAgent pointing at a stand-in server.
+        max_bytes (int): Largest body read, larger responses fail with
+                         PageTooLarge (no limit when None).
+        content_types (frozenset): Content types accepted (e.g. HTML_TYPES),
+                                   other responses fail with UnwantedContent
+                                   before their body is read. All are
+                                   accepted when None.
+        """
+        self.semaphore = DeferredSemaphore(max_concurrent)
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.content_types = content_types
+        self.hosts = {}
+        if agent is None:
+            pool = HTTPConnectionPool(reactor)
+            pool.maxPersistentPerHost = per_host
+            agent = BrowserLikeRedirectAgent(Agent(reactor,
+                                                   connectTimeout=timeout,
+                                                   pool=pool))
+        self.agent = agent
+
+    @property
+    def in_flight(self):
+        return self.semaphore.limit - self.semaphore.tokens
+
+    def fetch(self, url, headers=None):
+        """ Download a page once both a host and a global slot are free.
+
+        The host slot is taken first so that requests queued behind a slow
+        host never hold one of the global slots while they wait.
+
+        Args:
+            url (str): The URL to download.
+            headers (dict): Extra request headers, e.g. If-None-Match.
+
+        Returns:
+            A Deferred that fires with a Page. Responses with a status of
+            400 or above errback with twisted.web.error.Error, oversized
+            ones with PageTooLarge and unwanted ones with UnwantedContent.
+        """
+        host = urlparse(url).netloc.lower()
+        host_lock = self.hosts.get(host)
+        if host_lock is None:
+            host_lock = self.hosts[host] = DeferredSemaphore(self.per_host)
+        metrics.count("fetch.requests")
+        page = host_lock.run(self.semaphore.run, self._timed_get, url, headers)
+        page.addBoth(self._release_host, host)
+        return page
+
+    def _timed_get(self, url, headers):
+        # Only the request itself is timed, not the wait for a slot
+        response = metrics.time_deferred("fetch", self._get(url, headers))
+        response.addErrback(self._failed)
+        return response
+
+    @staticmethod
+    def _failed(failure):
+        if failure.check(PageTooLarge):
+            metrics.count("fetch.too_large")
+        elif failure.check(UnwantedContent):
+            metrics.count("fetch.unwanted")
+        else:
+            metrics.count("fetch.errors")
+        return failure
+
+    def _get(self, url, headers):
+        request_headers = Headers({b"User-Agent": [USER_AGENT]})
+        for name, value in (headers or {}).items():
+            request_headers.addRawHeader(name, value)
+        response = self.agent.request(b"GET", url, request_headers)
+        response.addCallback(self._read, url)
+        response.addTimeout(self.timeout, reactor)
+        return response
+
+    def _read(self, response, url):
+        reader = LimitedBody(response, self.max_bytes, self._unwanted(response))
+        response.deliverBody(reader)
+        reader.finished.addCallback(self._page, url, response)
+        return reader.finished
+
+    def _unwanted(self, response):
+        """The reason to turn a response down without reading it, or None."""
+        if response.code >= 400:
+            return error.Error(response.code, response.phrase)
+        if (self.max_bytes is not None and response.length is not UNKNOWN_LENGTH and
+                response.length > self.max_bytes):
+            return PageTooLarge(u"Content-Length of {0} bytes".format(response.length))
+        content_type = _header(response.headers, b"content-type")
+        content_type = content_type.split(b";")[0].strip().lower()
+        # Pages sent without a content type are given the benefit of the doubt
+        if (self.content_types is not None and content_type and
+                content_type not in self.content_types):
+            return UnwantedContent(content_type.decode("ascii", "replace"))
+        return None
+
+    @staticmethod
+    def _page(body, url, response):
+        encoding, lang = sniff(body[:SNIFF_BYTES], response.headers)
+        return Page(url, response.code, response.headers, body, encoding, lang)
+
+    def _release_host(self, result, host):
+        # Drop idle host locks so the table does not grow with every
+        # netloc we have ever seen.
+        host_lock = self.hosts.get(host)
+        if (host_lock is not None and not host_lock.waiting and
+                host_lock.tokens == host_lock.limit):
+            del self.hosts[host]
+        return result
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+import time
+
+
+class LanguageResources(object):
+    """ Per-process cache of the language resources used by ExtractTerms.
+
+    Tokenizers, stop word sets and NER taggers are loaded the first time a
+    language asks for them and then kept for the life of the process.
+    """
+
+    # Language code -> NLTK stop word corpus name.
+    STOPWORDS = {"en": "english",
+                 "fa": "persian"}
+
+    def __init__(self):
+        self._tokenizers = {}
+        self._stopwords = {}
+        self._taggers = {}
+        self._batch_taggers = {}
+
+    def tokenizer(self, lang=None):
+        """Return a word tokenizer function for a language code."""
+        if lang not in self._tokenizers:
+            if lang == "fa":
+                from hazm import word_tokenize
+            else:
+                from nltk import word_tokenize
+            self._tokenizers[lang] = word_tokenize
+        return self._tokenizers[lang]
+
+    def stopwords(self, lang):
+        """Return the stop words of a language code as a frozenset."""
+        if lang not in self._stopwords:
+            from nltk.corpus import stopwords
+            self._stopwords[lang] = frozenset(
+                stopwords.words(self.STOPWORDS[lang]))
+        return self._stopwords[lang]
+
+    def ner_tagger(self, lang):
+        """Return the polyglot named entity tagger for a language code."""
+        if lang not in self._taggers:
+            from polyglot.tag import get_ner_tagger
+            self._taggers[lang] = get_ner_tagger(lang=lang)
+        return self._taggers[lang]
+
+    def ner_batch_tagger(self, lang):
+        """Return a BatchTagger wrapping the NER tagger of a language code."""
+        if lang not in self._batch_taggers:
+            from ner import BatchTagger
+            self._batch_taggers[lang] = BatchTagger(self.ner_tagger(lang))
+        return self._batch_taggers[lang]
+
+    def preload(self, languages):
+        """ Load every resource of the given language codes up front.
+
+        Tokenizers are run once as some of them (e.g. NLTK's punkt) load
+        their models lazily on first use. Resources that are not installed
+        are reported and skipped.
+        """
+        for lang in languages:
+            start = time.time()
+            try:
+                self.tokenizer(lang)(u"Warm up.")
+                if lang in self.STOPWORDS:
+                    self.stopwords(lang)
+                self.ner_batch_tagger(lang)
+            except Exception as err:
+                print(u"Could not preload {0} language resources: {1}".format(
+                    lang, err))
+                continue
+            print(u"Preloaded {0} language resources in {1:.1f}s".format(
+                lang, time.time() - start))
+
+
+# The registry shared by everything in this process.
+resources = LanguageResources()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+from array import array
+from collections import OrderedDict
+import hashlib
+
+SIMHASH_BITS = 64
+# The simhash is split into this many bands for lookups. Two hashes that
+# differ in fewer bits than there are bands share at least one band.
+SIMHASH_BANDS = 4
+
+
+def _hash64(text):
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def simhash(words):
+    """ A 64 bit SimHash of the three word shingles of a text.
+
+    Texts that share most of their shingles get hashes that differ in only a
+    few bits.
+    """
+    shingles = set(u" ".join(words[i:i + 3])
+                   for i in range(max(len(words) - 2, 1)))
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        value = _hash64(shingle)
+        for bit in range(SIMHASH_BITS):
+            if value >> bit & 1:
+                weights[bit] += 1
+            else:
+                weights[bit] -= 1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def fingerprint(text, near_duplicates=False):
+    """ Key a text for the TermMemo.
+
+    Case and whitespace are ignored so copies of an article that only differ
+    in layout get the same digest.
+
+    Returns:
+        Tuple (digest, simhash) where simhash is None unless near_duplicates.
+    """
+    words = text.lower().split()
+    digest = hashlib.sha1(u" ".join(words).encode("utf-8")).hexdigest()
+    return digest, simhash(words) if near_duplicates else None
+
+
+class TermMemo(object):
+    """ A bounded memo of the terms extracted from recently seen article text.
+
+    Articles are looked up by the fingerprint of their extracted text. With
+    max_distance set, an article whose SimHash is within max_distance bits
+    of a stored one also counts as seen.
+    """
+
+    def __init__(self, max_entries=1000, max_distance=0):
+        """
+        Args:
+        max_entries (int): Number of articles kept, least recently used are evicted.
+        max_distance (int): Largest SimHash distance treated as a near duplicate
+                            (0 turns near duplicate detection off, at most 3).
+        """
+        self.max_entries = max_entries
+        self.max_distance = min(max_distance, SIMHASH_BANDS - 1)
+        # digest -> (simhash, keyword_hash, term ids, seconds)
+        self.entries = OrderedDict()
+        self.bands = [{} for _ in range(SIMHASH_BANDS)]
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    @property
+    def near_duplicates(self):
+        return self.max_distance > 0
+
+    def get(self, key):
+        """ Look up an article by its fingerprint.
+
+        Returns:
+            Tuple (keyword_hash, term_ids) of the stored article, or None.
+        """
+        digest, simhash_value = key
+        if digest not in self.entries:
+            digest = self._near(simhash_value)
+            if digest is None:
+                self.misses += 1
+                return None
+            self.near_hits += 1
+        self.hits += 1
+        entry = self.entries.pop(digest)
+        self.entries[digest] = entry
+        self.seconds_saved += entry[3]
+        return entry[1], entry[2]
+
+    def put(self, key, keyword_hash, term_ids, seconds):
+        """ Remember the terms extracted for an article.
+
+        Args:
+        key (tuple): The article's fingerprint.
+        keyword_hash (str): The keyword file written for the article.
+        term_ids (list): The ids of the article's terms.
+        seconds (float): Time the term extraction took.
+        """
+        digest, simhash_value = key
+        if digest in self.entries:
+            return
+        self.entries[digest] = (simhash_value, keyword_hash, array("l", term_ids), seconds)
+        if simhash_value is not None:
+            for band, value in enumerate(self._bands(simhash_value)):
+                self.bands[band].setdefault(value, set()).add(digest)
+        while len(self.entries) > self.max_entries:
+            old_digest, entry = self.entries.popitem(last=False)
+            if entry[0] is not None:
+                for band, value in enumerate(self._bands(entry[0])):
+                    self.bands[band][value].discard(old_digest)
+                    if not self.bands[band][value]:
+                        del self.bands[band][value]
+
+    def _near(self, simhash_value):
+        if not self.near_duplicates or simhash_value is None:
+            return None
+        for band, value in enumerate(self._bands(simhash_value)):
+            for digest in self.bands[band].get(value, ()):
+                distance = bin(self.entries[digest][0] ^ simhash_value).count("1")
+                if distance <= self.max_distance:
+                    return digest
+        return None
+
+    @staticmethod
+    def _bands(simhash_value):
+        width = SIMHASH_BITS // SIMHASH_BANDS
+        mask = (1 << width) - 1
+        return [(simhash_value >> (band * width)) & mask
+                for band in range(SIMHASH_BANDS)]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"articles": len(self.entries),
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+                "near_hits": self.near_hits,
+                "seconds_saved": self.seconds_saved}
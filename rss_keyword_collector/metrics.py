@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import time
+
+from twisted.application import service
+from twisted.internet import task
+from twisted.web.resource import Resource
+
+# Upper bounds in seconds of the latency histogram buckets, 100us to ~100s
+BUCKETS = [0.0001 * 2 ** i for i in range(21)]
+
+
+class Histogram(object):
+    """ A latency histogram with fixed, doubling buckets.
+
+    Recording is a bisect and two additions, so it is cheap enough for the
+    hot paths. Percentiles are reported as the upper bound of the bucket
+    they fall in, so they are accurate to within a factor of two, unless
+    every sample is kept (for benchmarks).
+    """
+
+    def __init__(self, keep_samples=False):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = [] if keep_samples else None
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if self.samples is not None:
+            self.samples.append(seconds)
+
+    def merge(self, counts, total, samples=None):
+        for bucket, count in enumerate(counts):
+            self.counts[bucket] += count
+        self.count += sum(counts)
+        self.sum += total
+        if self.samples is not None and samples:
+            self.samples.extend(samples)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        if self.samples:
+            samples = sorted(self.samples)
+            return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[bucket] if bucket < len(BUCKETS) else float("inf")
+        return float("inf")
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "p50": self.percentile(0.5),
+                "p99": self.percentile(0.99)}
+
+
+class Registry(object):
+    """ Counters, latency histograms and gauges shared by the services.
+
+    Counters and histograms are created on first use. Gauges are functions
+    read when a snapshot is taken, e.g. the depth of a queue. Everything is
+    updated from the reactor thread, except in pool workers whose metrics
+    are sent back with each job's result (see pool.ProcessPool).
+    """
+
+    def __init__(self, keep_samples=False):
+        """
+        Args:
+        keep_samples (bool): Keep every timing for exact percentiles. Memory
+                             grows with every timing, so only for benchmarks.
+        """
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.keep_samples = keep_samples
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(self.keep_samples)
+        histogram.observe(seconds)
+
+    def gauge(self, name, read):
+        """Report read() as the value of name in every snapshot."""
+        self.gauges[name] = read
+
+    @contextmanager
+    def timer(self, name):
+        """Time the body of a with statement into the name histogram."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def time_deferred(self, name, deferred):
+        """Time a Deferred from now until it fires, successful or not."""
+        start = time.time()
+
+        def done(result):
+            self.observe(name, time.time() - start)
+            return result
+        return deferred.addBoth(done)
+
+    def drain(self):
+        """ Take the counters and histograms recorded so far and reset them.
+
+        Returns:
+            A picklable dict for merge().
+        """
+        drained = {"counters": self.counters,
+                   "histograms": {name: (histogram.counts, histogram.sum,
+                                         histogram.samples)
+                                  for name, histogram in self.histograms.items()}}
+        self.counters = {}
+        self.histograms = {}
+        return drained
+
+    def merge(self, drained):
+        """Add the metrics drained from another process."""
+        for name, value in drained["counters"].items():
+            self.count(name, value)
+        for name, (counts, total, samples) in drained["histograms"].items():
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.keep_samples)
+            histogram.merge(counts, total, samples)
+
+    def snapshot(self):
+        gauges = {}
+        for name, read in self.gauges.items():
+            try:
+                gauges[name] = read()
+            except Exception:
+                gauges[name] = None
+        return {"counters": dict(self.counters),
+                "gauges": gauges,
+                "histograms": {name: histogram.summary()
+                               for name, histogram in self.histograms.items()}}
+
+    def summary_lines(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(u"{0}: {1}".format(name, value))
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append(u"{0}: {1}".format(name, value))
+        for name, summary in sorted(snapshot["histograms"].items()):
+            lines.append(u"{0}: {count} timed, mean {mean:.4f}s, p50 {p50:.4f}s, "
+                         u"p99 {p99:.4f}s".format(name, **summary))
+        return lines
+
+
+# The process wide registry
+metrics = Registry()
+
+
+class MetricsResource(Resource):
+    """Serves a JSON snapshot of a registry."""
+
+    isLeaf = True
+
+    def __init__(self, registry=metrics):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"application/json")
+        return json.dumps(self.registry.snapshot(), indent=1,
+                          sort_keys=True).encode("utf-8")
+
+
+class MetricsService(service.Service):
+    """ Prints a summary of the metrics at an interval.
+
+    The summary is cumulative since the service started.
+    """
+
+    def __init__(self, interval=300, registry=metrics):
+        """
+        Args:
+        interval (int): Seconds between summaries.
+        """
+        self.interval = interval
+        self.registry = registry
+        self.call = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.call = task.LoopingCall(self.report)
+        self.call.start(self.interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.call is not None and self.call.running:
+            self.call.stop()
+
+    def report(self):
+        print(u"Metrics:")
+        for line in self.registry.summary_lines():
+            print(u"  " + line)
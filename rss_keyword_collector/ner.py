@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+import numpy as np
+
+# Words tagged with this are not part of any entity
+OUTSIDE = u"O"
+
+
+class BatchTagger(object):
+    """ Runs a polyglot NER tagger over many texts with matrix operations.
+
+    polyglot's tagger builds a feature vector and runs its network one word
+    at a time. Here the windows of every word of every text are looked up in
+    one indexing operation on the embedding matrix and the network is run on
+    a chunk of words at a time. The tags are the same as the tagger's own
+    (see tests/test_ner.py).
+    """
+
+    def __init__(self, tagger, chunk_size=2048, cached_words=100000):
+        """
+        Args:
+        tagger (polyglot.tag.NEChunker): A loaded tagger, e.g. from
+                                         LanguageResources.ner_tagger.
+        chunk_size (int): Number of words run through the network at once.
+                          Bounds the size of the hidden layer matrix.
+        cached_words (int): Number of words whose embedding row is remembered.
+        """
+        self.tagger = tagger
+        self.chunk_size = chunk_size
+        self.cached_words = cached_words
+        self.first_layer, self.second_layer = tagger.model
+        embeddings = tagger.embeddings
+        # load_embeddings wraps the vocabulary in case and digit expanders,
+        # so a word missing from it can still map to the row of e.g. its
+        # lowercase form. Every lookup goes through them, as the tagger's do.
+        self.vocabulary = embeddings.vocabulary
+        self.row_ids = {}
+        # Words missing from the embeddings get the extra zero row
+        self.missing = len(embeddings.vectors)
+        self.vectors = np.vstack((embeddings.vectors,
+                                  np.zeros((1, embeddings.vectors.shape[1]))))
+        self.unknown = self.vocabulary.get(tagger.UNK, self.missing)
+        self.padding = [self.vocabulary.get(tagger.PAD, self.missing)] * (tagger.context - 1)
+        self.start = self.vocabulary.get(tagger.START, self.missing)
+        self.end = self.vocabulary.get(tagger.END, self.missing)
+        self.tags = [tagger.ID_TAG[i] for i in range(len(tagger.ID_TAG))]
+
+    def _row_id(self, word):
+        """The embedding row of a word, or of the unknown word."""
+        row_id = self.row_ids.get(word)
+        if row_id is None:
+            row_id = self.vocabulary.get(word, self.unknown)
+            if len(self.row_ids) >= self.cached_words:
+                self.row_ids.clear()
+            self.row_ids[word] = row_id
+        return row_id
+
+    def _windows(self, words):
+        """Embedding row ids of the window around each word, one row per word."""
+        context = self.tagger.context
+        ids = (self.padding + [self.start] +
+               [self._row_id(word) for word in words] +
+               [self.end] + self.padding)
+        ids = np.array(ids, dtype=np.intp)
+        offsets = np.arange(2 * context + 1)
+        return ids[np.arange(len(words))[:, None] + offsets]
+
+    def _predict(self, windows):
+        """The best tag id for each row of windows."""
+        features = self.vectors[windows].reshape(len(windows), -1)
+        # (tags, hidden, dims) x (words, dims) -> (tags, hidden, words), the
+        # last column of each layer is the bias
+        hidden = np.dot(self.first_layer[:, :, :-1], features.T)
+        hidden = np.tanh(hidden + self.first_layer[:, :, -1:])
+        output = np.einsum("th,thw->tw", self.second_layer[:, :-1], hidden)
+        output += self.second_layer[:, -1:]
+        # The tagger's sigmoid and normalisation do not change the best tag
+        return output.argmax(axis=0)
+
+    def annotate(self, texts):
+        """ Tag the words of many texts.
+
+        Args:
+        texts (list): Lists of words, one per text.
+
+        Returns:
+            A list of tag lists, one per text.
+        """
+        lengths = [len(words) for words in texts]
+        if not sum(lengths):
+            return [[] for _ in texts]
+        windows = np.vstack([self._windows(words) for words in texts if words])
+        best = np.concatenate([self._predict(windows[start:start + self.chunk_size])
+                               for start in range(0, len(windows), self.chunk_size)])
+        tagged, position = [], 0
+        for length in lengths:
+            tagged.append([self.tags[i] for i in best[position:position + length]])
+            position += length
+        return tagged
+
+
+def chunk_entities(words, tags):
+    """ Group tagged words into entities the way polyglot's Text.entities does.
+
+    Returns:
+        A list of entities, each a list of words.
+    """
+    chunks = []
+    start = 0
+    prev_tag = OUTSIDE
+    for i, tag in enumerate(tags):
+        if tag != prev_tag:
+            if prev_tag == OUTSIDE:
+                start = i
+            else:
+                chunks.append(words[start:i])
+            prev_tag = tag
+    if tags and tags[-1] != OUTSIDE:
+        chunks.append(words[start:])
+    return chunks
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+from collections import OrderedDict
+import hashlib
+from os import listdir, makedirs, path, remove, rename, utime
+from threading import Lock, current_thread
+
+
+def _sha1(data):
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+class PageStore(object):
+    """ An on-disk, content-addressed store of downloaded pages.
+
+    Layout of the store directory:
+        objects/ab/abcd...        A page body, named by its SHA-1.
+        objects/ab/abcd....terms  The extractor version, keyword file name and
+                                  term ids of that body, once extracted.
+
+    The digest of the body last downloaded for an entry is kept with the
+    entry (entries.page_digest), so the store holds one file per body and is
+    bounded by its eviction. Bodies are evicted least recently used first
+    once the store grows past max_bytes. A body extracted by an older
+    extractor version is extracted again.
+
+    The store is used from the reactor's thread pool, the index of bodies is
+    only changed while holding a lock.
+    """
+
+    def __init__(self, root, max_bytes=1024 * 1024 * 1024):
+        """
+        Args:
+        root (str): Directory holding the store. Created if missing.
+        max_bytes (int): Total size of the stored bodies before eviction.
+        """
+        self.root = path.abspath(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+        # digest -> size, least recently used first
+        self.objects = OrderedDict()
+        self.bytes = 0
+        self.lock = Lock()
+        self._load()
+
+    def _load(self):
+        objects = []
+        object_dir = path.join(self.root, "objects")
+        if not path.exists(object_dir):
+            makedirs(object_dir)
+        for prefix in listdir(object_dir):
+            for name in listdir(path.join(object_dir, prefix)):
+                if "." in name:
+                    continue
+                mtime = path.getmtime(path.join(object_dir, prefix, name))
+                size = path.getsize(path.join(object_dir, prefix, name))
+                objects.append((mtime, name, size))
+        for _, digest, size in sorted(objects):
+            self.objects[digest] = size
+            self.bytes += size
+
+    def _path(self, digest):
+        return path.join(self.root, "objects", digest[:2], digest)
+
+    def _write(self, file_path, data):
+        directory = path.dirname(file_path)
+        if not path.exists(directory):
+            try:
+                makedirs(directory)
+            except OSError:
+                # Made by another thread in the meantime
+                if not path.isdir(directory):
+                    raise
+        # Write then rename so a crash never leaves a partial file behind,
+        # threads storing the same body each write their own copy
+        temp_path = "{0}.{1}.tmp".format(file_path, current_thread().ident)
+        with open(temp_path, "wb") as stored:
+            stored.write(data)
+        rename(temp_path, file_path)
+
+    def get(self, digest):
+        """The stored body with a digest, or None."""
+        try:
+            with open(self._path(digest), "rb") as stored:
+                body = stored.read()
+        except (IOError, OSError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self._touch(digest)
+        return body
+
+    def put(self, body):
+        """ Store a downloaded body.
+
+        Returns:
+            The body's digest.
+        """
+        digest = _sha1(body)
+        with self.lock:
+            stored = digest in self.objects
+            if stored:
+                self.duplicates += 1
+                self._touch(digest)
+        if not stored:
+            self._write(self._path(digest), body)
+            with self.lock:
+                if digest not in self.objects:
+                    self.objects[digest] = len(body)
+                    self.bytes += len(body)
+                self._evict()
+        return digest
+
+    def term_file(self, digest, version):
+        """ The terms extracted from a body by an extractor version.
+
+        Returns:
+            Tuple (keyword_hash, term_ids), or None.
+        """
+        try:
+            with open(self._path(digest) + ".terms", "rb") as terms:
+                header, ids = terms.read().decode("ascii").split(u"\n", 1)
+            stored_version, keyword_hash = header.split()
+            term_ids = [int(term_id) for term_id in ids.split()]
+        except (IOError, OSError, ValueError):
+            return None
+        if stored_version != str(version):
+            return None
+        return keyword_hash, term_ids
+
+    def set_term_file(self, digest, keyword_hash, term_ids, version):
+        with self.lock:
+            if digest not in self.objects:
+                return
+        self._write(self._path(digest) + ".terms",
+                    u"{0} {1}\n{2}".format(version, keyword_hash,
+                                           u" ".join(str(term_id) for term_id in term_ids)
+                                           ).encode("ascii"))
+
+    def _touch(self, digest):
+        if digest in self.objects:
+            self.objects[digest] = self.objects.pop(digest)
+            # Keep the order across restarts
+            try:
+                utime(self._path(digest), None)
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and len(self.objects) > 1:
+            digest, size = self.objects.popitem(last=False)
+            self.bytes -= size
+            for file_path in [self._path(digest), self._path(digest) + ".terms"]:
+                if path.exists(file_path):
+                    remove(file_path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"pages": len(self.objects),
+                "bytes": self.bytes,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+                "duplicates": self.duplicates}
@@ -14,27 +14,53 @@
 # FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
 
 from collections import namedtuple
-from datetime import date, datetime
+from datetime import date
 import feedparser
 import md5
-from os import environ, path
+from os import environ
+import time
 from urlparse import urlparse
-from bs4 import BeautifulSoup, Comment
+from bs4 import UnicodeDammit
+import lxml.etree
+import lxml.html
 import re
 from uuid import uuid4
-import codecs
 from polyglot.text import Text
 
 from twisted.application import service
-from twisted.enterprise import adbapi
-from twisted.internet import task, protocol
-from twisted.internet.defer import inlineCallbacks
-from twisted.web.client import getPage
+from twisted.internet import task, protocol, threads
+from twisted.internet.defer import (CancelledError, DeferredList, DeferredSemaphore,
+                                    inlineCallbacks, returnValue)
+from twisted.python.failure import Failure
+
+from db import TimedConnectionPool
+from fetch import (HTML_TYPES, SNIFF_BYTES, Page, PageFetcher, PageTooLarge,
+                   UnwantedContent, sniff)
+from language import resources
+from memo import TermMemo, fingerprint
+from metrics import metrics
+from ner import chunk_entities
+from pagestore import PageStore
+from pool import MicroBatcher, ProcessPool
+from sites import sites
+from termcache import TermDictionary
+from termstore import TermStore
+from trends import TermTrends
+
+# Matches the special characters stripped from every token
+UNICODE_NON_WORDS = re.compile('\W+', re.UNICODE)
+
+# The <?xml ... ?> declaration some XHTML pages start with
+XML_DECLARATION = re.compile(r"^\s*<\?xml[^>]*>")
+
+# Bump when text or term extraction changes, so the page store does not
+# hand out the terms an older version extracted from a stored page
+EXTRACTOR_VERSION = 1
 
 
 class ParserService(service.Service):
 
-    def __init__(self, feed_db, interval=30):
+    def __init__(self, feed_db, interval=30, preload=(), queue=None):
         """
         Args:
         feed (named_tuple):
@@ -45,19 +71,26 @@ class ParserService(service.Service):
             host: The host where the database can be reached
             port: The port used to access the database
         interval (int): Number of minutes between feed queries (rounded to nearest minute).
+        preload (list): Language codes whose tokenizers, stop words and NER
+                        models are loaded before the first entry is parsed.
+        queue (EntryQueue): Queue new entries are taken from as the collector
+                            stores them. The database is still polled every
+                            interval for anything the queue did not carry.
         """
         self.interval = int(interval / 60)
         if self.interval <= 60:
             self.interval = 60
-        self.dbpool = adbapi.ConnectionPool(feed_db.dbmodule,
-                                            host = feed_db.host,
-                                            port = feed_db.port,
-                                            database = feed_db.name,
-                                            user = feed_db.user,
-                                            password = feed_db.password,
-                                            cp_noisy = True)
+        self.dbpool = TimedConnectionPool(feed_db.dbmodule,
+                                          host = feed_db.host,
+                                          port = feed_db.port,
+                                          database = feed_db.name,
+                                          user = feed_db.user,
+                                          password = feed_db.password,
+                                          cp_noisy = True)
         # Create a feed collector
-        self.entry_parser = EntryParser(self.dbpool)
+        self.entry_parser = EntryParser(self.dbpool, preload=preload)
+        if queue is not None:
+            self.entry_parser.consume(queue)
         # Every [interval] run the collector
         self.call = task.LoopingCall(self.startService).start(self.interval)
 
@@ -69,119 +102,404 @@ class ParserService(service.Service):
         # stop the reactor.call
         if self.call:
             self.call.cancel()
+        return self.entry_parser.stop()
 
 
-def get_netloc(url):
-    """ Creates an escaped netloc from a supplied URL.
+def extract_text(url, raw, near_duplicates=False, encoding=None, lang=None):
+    """ Extract the text and language of a downloaded page.
 
-    Netloc will be escaped by replacing periods with underscores and
-    downcaseing the string.
+    This and extract_terms run in the worker processes of an EntryParser's
+    pool, so they only take and return picklable values.
 
     Args:
-        url (str): A URL that follows the general URL pattern.
-                   e.g. "scheme://netloc/path;parameters?query#fragment".
+        encoding (str): The page's charset if already known (see fetch.sniff).
+        lang (str): The language used when the extractor finds none.
 
+    Returns:
+        Tuple (text, lang, fingerprint) where fingerprint keys the text in
+        a TermMemo.
     """
-    parsed = urlparse(url)
-    raw_netloc = ""
-    # If url does not have a scheme specified XXX://
-    # then parse the netloc out of the path
-    # https://docs.python.org/3.0/library/urllib.parse.html#urllib.parse.urlparse
-    if parsed.netloc != "":
-        raw_netloc = parsed.netloc
-    else:
-        raw_netloc = parsed.path.split("/")[0]
-
-
-    if raw_netloc == "":
-        raise ValueError("{0} is not parsable.".format(url) +
-                         "Please provide a url that follows the format " +
-                         "scheme://netloc/path")
-    raw_netloc = raw_netloc.replace(".", "_").lower()
-    return raw_netloc
+    with metrics.timer("extract.text"):
+        text_extractor = ExtractText(url, raw, encoding, lang)
+    text = text_extractor.text
+    return text, text_extractor.lang, fingerprint(text, near_duplicates)
+
+
+def extract_terms(jobs):
+    """ Extract the terms of a batch of pages' text.
+
+    Named entities are found for all of the texts in a language at once.
+
+    Args:
+        jobs (list): Tuples (text, lang), one per page.
+
+    Returns:
+        A list with a tuple (terms, seconds) per page, where seconds is the
+        page's share of the time the batch took, or the exception raised
+        while extracting that page.
+    """
+    start = time.time()
+    results = ExtractTerms.batch(jobs)
+    seconds = (time.time() - start) / max(len(jobs), 1)
+    return [result if isinstance(result, Exception) else (result.terms, seconds)
+            for result in results]
+
 
 class EntryParser(protocol.ClientFactory):
-    def __init__(self, dbconn):
+    def __init__(self, dbconn, workers=None, preload=(),
+                 hot_terms=50000,
+                 page_cache_bytes=1024 * 1024 * 1024, claim_size=100,
+                 lease=600, max_attempts=10, backoff=60, memo_size=1000,
+                 near_duplicate_bits=0, ner_batch_size=16, ner_batch_delay=0.5,
+                 max_page_bytes=2 * 1024 * 1024, term_flush_interval=3600):
+        """
+        Args:
+        dbconn (adbapi.ConnectionPool): Pool used for all entry and term queries.
+        workers (int): Number of extraction processes (defaults to the number of cores).
+        preload (list): Language codes to load resources for at startup.
+        hot_terms (int): Number of recently used terms the term dictionary keeps in an LRU.
+        page_cache_bytes (int): Size of the downloaded page store (see RKC_PAGE_PATH).
+        claim_size (int): Number of unparsed entries claimed at a time.
+        lease (int): Seconds a claimed entry is reserved for this parser.
+        max_attempts (int): Number of times an entry is tried before it is left alone.
+        backoff (int): Seconds before a failed entry is retried, doubled on every attempt.
+        memo_size (int): Number of recently extracted articles whose terms are reused
+                         when the same text turns up again.
+        near_duplicate_bits (int): Largest SimHash distance at which texts count as the
+                                   same article (0 only matches identical text).
+        ner_batch_size (int): Number of texts gathered for one term extraction job.
+        ner_batch_delay (float): Longest time in seconds a text waits for its batch to fill.
+        max_page_bytes (int): Largest page downloaded. Larger pages, and pages
+                              that are not HTML, are dropped without being
+                              read in full and are not retried.
+        term_flush_interval (float): Seconds between sealing the term records
+                                     added into a term store segment.
+        """
         self.dbpool = dbconn
+        self.claim_size = claim_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
         self.entries = {}
-        self.keyword_dir = environ['RKC_KEYWORD_PATH']
+        # Term occurrences of every article, kept in segments rather than
+        # a file per article
+        self.term_store = TermStore(environ['RKC_KEYWORD_PATH'])
+        self.term_store.start(term_flush_interval)
+        # Hourly article counts per term, for trend queries
+        self.trends = TermTrends(dbconn)
+        self.fetcher = PageFetcher(max_bytes=max_page_bytes, content_types=HTML_TYPES)
+        # Keep downloaded pages on disk when a page store path is configured
+        self.page_store = None
+        if environ.get('RKC_PAGE_PATH'):
+            self.page_store = PageStore(environ['RKC_PAGE_PATH'], page_cache_bytes)
+        # Terms are counted and remembered by their id in the terms table,
+        # only terms missing from the dictionary are sent to the database
+        self.term_ids = TermDictionary(dbconn, hot_terms)
+        self.warming = self.term_ids.warm()
+        self.warming.addCallbacks(self._warmed, self._warm_failed)
+        self.memo = TermMemo(memo_size, near_duplicate_bits)
+        # Workers are forked on first use, so anything preloaded here is
+        # inherited by every worker process.
+        resources.preload(preload)
+        self.pool = ProcessPool(workers)
+        # Texts are sent to term extraction in batches, which lets NER run
+        # on many articles at once
+        self.term_batcher = MicroBatcher(self.pool, extract_terms,
+                                         ner_batch_size, ner_batch_delay)
+        # Bound the number of entries between download and the database so
+        # downloaded pages do not pile up in memory while the pool is busy.
+        self.in_flight = DeferredSemaphore(self.pool.backlog * ner_batch_size)
+        metrics.gauge("parser.in_flight",
+                      lambda: self.in_flight.limit - self.in_flight.tokens)
+        metrics.gauge("parser.pool_pending", lambda: self.pool.pending)
+        metrics.gauge("parser.batch_waiting", lambda: len(self.term_batcher.items))
+        metrics.gauge("parser.fetch_in_flight", lambda: self.fetcher.in_flight)
+        # The wait for queued entries, while consuming an EntryQueue
+        self.queue_wait = None
 
 
     def parse(self, feed):
         pass
 
+    def stop(self):
+        """ Stop consuming and shut the worker pool down.
+
+        Returns:
+            A Deferred that fires once the term counts are written and the
+            term store is sealed.
+        """
+        if self.queue_wait is not None:
+            self.queue_wait.cancel()
+        self.pool.stop()
+        stopped = self.trends.flush()
+        stopped.addCallback(lambda _: self.term_store.close())
+        return stopped
+
+    @staticmethod
+    def _warmed(loaded):
+        print(u"Loaded {0} known terms".format(loaded))
+
+    @staticmethod
+    def _warm_failed(failure):
+        print(u"Could not load known terms: {0}".format(failure.getErrorMessage()))
+
     @inlineCallbacks
     def run(self):
-        entries = yield self.get_unparsed_entries()
-        for item in entries:
-            entry = namedtuple("entry", ["page", "url", "lang"])
-            entry.url = item[0]
-            # Download the entries url
-            entry.page = yield getPage(entry.url)
+        # Start with a warm term cache so known terms are not re-sent
+        yield self.warming
+        # Work through the backlog a claimed batch at a time. Other parsers
+        # (or an overlapping run) claim different entries.
+        while True:
+            entries = yield self.claim_entries()
+            if not entries:
+                break
+            parsing = [self.in_flight.run(self.parse_entry, *item)
+                       for item in entries]
+            yield DeferredList(parsing, consumeErrors=True)
+        print(u"Term dictionary: {terms} terms, {hot_terms} hot, {packed_bytes} bytes packed, "
+              u"{hit_rate:.1%} hits, {learned} ids fetched, {evicted} evicted".format(**self.term_ids.stats()))
+        print(u"Term extraction: {0} batches of {1:.1f} texts on average".format(
+            self.term_batcher.batches, self.term_batcher.mean_size))
+        print(u"Term memo: {articles} articles, {hit_rate:.1%} hits, "
+              u"{near_hits} near duplicates, {seconds_saved:.1f}s of term "
+              u"extraction saved".format(**self.memo.stats()))
+        if self.page_store is not None:
+            print(u"Page store: {pages} pages, {bytes} bytes, {hit_rate:.1%} hits, "
+                  u"{duplicates} duplicate bodies".format(**self.page_store.stats()))
+        yield self.trends.flush()
+        # Term records are sealed into segments by the term store's timer,
+        # once a segment is full and on stop(), not after every run
+        print(u"Term store: {records} records in {segments} segments, "
+              u"{pending} not sealed yet".format(**self.term_store.stats()))
 
-            # Run text extraction
-            text_extractor = ExtractText(entry.url, entry.page)
-            page_text = text_extractor.text
-            entry.lang = text_extractor.lang
+    @inlineCallbacks
+    def consume(self, queue):
+        """ Parse entries as they are offered to an EntryQueue, until stop().
 
-            # Get terms from text
-            terms = ExtractTerms(page_text, entry.lang).terms
-            UUID = uuid4().hex
+        Queued entries are claimed like the ones run() finds, so each is
+        parsed once whichever way it is found first.
+        """
+        yield self.warming
+        # Never wait for more slots than there are
+        take = min(self.claim_size, self.in_flight.limit)
+        while True:
+            self.queue_wait = queue.get(take)
+            try:
+                queued = yield self.queue_wait
+            except CancelledError:
+                break
+            finally:
+                self.queue_wait = None
+            offered = dict(queued)
+            # Wait for room before claiming, so a busy parser lets the queue
+            # fill up and the overflow wait for a poll, and the leases of
+            # claimed entries do not run out while they wait
+            for _ in offered:
+                yield self.in_flight.acquire()
+            try:
+                claimed = yield self.claim_urls(list(offered))
+            except Exception as err:
+                # Left for the next database poll
+                print(u"Could not claim queued entries: {0}".format(err))
+                claimed = []
+            # Entries parsed or claimed elsewhere meanwhile
+            for _ in range(len(offered) - len(claimed)):
+                self.in_flight.release()
+            for item in claimed:
+                parsing = self.parse_entry(*item)
+                parsing.addBoth(self._consumed, item[0], offered.get(item[0]))
+
+    def _consumed(self, result, url, offered):
+        self.in_flight.release()
+        if isinstance(result, Failure):
+            metrics.count("parser.failed")
+            print(u"Could not parse entry {0}: {1}".format(url, result.getErrorMessage()))
+        elif result is not False and offered is not None:
+            # From the collector storing the entry to its terms being stored
+            metrics.observe("pipeline.latency", time.time() - offered)
 
-            if terms != []:
-                # Write the keyword list to file
-                self.write_keyword_file(terms, UUID, entry.url)
+    @inlineCallbacks
+    def get_page(self, url, digest=None):
+        """ Read an entry's page from the page store or download it.
 
-                # Update Keywords
-                kdb = yield self.update_keywords(terms)
+        Args:
+        digest (str): The digest of the page last stored for the entry, if any.
 
-            # Update entries
-            edb = yield self.update_entry(entry.url, UUID)
+        Returns:
+            A Deferred that fires with a tuple (digest, page) where digest is
+            None when there is no page store.
+        """
+        if self.page_store is not None and digest is not None:
+            body = yield threads.deferToThread(self.page_store.get, digest)
+            if body is not None:
+                returnValue((digest, Page(url, 200, None, body,
+                                          *sniff(body[:SNIFF_BYTES]))))
+        page = yield self.fetcher.fetch(url)
+        digest = None
+        if self.page_store is not None:
+            digest = yield threads.deferToThread(self.page_store.put, page.body)
+        returnValue((digest, page))
 
+    @inlineCallbacks
+    def parse_entry(self, url, digest=None):
+        """ Download, extract and store the terms of a single entry.
+
+        Args:
+        digest (str): The digest of the page last stored for the entry, if any.
+
+        Returns:
+            A Deferred that fires with False if the entry was released to be
+            retried later or dropped.
+        """
+        entry = namedtuple("entry", ["page", "url", "lang"])
+        entry.url = url
+        try:
+            # Download the entries url
+            digest, entry.page = yield self.get_page(entry.url, digest)
+
+            # Identical pages (e.g. syndicated under another url) share the
+            # keyword hash of the first copy extracted, and are counted in
+            # the term trends like the copies the memo catches
+            if digest is not None:
+                extracted = yield threads.deferToThread(self.page_store.term_file,
+                                                        digest, EXTRACTOR_VERSION)
+                if extracted is not None:
+                    metrics.count("parser.page_store_hits")
+                    yield self.update_entry(entry.url, extracted[0], digest)
+                    self.trends.add(extracted[1])
+                    return
+
+            # Run text extraction in the worker pool
+            text, entry.lang, key = yield self.pool.submit(
+                extract_text, entry.url, entry.page.body, self.memo.near_duplicates,
+                entry.page.encoding, entry.page.lang)
+
+            # Wire stories carried by many feeds share the keyword hash of
+            # the first copy instead of being run through NER again, but
+            # are still counted in the term trends
+            memoized = self.memo.get(key)
+            if memoized is not None:
+                metrics.count("parser.memo_hits")
+                yield self.update_entry(entry.url, memoized[0], digest)
+                self.trends.add(memoized[1])
+                return
+
+            # Run term extraction in the worker pool
+            terms, seconds = yield self.term_batcher.add((text, entry.lang))
+
+            # Store any new terms and look up the ids of all of them
+            term_ids = yield self.update_keywords(terms)
+
+            UUID = uuid4().hex
+            if terms != []:
+                # Record the article's terms in the term store (the term to
+                # articles index) and the hourly term counts. The entry is
+                # only marked scraped once its records are on disk.
+                yield self.term_store.add(UUID, term_ids, entry.lang)
+                self.trends.add(term_ids)
+        except (PageTooLarge, UnwantedContent) as err:
+            metrics.count("parser.dropped")
+            print(u"Dropped entry {0}: {1}".format(entry.url, err))
+            yield self.drop_entry(entry.url)
+            returnValue(False)
+        except Exception as err:
+            metrics.count("parser.failed")
+            print(u"Could not parse entry {0}: {1}".format(entry.url, err))
+            yield self.release_entry(entry.url, digest)
+            returnValue(False)
+        # Update entries
+        edb = yield self.update_entry(entry.url, UUID, digest)
+        metrics.count("parser.entries")
+        if digest is not None:
+            yield threads.deferToThread(self.page_store.set_term_file,
+                                        digest, UUID, term_ids, EXTRACTOR_VERSION)
+        self.memo.put(key, UUID, term_ids, seconds)
 
-    def write_keyword_file(self, keywords, keyword_hash, url):
-        keyword_path = path.join(self.keyword_dir, keyword_hash)
-        with codecs.open(keyword_path, mode="w+", encoding="utf-8") as keyword_file:
-            keyword_file.write(u"# " + url + u"\n\n")
-            keyword_file.write(u"# " + str(datetime.now()) + u"\n")
-            for keyword in keywords:
-                keyword_file.write(keyword + u"\n")
 
     def update_keywords(self, keywords):
-        """Update entry with id & location of scraped keywords."""
-        insert_string = "INSERT INTO terms "
-        value_string = "(term, censored) VALUES "
-        term_string = ""
-        conflict_string = " ON CONFLICT (term) DO NOTHING"
-        _first = True
-        for keyword in keywords:
-            if _first:
-                # Double up single quotes to excape in sql
-                term_string += "('%s', false)" % keyword.replace("'","''")
-                _first = False
-            else:
-                #print(keyword)
-                term_string += ", ('%s', false)" % keyword.replace("'","''")
-
-        sql_statement = insert_string + value_string + term_string + conflict_string
-
-        #print(sql_statement)
-
-        db = self.dbpool.runOperation(sql_statement)
-        return db
+        """ Add any new keywords to the terms table.
 
-    def update_entry(self, url, keyword_hash):
-        """Update entry with id & location of scraped keywords."""
+        Returns:
+            A Deferred that fires with the ids of the keywords.
+        """
+        return self.term_ids.ids(keywords)
+
+    def update_entry(self, url, keyword_hash, digest=None):
+        """Update entry with id & location of scraped keywords and the digest of its page."""
         db = self.dbpool.runOperation("UPDATE entries "
                                       "SET term_file = %s, "
-                                      "scraped = true "
+                                      "page_digest = %s, "
+                                      "scraped = true, "
+                                      "claimed_until = NULL "
                                       "WHERE url = %s",
-                                      (keyword_hash, url))
+                                      (keyword_hash, digest, url))
         return db
 
-    def get_unparsed_entries(self):
-        return self.dbpool.runQuery("SELECT url FROM entries "
-                                    "WHERE scraped = false")
+    def claim_entries(self):
+        """ Claim a batch of unparsed entries for this parser.
+
+        Claimed entries are leased until parsed, released or the lease runs
+        out. Rows locked by a concurrent claim are skipped rather than waited
+        on, so any number of parsers can share the backlog.
+
+        Returns:
+            A Deferred that fires with a list of (url, page_digest) rows.
+        """
+        return self.dbpool.runQuery("UPDATE entries "
+                                    "SET claimed_until = now() + %s * interval '1 second', "
+                                    "attempts = attempts + 1 "
+                                    "WHERE url IN ("
+                                    "SELECT url FROM entries "
+                                    "WHERE scraped = false "
+                                    "AND (claimed_until IS NULL OR claimed_until < now()) "
+                                    "AND (retry_after IS NULL OR retry_after <= now()) "
+                                    "AND attempts < %s "
+                                    "LIMIT %s "
+                                    "FOR UPDATE SKIP LOCKED) "
+                                    "RETURNING url, page_digest",
+                                    (self.lease, self.max_attempts, self.claim_size))
+
+    def claim_urls(self, urls):
+        """ Claim the given entries, skipping any parsed or claimed already.
+
+        Returns:
+            A Deferred that fires with a list of (url, page_digest) rows.
+        """
+        return self.dbpool.runQuery("UPDATE entries "
+                                    "SET claimed_until = now() + %s * interval '1 second', "
+                                    "attempts = attempts + 1 "
+                                    "WHERE url IN ("
+                                    "SELECT url FROM entries "
+                                    "WHERE url = ANY(%s) "
+                                    "AND scraped = false "
+                                    "AND (claimed_until IS NULL OR claimed_until < now()) "
+                                    "FOR UPDATE SKIP LOCKED) "
+                                    "RETURNING url, page_digest",
+                                    (self.lease, list(urls)))
+
+    def release_entry(self, url, digest=None):
+        """ Give up a claimed entry and back off before it is retried.
+
+        The digest of the entry's page, if it was downloaded, is kept so the
+        retry reads it from the page store.
+        """
+        db = self.dbpool.runOperation("UPDATE entries "
+                                      "SET claimed_until = NULL, "
+                                      "page_digest = COALESCE(%s, page_digest), "
+                                      "retry_after = now() + %s * power(2, attempts - 1) "
+                                      "* interval '1 second' "
+                                      "WHERE url = %s",
+                                      (digest, self.backoff, url))
+        return db
+
+    def drop_entry(self, url):
+        """Give up a claimed entry for good, it is not claimed again."""
+        db = self.dbpool.runOperation("UPDATE entries "
+                                      "SET claimed_until = NULL, "
+                                      "attempts = %s "
+                                      "WHERE url = %s",
+                                      (self.max_attempts, url))
+        return db
 
     def update_feed(self, page, url):
         feed = feedparser.parse(page)
@@ -240,127 +558,205 @@ class EntryParser(protocol.ClientFactory):
 
 
 
+def parse_html(raw, encoding=None):
+    """ Parse a downloaded page into an lxml tree.
+
+    The page is decoded before lxml sees it, so a wrong or unknown charset
+    cannot make the parse fail.
+
+    Args:
+        encoding (str): The page's declared charset (see fetch.sniff). It is
+                        tried first, and the charset is guessed from the
+                        whole page when it is None, unknown, or the page
+                        does not decode with it.
+    """
+    dammit = UnicodeDammit(raw, [encoding] if encoding else [], is_html=True)
+    # lxml refuses text with an XML encoding declaration
+    text = XML_DECLARATION.sub(u"", dammit.unicode_markup, count=1)
+    return lxml.html.document_fromstring(text)
+
+
+def page_text(html_obj):
+    """ Yield the text nodes of a tree in document order.
+
+    The text inside comments, processing instructions, scripts and styles is
+    left out, but the text following them (their tail) is kept as a node of
+    its own rather than being joined onto the text before them.
+    """
+    events = ("start", "end", "comment", "pi")
+    for event, element in lxml.etree.iterwalk(html_obj, events=events):
+        if event == "start":
+            if element.text and element.tag not in ("script", "style"):
+                yield element.text
+        # Comments and processing instructions only get one event
+        elif element.tail and element is not html_obj:
+            yield element.tail
+
+
+def primary_language(lang):
+    """The primary subtag of a language tag, e.g. "en" for "en-GB"."""
+    if not lang:
+        return None
+    return lang.strip().split("-")[0].split("_")[0].lower() or None
+
+
 class ExtractText(object):
 
-    def __init__(self, url, raw):
+    def __init__(self, url, raw, encoding=None, lang=None):
+        """
+        Args:
+        url (str): The page's url, which picks the site extractor.
+        raw (str): The page as downloaded.
+        encoding (str): The page's charset, if already known.
+        lang (str): The language used when the page does not declare one.
+        """
         self.url = url
         self.raw = raw
+        self.encoding = encoding
         results = self.extract()
         self.text = results[0]
         self.title = results[1]
-        self.lang = results[2]
+        self.lang = primary_language(results[2] or lang)
 
     def extract(self):
         """ Extracts the raw text from a URL using the appropriate extractor.
 
-        This function retreives a website text extractor function of this
-        object that corresponds to the following pattern where NETLOC
-        corresponds to the escaped netloc of a url.
-            def extractor_NETLOC(self, url):
+        Pages from a host in the site registry (see sites.py) are read with
+        that site's selectors, any other page with the generic extractor.
 
         Returns:
-            Tuple containing two string objects: (text, title).
+            Tuple containing three objects: (text, title, lang).
             Where:
                 text (str) The raw text of the page.
                 title (str) An appropriate title for the pages content.
+                lang (str) The page's language code, or None.
         """
-        netloc = get_netloc(self.url)
-        #print("Attempting to retreive extractor for {0}".format(netloc))
-        extractor = getattr(self, 'extractor_%s' % (netloc,), None)
+        site = sites.get(urlparse(self.url).hostname)
+        if site is None: # no such site extractor
+            return self.extractor_generic(self.raw, self.encoding)
+        return site.extract(parse_html(self.raw, self.encoding))
 
-        if extractor is None: # no such domain extractor
-            text, title, lang = self.extractor_generic(self.raw)
-            return (text, title, lang)
-        else:
-            text, title, lang = extractor(self.raw)
-            return (text, title, lang)
-
-    def extractor_generic(self, raw):
+    def extractor_generic(self, raw, encoding=None):
         """ Generic website text extractor for unknown and undefined websites.
 
+        The page is parsed once with lxml. The text of comments, scripts and
+        styles is skipped, while the text that follows them stays a separate
+        text node, and every text node is split into stripped lines. This
+        gives the same lines as printing the page with BeautifulSoup's
+        prettify() and reading the text back (see tests/test_extract_text.py).
+
         Returns:
             Two string objects: text, title
             Where:
                 text (str) The raw text of the page.
                 title (str) An appropriate title for the pages content.
         """
-        html_obj = BeautifulSoup(raw, 'lxml')
-        html_title = html_obj.title.string.strip()
-        html_lang = html_obj.html['lang']
-        # Remove all comment elements
-        comments = html_obj.findAll(text=lambda text:isinstance(text, Comment))
-        [comment.extract() for comment in comments]
-        #print(html_obj)
-
-        # print and reparse html or we get an error for some reason
-        html_obj = BeautifulSoup(html_obj.prettify(), 'lxml')
-
-        # remove all script and style elements
-        for unwanted in html_obj(["script", "style"]):
-            unwanted.extract()
-
-        # print and reparse html or we get an error for some reason
-        html_obj = BeautifulSoup(html_obj.prettify(), 'lxml')
-
-        # get the text
-        text = html_obj.get_text()
-
-        # break into lines and remove leading and trailing space on each
-        lines = (line.strip() for line in text.splitlines())
-        # break multi-headlines into a line each
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        # drop blank lines
-        text = '\n'.join(chunk for chunk in chunks if chunk)
-        return text, html_obj.title.string, html_lang
+        html_obj = parse_html(raw, encoding)
+        # Pages without a <title> or lang get an empty title and no language
+        html_title = (html_obj.findtext(".//title") or u"").strip()
+        html_lang = html_obj.get('lang')
+
+        # prettify() leaves preformatted text as a single text node
+        for preformatted in html_obj.xpath("//pre | //textarea"):
+            preformatted.text = preformatted.text_content()
+            del preformatted[:]
+
+        lines = []
+        for text in page_text(html_obj):
+            # break into lines and multi-headlines into a line each
+            for line in text.splitlines():
+                for phrase in line.strip().split("  "):
+                    phrase = phrase.strip()
+                    # drop blank lines
+                    if phrase:
+                        lines.append(phrase)
+        text = '\n'.join(lines)
+        return text, html_title, html_lang
+
+
+def normalize_tokens(tokens, stop_words=frozenset(), min_length=2):
+    """ Turn tokens into unique, lowercase keywords.
+
+    Every token is lowercased and stripped of special characters as it is
+    read, straight into a set, so no per-token intermediate lists are built.
 
+    Args:
+    tokens (iterable): Tokens produced by a word tokenizer.
+    stop_words (frozenset): Lowercase words to leave out of the keywords.
+    min_length (int): Shortest keyword kept.
 
-    def extractor_www_bbc_com(self, raw):
-        """ Text extractor for BBC news articles.
+    Returns:
+        A list of keywords.
+    """
+    strip = UNICODE_NON_WORDS.sub
+    words = {strip(u'', token.lower()) for token in tokens}
+    return [word for word in words - stop_words if len(word) >= min_length]
 
-        Returns:
-            Two string objects: text, title
-            Where:
-                text (str) The raw text of the page.
-                title (str) An appropriate title for the pages content.
-        """
-        html_obj = BeautifulSoup(raw, 'lxml')
-        try:
-            story_title = html_obj.find("h1", class_="story-body__h1").get_text()
-        except AttributeError:
-            story_title = html_obj.find("title").get_text()
-        html_lang = html_obj.html['lang']
-        article_contents = []
-        try:
-            for section in html_obj.find("div", "story-body__inner").descendants:
-                if section.name == "p":
-                    article_contents.append(section.get_text())
-            if article_contents != []:
-                article_text = "\n".join(article_contents)
-            else:
-                raise ValueError("No body text found in article.")
-        except (AttributeError, ValueError):
-            article_text = ""
-            print(u"No body text found in article {0}".format(story_title))
-
-        return article_text, story_title, html_lang
 
 class ExtractTerms(object):
 
-    def __init__(self, raw, language="english", remove_stopwords=False):
+    def __init__(self, raw, language="english", remove_stopwords=False,
+                 entities=None):
         """
 
         Args:
 
         language (str): What language should the keyword extractor treat the keywords as? [Each language used requires it's own
         without_stopwords (bool): Should the keyword extractor remove stop words from the keywords that it identifies? (True, False)
+        entities (list): Named entities already found in raw (see batch), NER is not run again.
 
         """
         self.raw = raw
         self.language = str(language)
         self.remove_stopwords = remove_stopwords
+        self.found_entities = entities
         self.keywords, self.entities = None, None
         self.extract()
 
+    @classmethod
+    def batch(cls, jobs):
+        """ Extract the terms of many texts, running NER on each language's
+        texts at once.
+
+        Args:
+        jobs (list): Tuples (raw, language).
+
+        Returns:
+            A list with an ExtractTerms per job, or the exception raised
+            while extracting that job.
+        """
+        by_language = {}
+        for index, (raw, language) in enumerate(jobs):
+            by_language.setdefault(cls.ner_language(language), []).append(index)
+        entities = [None] * len(jobs)
+        for language, indexes in by_language.items():
+            # Without a known language polyglot has to detect it per text
+            if language is None:
+                continue
+            try:
+                found = cls.get_entities_batch([jobs[i][0] for i in indexes],
+                                               language)
+            except Exception as err:
+                print(u"Batched NER failed for {0}: {1}".format(language, err))
+                continue
+            for index, text_entities in zip(indexes, found):
+                entities[index] = text_entities
+        results = []
+        for (raw, language), text_entities in zip(jobs, entities):
+            try:
+                results.append(cls(raw, language, entities=text_entities))
+            except Exception as err:
+                results.append(err)
+        return results
+
+    @classmethod
+    def ner_language(cls, language):
+        """The language code NER runs with for a language, or None to detect it."""
+        language = str(language)
+        if language != "generic" and hasattr(cls, 'extractor_%s' % (language,)):
+            return language
+        return None
+
     def extract(self):
         #print("Attempting to retreive {0} language keyword extractor".format(self.language))
         extractor = getattr(self, 'extractor_%s' % (self.language,), None)
@@ -378,37 +774,10 @@ class ExtractTerms(object):
         return self.keywords + self.entities
 
     def extractor_generic(self, raw):
-        from nltk import word_tokenize
-        # Keywords
-        tokens = word_tokenize(raw)
-        lowered = [x.lower() for x in tokens]
-        # Remove any special characters
-        unicode_non_words = re.compile('\W+', re.UNICODE)
-        plain = [re.sub(unicode_non_words, '', x) for x in lowered]
-        unique_words = set(plain)
-        no_blanks = [x for x in unique_words if len(x) > 1]
-        entities = self.get_entities(raw)
-        return no_blanks, entities
+        return self.extract_with(raw)
 
     def extractor_en(self, raw):
-        from nltk import word_tokenize
-        from nltk.corpus import stopwords
-
-        tokens = word_tokenize(raw)
-        lowered = [x.lower() for x in tokens]
-        # Remove any special characters
-        unicode_non_words = re.compile('\W+', re.UNICODE)
-        plain = [re.sub(unicode_non_words, '', x) for x in lowered]
-        unique_words = set(plain)
-
-        if self.remove_stopwords == True:
-            stop_words = stopwords.words('english')
-            words_no_stop = [x for x in unique_words if x not in stop_words]
-            unique_words = words_no_stop
-
-        no_blanks = [x for x in unique_words if len(x) > 1]
-        entities = self.get_entities(raw)
-        return no_blanks, entities
+        return self.extract_with(raw, "en")
 
     def extractor_fa(self, raw):
         """
@@ -427,32 +796,67 @@ class ExtractTerms(object):
             Stop-Words I use for Persian:
                 https://github.com/kharazi/persian-stopwords.git
         """
-        from hazm import word_tokenize
-        from nltk.corpus import stopwords
-
-        tokens = word_tokenize(raw)
-        lowered = [x.lower() for x in tokens]
-        # Remove any special characters
-        unicode_non_words = re.compile('\W+', re.UNICODE)
-        plain = [re.sub(unicode_non_words, '', x) for x in lowered]
-        unique_words = set(plain)
+        return self.extract_with(raw, "fa")
 
-        if self.remove_stopwords == True:
-            stop_words = stopwords.words('persian')
-            words_no_stop = [x for x in unique_words if x not in stop_words]
-            unique_words = words_no_stop
+    def extract_with(self, raw, language=None):
+        """ Run the normalization pipeline with a language's resources.
 
-        no_blanks = [x for x in unique_words if len(x) > 1]
-        entities = self.get_entities(raw)
-        return no_blanks, entities
+        Args:
+        raw (str): Raw text to be split into keywords.
+        language (str): Language code whose tokenizer, stop words and NER
+                        model are used. None uses the generic tokenizer
+                        without stop words.
+        """
+        stop_words = frozenset()
+        if self.remove_stopwords == True and language is not None:
+            stop_words = resources.stopwords(language)
+        with metrics.timer("extract.tokenize"):
+            tokens = resources.tokenizer(language)(raw)
+        keywords = normalize_tokens(tokens, stop_words)
+        entities = self.found_entities
+        if entities is None:
+            entities = self.get_entities(raw, language=language)
+        return keywords, entities
 
     @classmethod
-    def get_entities(self, raw, min_text_length=50):
+    def get_entities(self, raw, min_text_length=50, language=None):
+        """ Named entities found in raw text.
+
+        Args:
+        language (str): Language code of the text. Known languages skip
+                        polyglot's language detection.
+        """
         if len(raw) < min_text_length:
             return []
 
-        text = Text(raw)
-        entities = []
-        for ent in text.entities:
-            entities.append(u" ".join(ent))
+        if language is not None:
+            # polyglot memoizes its taggers, so this is the same tagger the
+            # text will use; loading it through the registry keeps it warm.
+            resources.ner_tagger(language)
+        with metrics.timer("extract.ner"):
+            text = Text(raw, hint_language_code=language)
+            entities = []
+            for ent in text.entities:
+                entities.append(u" ".join(ent))
         return entities
+
+    @classmethod
+    def get_entities_batch(self, texts, language, min_text_length=50):
+        """ Named entities found in many texts of the same language.
+
+        Gives the same entities as get_entities on each text, but the NER
+        network is run on the words of all the texts at once.
+
+        Args:
+        texts (list): Raw texts.
+        language (str): Language code of every text.
+
+        Returns:
+            A list of entity lists, one per text.
+        """
+        tagger = resources.ner_batch_tagger(language)
+        with metrics.timer("extract.ner_batch"):
+            words = [list(Text(raw, hint_language_code=language).words)
+                     if len(raw) >= min_text_length else [] for raw in texts]
+            return [[u" ".join(entity) for entity in chunk_entities(text_words, tags)]
+                    for text_words, tags in zip(words, tagger.annotate(words))]
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+from collections import deque
+import time
+
+from twisted.internet.defer import Deferred
+
+from metrics import metrics
+
+
+class EntryQueue(object):
+    """ A bounded queue of new entry urls from the collector to the parser.
+
+    The collector offers every entry it stores and the parser takes them as
+    soon as it has room, instead of waiting for its next database poll. The
+    database stays the record of what is left to parse: an entry offered to
+    a full queue is dropped from the queue only, and is claimed by the
+    parser's next poll like any other unparsed entry. A parser that falls
+    behind stops taking entries, the queue fills up and the collector's
+    entries go back to waiting for a poll.
+    """
+
+    def __init__(self, size=1000):
+        """
+        Args:
+        size (int): Largest number of entries waiting in the queue.
+        """
+        self.size = size
+        # (url, time offered), oldest first
+        self.items = deque()
+        self.waiting = None
+        self.offered = 0
+        self.dropped = 0
+        metrics.gauge("pipeline.queued", lambda: len(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+    def offer(self, urls):
+        """ Queue entry urls, as many as there is room for.
+
+        Returns:
+            The number of urls queued.
+        """
+        now = time.time()
+        room = max(self.size - len(self.items), 0)
+        queued = list(urls)
+        dropped = len(queued[room:])
+        self.items.extend((url, now) for url in queued[:room])
+        self.offered += len(queued) - dropped
+        self.dropped += dropped
+        metrics.count("pipeline.offered", len(queued) - dropped)
+        if dropped:
+            metrics.count("pipeline.dropped", dropped)
+        if self.waiting is not None and self.items:
+            waiting, limit = self.waiting
+            self.waiting = None
+            waiting.callback(self._take(limit))
+        return len(queued) - dropped
+
+    def get(self, limit):
+        """ Take up to limit queued entries, waiting for one if the queue is empty.
+
+        Only one caller may wait at a time.
+
+        Returns:
+            A Deferred that fires with a list of (url, time offered) tuples.
+            Cancelling it stops the wait.
+        """
+        if self.waiting is not None:
+            raise RuntimeError("The entry queue already has a consumer waiting")
+        result = Deferred(self._cancel)
+        if self.items:
+            result.callback(self._take(limit))
+        else:
+            self.waiting = (result, limit)
+        return result
+
+    def _take(self, limit):
+        return [self.items.popleft() for _ in range(min(limit, len(self.items)))]
+
+    def _cancel(self, result):
+        if self.waiting is not None and self.waiting[0] is result:
+            self.waiting = None
+
+    def stats(self):
+        return {"queued": len(self.items),
+                "offered": self.offered,
+                "dropped": self.dropped}
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import process
+from multiprocessing import cpu_count
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.python.failure import Failure
+
+from metrics import metrics
+
+# Raised by Python 3's executor once a worker died, the futures backport
+# leaves the job waiting instead
+BrokenProcessPool = getattr(process, "BrokenProcessPool", None)
+
+
+class JobTimeout(Exception):
+    """A pool job did not finish in time, or was lost when its workers were replaced."""
+
+
+def _measured(func, *args):
+    # Drop anything inherited from the parent when the worker was forked,
+    # then send back what this job recorded.
+    metrics.drain()
+    result = func(*args)
+    return result, metrics.drain()
+
+
+class ProcessPool(object):
+
+    def __init__(self, workers=None, backlog=None, timeout=300):
+        """
+        Args:
+        workers (int): Number of worker processes (defaults to the number of cores).
+        backlog (int): Maximum number of jobs queued or running at once
+                       (defaults to twice the number of workers).
+        timeout (float): Seconds from submission after which a job fails
+                         with JobTimeout. Its worker may be stuck or dead,
+                         so the worker processes are replaced.
+        """
+        self.workers = workers or cpu_count()
+        self.backlog = backlog or self.workers * 2
+        self.timeout = timeout
+        self.semaphore = DeferredSemaphore(self.backlog)
+        self.executor = ProcessPoolExecutor(self.workers)
+        # future -> (Deferred, timeout call, executor) of every running job
+        self.jobs = {}
+
+    @property
+    def pending(self):
+        return self.backlog - self.semaphore.tokens
+
+    def submit(self, func, *args):
+        """ Run func(*args) in a worker process.
+
+        Once backlog jobs are outstanding further calls wait for a free slot
+        before being handed to the pool. func, its arguments and its result
+        must all be picklable.
+
+        Returns:
+            A Deferred that fires in the reactor thread with func's result.
+        Metrics func records in the worker are added to the registry.
+        """
+        metrics.count("pool.jobs")
+        job = self.semaphore.run(self._submit, func, *args)
+        return metrics.time_deferred("pool.job", job)
+
+    def _submit(self, func, *args):
+        result = Deferred()
+        future = self.executor.submit(_measured, func, *args)
+        timer = reactor.callLater(self.timeout, self._timed_out, future)
+        self.jobs[future] = (result, timer, self.executor)
+        future.add_done_callback(
+            lambda done: reactor.callFromThread(self._finished, done))
+        return result
+
+    def _finished(self, future):
+        job = self.jobs.pop(future, None)
+        if job is None:
+            # Already failed by a timeout
+            return
+        result, timer, executor = job
+        if timer.active():
+            timer.cancel()
+        try:
+            value, measured = future.result()
+        except Exception as err:
+            metrics.count("pool.failed_jobs")
+            if BrokenProcessPool is not None and isinstance(err, BrokenProcessPool):
+                self._replace(executor)
+            result.errback(Failure(err))
+        else:
+            metrics.merge(measured)
+            result.callback(value)
+
+    def _timed_out(self, future):
+        job = self.jobs.pop(future, None)
+        if job is None:
+            return
+        result, _, executor = job
+        metrics.count("pool.timeouts")
+        print(u"Pool job ran longer than {0}s, replacing the worker processes".format(
+            self.timeout))
+        result.errback(Failure(JobTimeout(u"Job ran longer than {0}s".format(self.timeout))))
+        self._replace(executor)
+
+    def _replace(self, executor):
+        """Start new worker processes in place of an executor's and stop its own."""
+        if executor is not self.executor:
+            return
+        self.executor = ProcessPoolExecutor(self.workers)
+        metrics.count("pool.replaced")
+        # Jobs on the old workers are lost with them
+        for future, (result, timer, job_executor) in list(self.jobs.items()):
+            if job_executor is executor:
+                del self.jobs[future]
+                timer.cancel()
+                result.errback(Failure(JobTimeout(u"Lost when the worker processes were replaced")))
+        # A set in the futures backport, a dict by pid on Python 3
+        processes = executor._processes or ()
+        if isinstance(processes, dict):
+            processes = processes.values()
+        for worker in list(processes):
+            if worker.is_alive():
+                worker.terminate()
+        executor.shutdown(wait=False)
+
+    def stop(self):
+        for _, timer, _ in self.jobs.values():
+            if timer.active():
+                timer.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class MicroBatcher(object):
+    """ Gathers single jobs into batches run as one pool job.
+
+    A batch is submitted once it holds size items or delay seconds after its
+    first item arrived, whichever comes first.
+    """
+
+    def __init__(self, pool, func, size=16, delay=0.5):
+        """
+        Args:
+        pool (ProcessPool): Pool the batches are run in.
+        func (function): Takes a list of items and returns a list with one
+                         result per item, in the same order. An exception
+                         in place of a result fails only that item.
+        size (int): Largest number of items in a batch.
+        delay (float): Longest time in seconds an item waits for a batch to fill.
+        """
+        self.pool = pool
+        self.func = func
+        self.size = size
+        self.delay = delay
+        self.items = []
+        self.waiting = []
+        self.timer = None
+        self.batches = 0
+        self.batched = 0
+
+    def add(self, item):
+        """ Add an item to the next batch.
+
+        Returns:
+            A Deferred that fires with the item's result.
+        """
+        result = Deferred()
+        self.items.append(item)
+        self.waiting.append(result)
+        if len(self.items) >= self.size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = reactor.callLater(self.delay, self.flush)
+        return result
+
+    def flush(self):
+        """Submit the items gathered so far as a batch."""
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        if not self.items:
+            return
+        items, waiting = self.items, self.waiting
+        self.items, self.waiting = [], []
+        self.batches += 1
+        self.batched += len(items)
+        submitted = self.pool.submit(self.func, items)
+        submitted.addCallbacks(self._done, self._failed,
+                               callbackArgs=(waiting,), errbackArgs=(waiting,))
+
+    @staticmethod
+    def _done(results, waiting):
+        for result, value in zip(waiting, results):
+            if isinstance(value, Exception):
+                result.errback(Failure(value))
+            else:
+                result.callback(value)
+
+    @staticmethod
+    def _failed(failure, waiting):
+        for result in waiting:
+            result.errback(failure)
+
+    @property
+    def mean_size(self):
+        return float(self.batched) / self.batches if self.batches else 0.0
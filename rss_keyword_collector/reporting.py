@@ -13,9 +13,11 @@
 # ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
 # FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
 
-from os import environ, mkdir, path
+from os import chmod, close, environ, mkdir, path, remove, rename
 from datetime import datetime
 import codecs
+from shutil import copyfile
+from tempfile import mkstemp
 
 from twisted.application import service
 from twisted.enterprise import adbapi
@@ -24,10 +26,13 @@ from twisted.internet.defer import inlineCallbacks
 from twisted.web.client import getPage
 from twisted.python import log
 
+from db import TimedConnectionPool, fetch_chunks
+from metrics import metrics
+
 
 class ReportingService(service.Service):
 
-    def __init__(self, feed_db, interval=600):
+    def __init__(self, feed_db, interval=600, incremental=False):
         """
         Args:
         feed (named_tuple):
@@ -38,19 +43,20 @@ class ReportingService(service.Service):
             host: The host where the database can be reached
             port: The port used to access the database
         interval (int): Number of minutes between feed queries (rounded to nearest minute).
+        incremental (bool): Append new terms to the reports instead of rewriting them every time.
         """
         self.interval = int(interval / 60)
         if self.interval <= 60:
             self.interval = 60
-        self.dbpool = adbapi.ConnectionPool(feed_db.dbmodule,
-                                            host = feed_db.host,
-                                            port = feed_db.port,
-                                            database = feed_db.name,
-                                            user = feed_db.user,
-                                            password = feed_db.password,
-                                            cp_noisy = True)
+        self.dbpool = TimedConnectionPool(feed_db.dbmodule,
+                                          host = feed_db.host,
+                                          port = feed_db.port,
+                                          database = feed_db.name,
+                                          user = feed_db.user,
+                                          password = feed_db.password,
+                                          cp_noisy = True)
         # Create a feed collector
-        self.report_writer = ReporterWriter(self.dbpool)
+        self.report_writer = ReporterWriter(self.dbpool, incremental=incremental)
         # Every [interval] run the collector
         self.call = task.LoopingCall(self.startService).start(self.interval)
 
@@ -65,36 +71,102 @@ class ReportingService(service.Service):
 
 class ReporterWriter(protocol.ClientFactory):
 
-    def __init__(self, dbconn):
+    def __init__(self, dbconn, incremental=False, rebuild_every=24,
+                 chunk_size=10000):
+        """
+        Args:
+        dbconn (adbapi.ConnectionPool): Pool used to read the terms.
+        incremental (bool): Only append terms added since the last report
+                            instead of rewriting each report.
+        rebuild_every (int): In incremental mode, rewrite the reports in full
+                             every [rebuild_every] updates so that terms whose
+                             censored state changed are moved.
+        chunk_size (int): Number of terms read from the database at a time.
+        """
         self.dbpool = dbconn
+        self.incremental = incremental
+        self.rebuild_every = rebuild_every
+        self.chunk_size = chunk_size
+        # Highest term id written to each report
+        self.high_water = {}
+        self.updates = 0
         # Create output_dir if it does not exist
         self.output_dir = path.abspath(environ['RKC_REPORT_PATH'])
         if not path.exists(self.output_dir):
             mkdir(self.output_dir)
 
-    def _write_term_file(self, keywords, state):
-        if keywords == []:
-            return
+    def _write_term_file(self, txn, state):
+        """ Rewrite a report from a server side cursor.
+
+        The terms are streamed into a temporary file in the report directory
+        which then replaces the report, so readers never see a partial file.
+        """
+        self._replace_term_file(txn, state)
+
+    def _append_term_file(self, txn, state):
+        """ Append the terms added since the last report.
+
+        The report is copied into a temporary file, the new terms are added
+        to the copy and it then replaces the report, so a crash part way
+        through leaves the previous report and its high water mark in place.
+        """
+        self._replace_term_file(txn, state, append=True)
+
+    def _replace_term_file(self, txn, state, append=False):
         keyword_path = path.join(self.output_dir, "{0}.report".format(state))
-        with codecs.open(keyword_path, mode="w+", encoding="utf-8") as keyword_file:
-            keyword_file.write(u"# " + str(datetime.now()) + u"\n")
-            for keyword in keywords:
-                kw_newline = keyword[0].decode("utf-8") + u"\n"
+        after = 0
+        if append and path.exists(keyword_path):
+            after = self.high_water[state]
+        temp_fd, temp_path = mkstemp(dir=self.output_dir, prefix=state)
+        close(temp_fd)
+        try:
+            if after:
+                copyfile(keyword_path, temp_path)
+            with codecs.open(temp_path, mode="a", encoding="utf-8") as keyword_file:
+                keyword_file.write(u"# " + str(datetime.now()) + u"\n")
+                written, high_water = self._write_terms(txn, keyword_file, state, after)
+            if written == 0:
+                return
+            chmod(temp_path, 0o644)
+            rename(temp_path, keyword_path)
+            self.high_water[state] = high_water
+        finally:
+            if path.exists(temp_path):
+                remove(temp_path)
+
+    def _write_terms(self, txn, keyword_file, state, after):
+        """Write every term of a state with an id above after. Returns (count, highest id)."""
+        query = "SELECT id, term FROM terms WHERE {0} AND id > %s".format(
+            self._get_query(state))
+        written, high_water = 0, after
+        for keywords in fetch_chunks(txn, query, self.chunk_size, (after,)):
+            for term_id, keyword in keywords:
+                kw_newline = keyword.decode("utf-8") + u"\n"
                 keyword_file.write(kw_newline)
+                high_water = max(high_water, term_id)
+            written += len(keywords)
+        return written, high_water
 
     @inlineCallbacks
     def update_files(self):
+        self.updates += 1
+        rebuild = (not self.incremental or
+                   self.updates % self.rebuild_every == 0)
         for state in ["censored", "uncensored"]:
-            yield self.update(state)
+            yield self.update(state, rebuild)
 
-    def update(self, state):
-        terms = self._get_terms(state)
-        terms.addCallback(self._write_term_file, state=state)
+    def update(self, state, rebuild=True):
+        """ Bring a report up to date.
 
-    def _get_terms(self, state):
-        query = self._get_query(state)
-        qwhere = "WHERE {0}".format(query)
-        return self.dbpool.runQuery("SELECT term FROM terms {0}".format(qwhere))
+        Terms are only appended when the report has been written by this
+        process before. The high water mark can skip a term whose insert
+        committed after a later one, which the next rebuild picks up.
+        """
+        if rebuild or state not in self.high_water:
+            written = self.dbpool.runInteraction(self._write_term_file, state)
+        else:
+            written = self.dbpool.runInteraction(self._append_term_file, state)
+        return metrics.time_deferred("report.write", written)
 
     @staticmethod
     def _get_query(state):
@@ -103,7 +175,7 @@ class ReporterWriter(protocol.ClientFactory):
         try:
             return queries[state]
         except KeyError:
-            raise ValueError("{0} is not a valid query".format(query))
+            raise ValueError("{0} is not a valid query".format(state))
 
 
     def set_censored(self, term, state=True):
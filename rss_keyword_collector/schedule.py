@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+import heapq
+import random
+import time
+
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks
+
+from metrics import metrics
+
+
+class FeedState(object):
+    """How often a feed is polled and what polling it has found."""
+
+    def __init__(self, url, interval, validator=None):
+        self.url = url
+        self.interval = interval
+        self.validator = validator
+        self.due = 0
+        self.ttl = None
+        self.skip_hours = frozenset()
+        self.polls = 0
+        self.running = False
+
+
+class FeedScheduler(object):
+    """ Polls each feed when it is due rather than all feeds at once.
+
+    Feeds wait in a priority queue keyed by the time they are next due. After
+    every poll a feed's interval is adapted to how often it publishes:
+
+    * no new entries: the interval grows by backoff,
+    * one new entry: the interval is kept,
+    * n new entries: the interval is divided by n, aiming for about one
+      new entry per poll.
+
+    Intervals stay between min_interval (or the channel's ttl, if longer)
+    and max_interval, and a poll that falls in one of the channel's
+    skipHours is moved to the next hour that is not skipped.
+
+    With a ShardMembership only the feeds owned by this node are polled, and
+    the feed list is reloaded whenever the nodes sharing the feeds change.
+    """
+
+    def __init__(self, collector, min_interval=60, max_interval=12 * 60 * 60,
+                 backoff=1.5, tick=5, refresh=600, report_every=3600, shard=None):
+        """
+        Args:
+        collector (FeedCollector): Used to list and poll the feeds.
+        min_interval (int): Shortest time in seconds between polls of a feed.
+                            New feeds start at this interval.
+        max_interval (int): Longest time in seconds between polls of a feed.
+        backoff (float): Factor the interval grows by after a poll without new entries.
+        tick (int): Seconds between checks for due feeds.
+        refresh (int): Seconds between reloads of the feed list.
+        report_every (int): Seconds between printed summaries.
+        shard (ShardMembership): Decides which feeds this node polls (all of
+                                 them when None).
+        """
+        self.collector = collector
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.tick = tick
+        self.refresh = refresh
+        self.report_every = report_every
+        self.shard = shard
+        # The shard membership version the feed list was loaded for
+        self.shard_version = None
+        self.feeds = {}
+        # (due, url), entries whose due time no longer matches the feed's
+        # state are stale and skipped
+        self.queue = []
+        self.loop = None
+        self.last_refresh = None
+        self.reset_stats()
+        metrics.gauge("scheduler.feeds", lambda: len(self.feeds))
+        metrics.gauge("scheduler.polling", lambda: sum(
+            1 for state in self.feeds.values() if state.running))
+
+    def reset_stats(self):
+        self.started = time.time()
+        self.polls = 0
+        self.new_entries = 0
+        self.lags = []
+
+    def start(self):
+        if self.loop is None:
+            self.loop = task.LoopingCall(self.check)
+            self.loop.start(self.tick)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.loop = None
+
+    @inlineCallbacks
+    def check(self):
+        """Poll every feed that is due, reloading the feed list when it is old."""
+        now = time.time()
+        if (self.last_refresh is None or now - self.last_refresh >= self.refresh or
+                (self.shard is not None and self.shard.version != self.shard_version)):
+            self.last_refresh = now
+            try:
+                yield self.load_feeds()
+            except Exception as err:
+                print(u"Could not load the feed list: {0}".format(err))
+            now = time.time()
+        while self.queue and self.queue[0][0] <= now:
+            due, url = heapq.heappop(self.queue)
+            state = self.feeds.get(url)
+            if state is None or state.due != due or state.running:
+                continue
+            self.poll(state)
+        if now - self.started >= self.report_every:
+            self.report()
+
+    @inlineCallbacks
+    def load_feeds(self):
+        """Add new feeds to the queue and drop the ones that were removed."""
+        if self.shard is not None:
+            self.shard_version = self.shard.version
+        rows = yield self.collector.get_feed_list()
+        validators = yield self.collector.get_validators()
+        urls = set(row[0] for row in rows)
+        if self.shard is not None:
+            # Feeds moved to another node are dropped like removed feeds
+            urls = set(url for url in urls if self.shard.owns(url))
+        for url in set(self.feeds) - urls:
+            del self.feeds[url]
+        now = time.time()
+        for url in urls - set(self.feeds):
+            state = FeedState(url, self.min_interval, validators.get(url))
+            self.feeds[url] = state
+            # Spread the first polls out rather than fetching every feed at once
+            self.schedule(state, now + random.uniform(0, self.min_interval))
+
+    def schedule(self, state, due):
+        if state.skip_hours and len(state.skip_hours) < 24:
+            while time.gmtime(due).tm_hour in state.skip_hours:
+                due = due - due % 3600 + 3600
+        state.due = due
+        heapq.heappush(self.queue, (due, state.url))
+
+    @inlineCallbacks
+    def poll(self, state):
+        state.running = True
+        try:
+            poll = yield self.collector.collect(state.url, state.validator)
+        except Exception as err:
+            print(u"Could not poll feed {0}: {1}".format(state.url, err))
+            poll = None
+        state.running = False
+        self.polls += 1
+        metrics.count("scheduler.polls")
+        if poll is not None:
+            state.validator = poll.validator
+            if poll.outcome == "parsed":
+                state.ttl, state.skip_hours = poll.ttl, poll.skip_hours
+            # Entries found on a feed's first poll can be of any age
+            if state.polls:
+                self.lags.extend(poll.lags)
+            self.new_entries += poll.inserted
+        state.interval = self.next_interval(state, poll.inserted if poll else 0)
+        state.polls += 1
+        if state.url in self.feeds:
+            self.schedule(state, time.time() + state.interval)
+
+    def next_interval(self, state, inserted):
+        if inserted == 0:
+            interval = state.interval * self.backoff
+        else:
+            interval = float(state.interval) / inserted
+        shortest = self.min_interval
+        if state.ttl:
+            shortest = max(shortest, state.ttl * 60)
+        return min(max(interval, shortest), max(self.max_interval, shortest))
+
+    def stats(self):
+        """ Fetch volume and freshness since the last report.
+
+        fixed_polls is the number of polls the old fixed interval (every feed
+        every min_interval) would have made over the same time. lag is the
+        time between an entry's publication date and its discovery.
+        """
+        elapsed = max(time.time() - self.started, 1)
+        lags = sorted(self.lags)
+        return {"feeds": len(self.feeds),
+                "polls": self.polls,
+                "fixed_polls": int(len(self.feeds) * elapsed / self.min_interval),
+                "new_entries": self.new_entries,
+                "median_lag": lags[len(lags) // 2] if lags else 0.0,
+                "max_lag": lags[-1] if lags else 0.0,
+                "mean_interval": (sum(state.interval for state in self.feeds.values())
+                                  / len(self.feeds) if self.feeds else 0.0)}
+
+    def report(self):
+        print(u"Feed scheduler: {feeds} feeds, {polls} polls ({fixed_polls} at a "
+              u"fixed interval), {new_entries} new entries, {median_lag:.0f}s "
+              u"median and {max_lag:.0f}s max lag, {mean_interval:.0f}s mean "
+              u"interval".format(**self.stats()))
+        self.reset_stats()
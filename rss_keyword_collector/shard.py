@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+"""Share the feeds among several collector nodes.
+
+Run with the RKC_DB_* settings to see how the feeds are currently shared:
+
+    python rss_keyword_collector/shard.py
+"""
+
+import argparse
+from bisect import bisect
+from collections import Counter
+import hashlib
+from os import environ
+import struct
+import sys
+
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, succeed
+
+from metrics import metrics
+
+
+def _hash(key):
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+
+class HashRing(object):
+    """ Consistent hashing of feed urls onto collector nodes.
+
+    Every node is placed on the ring at replicas points and a url belongs
+    to the node at the first point after the url's hash. When a node joins
+    or leaves only the urls next to its points move, about 1/n of them.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        """
+        Args:
+        nodes (list): Names of the nodes sharing the urls.
+        replicas (int): Points per node. More points spread the urls more evenly.
+        """
+        self.nodes = frozenset(nodes)
+        points = sorted((_hash(u"{0}#{1}".format(node, i)), node)
+                        for node in self.nodes for i in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    def owner(self, key):
+        """The node a key belongs to, or None when there are no nodes."""
+        if not self.hashes:
+            return None
+        return self.owners[bisect(self.hashes, _hash(key)) % len(self.hashes)]
+
+
+class ShardMembership(object):
+    """ The collector nodes sharing the feeds, kept in the collector_nodes table.
+
+    Each node stores a heartbeat every heartbeat seconds and reads back the
+    nodes seen within expiry seconds. A node that stops beating (or leaves
+    with stop()) drops out and its feeds are shared among the others, a new
+    node takes its share as soon as the others see it. version goes up on
+    every change so users of owns() know to look again.
+    """
+
+    def __init__(self, dbconn, node, heartbeat=15, expiry=60, replicas=100):
+        """
+        Args:
+        dbconn (adbapi.ConnectionPool): Pool holding the collector_nodes table.
+        node (str): This node's name, kept across restarts so it gets the
+                    same feeds back.
+        heartbeat (int): Seconds between heartbeats.
+        expiry (int): Seconds without a heartbeat before a node is dropped.
+        replicas (int): Ring points per node.
+        """
+        self.dbpool = dbconn
+        self.node = node
+        self.heartbeat = heartbeat
+        self.expiry = expiry
+        self.replicas = replicas
+        self.ring = HashRing((), replicas)
+        self.version = 0
+        self.loop = None
+        metrics.gauge("shard.nodes", lambda: len(self.ring.nodes))
+
+    def owns(self, url):
+        return self.ring.owner(url) == self.node
+
+    def start(self):
+        if self.loop is None:
+            self.loop = task.LoopingCall(self.beat)
+            self.loop.start(self.heartbeat)
+
+    def stop(self):
+        """ Stop beating and leave, so the other nodes take over straight away.
+
+        Returns:
+            A Deferred that fires once this node's row is removed.
+        """
+        if self.loop is None:
+            return succeed(None)
+        if self.loop.running:
+            self.loop.stop()
+        self.loop = None
+        self.update(())
+        return self.dbpool.runOperation("DELETE FROM collector_nodes WHERE node = %s",
+                                        (self.node,))
+
+    @inlineCallbacks
+    def beat(self):
+        try:
+            nodes = yield self.dbpool.runInteraction(self._beat)
+        except Exception as err:
+            # Keep the last known ring, the other nodes drop this one if
+            # the database stays out of reach
+            print(u"Could not store the shard heartbeat: {0}".format(err))
+            return
+        self.update(nodes)
+
+    def _beat(self, txn):
+        txn.execute("INSERT INTO collector_nodes (node, heartbeat) "
+                    "VALUES (%s, now()) "
+                    "ON CONFLICT (node) DO UPDATE SET heartbeat = now()",
+                    (self.node,))
+        txn.execute("DELETE FROM collector_nodes "
+                    "WHERE heartbeat < now() - %s * interval '1 second'",
+                    (self.expiry,))
+        txn.execute("SELECT node FROM collector_nodes")
+        return [row[0] for row in txn.fetchall()]
+
+    def update(self, nodes):
+        """Rebuild the ring when the set of nodes changes."""
+        nodes = frozenset(nodes)
+        if nodes == self.ring.nodes:
+            return
+        if self.version:
+            metrics.count("shard.rebalances")
+        print(u"Feed shards: {0} nodes ({1})".format(
+            len(nodes), u", ".join(sorted(nodes))))
+        self.ring = HashRing(nodes, self.replicas)
+        self.version += 1
+
+
+def main(args):
+    import psycopg2
+    connection = psycopg2.connect(host=environ['RKC_DB_HOST'],
+                                  port=environ['RKC_DB_PORT'],
+                                  database=environ['RKC_DB_NAME'],
+                                  user=environ['RKC_DB_USER'],
+                                  password=environ['RKC_DB_PASS'])
+    cursor = connection.cursor()
+    cursor.execute("SELECT node, extract(epoch FROM now() - heartbeat) "
+                   "FROM collector_nodes "
+                   "WHERE heartbeat >= now() - %s * interval '1 second' "
+                   "ORDER BY node", (args.expiry,))
+    nodes = cursor.fetchall()
+    cursor.execute("SELECT url FROM feeds")
+    ring = HashRing([node for node, _ in nodes], args.replicas)
+    shares = Counter(ring.owner(row[0]) for row in cursor.fetchall())
+    for node, age in nodes:
+        print(u"{0}: {1} feeds, last heartbeat {2:.0f}s ago".format(
+            node, shares[node], age))
+    connection.close()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--replicas", type=int, default=100,
+                        help="Ring points per node, as set for the collectors.")
+    parser.add_argument("--expiry", type=int, default=60,
+                        help="Seconds without a heartbeat before a node is dropped.")
+    sys.exit(main(parser.parse_args()))
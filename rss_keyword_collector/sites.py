@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+import json
+from os import environ, path
+import time
+
+from lxml import etree
+
+try:
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    CSSSelector = None
+
+DEFAULT_SITES_PATH = path.join(path.dirname(path.abspath(__file__)), "sites.json")
+
+
+def compile_selector(selector):
+    """ Compile a CSS selector, or an XPath expression prefixed with "xpath:".
+
+    CSS selectors need the cssselect package.
+    """
+    if selector.startswith("xpath:"):
+        return etree.XPath(selector[len("xpath:"):])
+    if CSSSelector is None:
+        raise ValueError(u"CSS selector {0} needs the cssselect package".format(selector))
+    return CSSSelector(selector)
+
+
+def _text(found):
+    """The stripped text of an element or of a string an XPath returned."""
+    if isinstance(found, etree._Element):
+        found = found.text_content()
+    return u" ".join(found.split())
+
+
+class SiteExtractor(object):
+    """The compiled selectors of one site."""
+
+    def __init__(self, name, body, title=None, lang=None):
+        """
+        Args:
+        name (str): The site's name in the registry.
+        body (str): Selector of the elements holding the article text, one
+                    line per element.
+        title (str): Selector of the article title, the page's <title> is
+                     used when it is missing or matches nothing.
+        lang (str): Selector of the page language, the lang attribute of
+                    <html> is used when it is missing or matches nothing.
+        """
+        self.name = name
+        self.body = compile_selector(body)
+        self.title = compile_selector(title) if title else None
+        self.lang = compile_selector(lang) if lang else None
+
+    def extract(self, html_obj):
+        """ Pull the text, title and language out of a parsed page.
+
+        Returns:
+            Tuple (text, title, lang), text is "" when the body selector
+            matches nothing.
+        """
+        title = self._first(self.title, html_obj)
+        if title is None:
+            title = (html_obj.findtext(".//title") or u"").strip()
+        lang = self._first(self.lang, html_obj) or html_obj.get('lang')
+        lines = [line for line in (_text(found) for found in self.body(html_obj))
+                 if line]
+        if not lines:
+            print(u"No body text found in article {0}".format(title))
+        return u"\n".join(lines), title, lang
+
+    @staticmethod
+    def _first(selector, html_obj):
+        if selector is None:
+            return None
+        for found in selector(html_obj):
+            text = _text(found)
+            if text:
+                return text
+        return None
+
+
+class SiteRegistry(object):
+    """ Site extractors by host, loaded from a JSON file.
+
+    The file maps site names to their hosts and selectors:
+
+        {"bbc": {"hosts": ["www.bbc.com", "*.bbc.co.uk"],
+                 "title": "h1.story-body__h1",
+                 "body": "div.story-body__inner p",
+                 "lang": "xpath:/html/@lang"}}
+
+    Only body is required. A host matches exactly, and "*.example.org"
+    matches every subdomain of example.org. Exact hosts win, then the longest matching suffix, so a
+    lookup costs one dictionary lookup per label of the host whatever the
+    number of sites. The file is checked for changes every check_interval
+    seconds and reloaded when it changed. A file that cannot be loaded is
+    reported and the sites loaded before are kept.
+    """
+
+    def __init__(self, sites_path=None, check_interval=5):
+        """
+        Args:
+        sites_path (str): The JSON file (defaults to RKC_SITES_PATH, or the
+                          sites.json next to this module).
+        check_interval (float): Seconds between checks for a changed file.
+        """
+        self.path = sites_path or environ.get('RKC_SITES_PATH') or DEFAULT_SITES_PATH
+        self.check_interval = check_interval
+        self.hosts = {}
+        self.suffixes = {}
+        self.mtime = None
+        self.checked = 0
+
+    def load(self):
+        """ Read and compile the sites file.
+
+        Returns:
+            The number of sites loaded.
+        """
+        with open(self.path, "rb") as sites_file:
+            config = json.loads(sites_file.read().decode("utf-8"))
+        hosts = {}
+        suffixes = {}
+        for name, site in config.items():
+            extractor = SiteExtractor(name, site["body"], site.get("title"),
+                                      site.get("lang"))
+            for host in site["hosts"]:
+                host = host.lower()
+                if host.startswith("*."):
+                    suffixes[host[2:]] = extractor
+                else:
+                    hosts[host] = extractor
+        self.hosts, self.suffixes = hosts, suffixes
+        return len(config)
+
+    def check(self):
+        """Reload the sites file if it changed since it was last loaded."""
+        self.checked = time.time()
+        try:
+            mtime = path.getmtime(self.path)
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self.load()
+        except Exception as err:
+            print(u"Could not load the site extractors from {0}: {1}".format(self.path, err))
+
+    def get(self, host):
+        """The SiteExtractor for a host, or None."""
+        if time.time() - self.checked >= self.check_interval:
+            self.check()
+        if not host:
+            return None
+        host = host.lower()
+        extractor = self.hosts.get(host)
+        if extractor is not None:
+            return extractor
+        labels = host.split(".")
+        for start in range(1, len(labels)):
+            extractor = self.suffixes.get(".".join(labels[start:]))
+            if extractor is not None:
+                return extractor
+        return None
+
+
+# Loaded on first use in every process that extracts text
+sites = SiteRegistry()
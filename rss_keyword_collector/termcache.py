@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+from array import array
+from collections import OrderedDict
+import heapq
+
+from twisted.internet.defer import DeferredLock, succeed
+from twisted.internet.threads import deferToThread
+
+from db import TERM_LENGTH, fetch_chunks, insert_many
+
+
+def _encode(term):
+    if isinstance(term, bytes):
+        return term
+    return term.encode("utf-8")
+
+
+class PackedTerms(object):
+    """ Terms and their ids, sorted and packed into flat arrays.
+
+    The UTF-8 bytes of every term are stored back to back in one string and
+    found by binary search, so a term costs its length plus 14 bytes rather
+    than a string object, an int object and a dict slot (well over 100
+    bytes). A PackedTerms is never changed once built, apart from its use
+    counts, so it can be read while a merged copy is built in a thread.
+    """
+
+    def __init__(self, pairs=()):
+        """
+        Args:
+        pairs (iterable): (UTF-8 term, id) tuples sorted by term. Only the
+                          first of repeated terms is kept.
+        """
+        chunks = []
+        self.offsets = array("I", [0])
+        self.ids = array("l")
+        size = 0
+        last = None
+        for term, term_id in pairs:
+            if last is not None and term <= last:
+                if term == last:
+                    continue
+                raise ValueError("Terms must be sorted")
+            last = term
+            chunks.append(term)
+            size += len(term)
+            self.offsets.append(size)
+            self.ids.append(term_id)
+        self.blob = b"".join(chunks)
+        # Lookups of each term since it was packed, capped at 65535
+        self.uses = array("H", [0]) * len(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return (len(self.blob) + self.offsets.itemsize * len(self.offsets) +
+                self.ids.itemsize * len(self.ids) + self.uses.itemsize * len(self.uses))
+
+    def _term(self, index):
+        return self.blob[self.offsets[index]:self.offsets[index + 1]]
+
+    def get(self, term):
+        """The id of a UTF-8 term, or None."""
+        low, high = 0, len(self.ids)
+        while low < high:
+            middle = (low + high) // 2
+            found = self._term(middle)
+            if found < term:
+                low = middle + 1
+            elif found > term:
+                high = middle
+            else:
+                if self.uses[middle] < 65535:
+                    self.uses[middle] += 1
+                return self.ids[middle]
+        return None
+
+    def items(self):
+        for index in range(len(self.ids)):
+            yield self._term(index), self.ids[index]
+
+    def merged(self, pairs, max_terms=None):
+        """ A copy holding these terms as well.
+
+        Args:
+        pairs (iterable): (UTF-8 term, id) tuples, in any order.
+        max_terms (int): Most terms kept. All of pairs are kept, then the
+                         most used of this copy's terms.
+        """
+        pairs = sorted(pairs)
+        terms = self.items()
+        room = None if max_terms is None else max_terms - len(pairs)
+        if room is not None and room < len(self):
+            terms = self._most_used(max(room, 0))
+        return PackedTerms(heapq.merge(terms, pairs))
+
+    def _most_used(self, count):
+        """The count most used terms, in term order."""
+        if not count:
+            return iter(())
+        threshold = sorted(self.uses, reverse=True)[count - 1]
+        # Every term used more than the threshold, then enough of those
+        # used exactly as often
+        ties = count - sum(1 for uses in self.uses if uses > threshold)
+        kept = []
+        for index, uses in enumerate(self.uses):
+            if uses > threshold or (uses == threshold and ties > 0):
+                if uses == threshold:
+                    ties -= 1
+                kept.append(index)
+        return ((self._term(index), self.ids[index]) for index in kept)
+
+
+class TermDictionary(object):
+    """ Maps terms to their id in the terms table (terms.id).
+
+    Up to max_terms terms are held in PackedTerms. Terms stored since the
+    last compaction are held in a dict until there are compact_at of them,
+    and the most recently used terms are kept in an LRU in front of both.
+    Terms missing from all of them are looked up in (or added to) the terms
+    table, so the ids of an article's terms cost no database round trip
+    once its terms have been seen, and memory stays bounded however many
+    terms the table holds.
+
+    Compaction packs the recent terms with the rest in a thread. Once
+    max_terms is reached it keeps the packed terms looked up most often
+    since the last compaction, and the others are looked up again in the
+    database the next time they turn up.
+    """
+
+    def __init__(self, dbconn, hot_terms=50000, compact_at=100000,
+                 max_terms=2000000, batch_size=1000):
+        """
+        Args:
+        dbconn (adbapi.ConnectionPool): Pool holding the terms table.
+        hot_terms (int): Number of recently used terms kept in the LRU.
+        compact_at (int): Number of newly stored terms held in a dict before
+                          they are packed with the rest.
+        max_terms (int): Most terms packed, each costs 14 bytes plus its
+                         UTF-8 length.
+        batch_size (int): Maximum number of terms sent in one INSERT.
+        """
+        self.dbpool = dbconn
+        self.hot_terms = hot_terms
+        self.compact_at = compact_at
+        self.max_terms = max_terms
+        self.batch_size = batch_size
+        self.packed = PackedTerms()
+        # UTF-8 term -> id, stored or looked up since the last compaction
+        self.recent = {}
+        self.hot = OrderedDict()
+        # Held while a merged copy of the packed terms is built
+        self.merging = DeferredLock()
+        self.compacting = False
+        self.lookups = 0
+        self.hits = 0
+        # Terms this process learned the id of from the database
+        self.learned = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.packed) + len(self.recent)
+
+    def get(self, term):
+        """The id of a term if it is known in this process, or None."""
+        self.lookups += 1
+        term_id = self.hot.get(term)
+        if term_id is not None:
+            # Move to the most recently used end
+            self.hot[term] = self.hot.pop(term)
+            self.hits += 1
+            return term_id
+        key = _encode(term)
+        term_id = self.recent.get(key)
+        if term_id is None:
+            term_id = self.packed.get(key)
+        if term_id is not None:
+            self.hits += 1
+            self._remember(term, term_id)
+        return term_id
+
+    def _remember(self, term, term_id):
+        self.hot[term] = term_id
+        while len(self.hot) > self.hot_terms:
+            self.hot.popitem(last=False)
+
+    def ids(self, terms):
+        """ Look up the ids of terms, adding the unknown ones to the terms table.
+
+        Terms are truncated to the column size first.
+
+        Returns:
+            A Deferred that fires with the list of ids, one per term.
+        """
+        terms = [term[:TERM_LENGTH] for term in terms]
+        found = dict((term, self.get(term)) for term in set(terms))
+        missing = [term for term, term_id in found.items() if term_id is None]
+        if not missing:
+            return succeed([found[term] for term in terms])
+        # Always insert in the same order so that concurrent writers lock
+        # index entries in the same order and cannot deadlock each other.
+        stored = self.dbpool.runInteraction(self._store, sorted(missing))
+        stored.addCallback(self._learned, terms, found)
+        return stored
+
+    def _store(self, txn, terms):
+        rows = []
+        for start in range(0, len(terms), self.batch_size):
+            batch = terms[start:start + self.batch_size]
+            inserted = insert_many(txn,
+                                   "INSERT INTO terms (term, censored) VALUES",
+                                   "(%s, false)",
+                                   [(term,) for term in batch],
+                                   "ON CONFLICT (term) DO NOTHING "
+                                   "RETURNING term, id")
+            rows += inserted
+            # Stored by another parser since this one last looked
+            if len(inserted) < len(batch):
+                txn.execute("SELECT term, id FROM terms WHERE term = ANY(%s)",
+                            (batch,))
+                rows += txn.fetchall()
+        return rows
+
+    def _learned(self, rows, terms, found):
+        stored = dict((_encode(term), term_id) for term, term_id in rows)
+        for term, term_id in found.items():
+            if term_id is None:
+                term_id = found[term] = stored.get(_encode(term))
+                if term_id is None:
+                    raise KeyError(u"Term {0} was not stored".format(term))
+                self._remember(term, term_id)
+        self.learned += len(stored)
+        self.recent.update(stored)
+        if len(self.recent) >= self.compact_at and not self.compacting:
+            self.compact()
+        return [found[term] for term in terms]
+
+    def compact(self):
+        """ Pack the recently stored terms with the rest, in a thread.
+
+        Lookups carry on against the current packed terms meanwhile.
+
+        Returns:
+            A Deferred that fires once the merged terms replace them.
+        """
+        self.compacting = True
+        compacted = self.merging.run(self._compact)
+        compacted.addBoth(self._compacted)
+        return compacted
+
+    def _compact(self):
+        pairs = list(self.recent.items())
+        merged = deferToThread(self.packed.merged, pairs, self.max_terms)
+        merged.addCallback(self._replace, pairs)
+        return merged
+
+    def _compacted(self, result):
+        self.compacting = False
+        return result
+
+    def _replace(self, packed, pairs):
+        self.evicted += max(len(self.packed) + len(pairs) - len(packed), 0)
+        self.packed = packed
+        # Terms stored while merging wait for the next compaction
+        for term, term_id in pairs:
+            if self.recent.get(term) == term_id:
+                del self.recent[term]
+
+    def stats(self):
+        return {"terms": len(self),
+                "hot_terms": len(self.hot),
+                "packed_bytes": self.packed.nbytes,
+                "hit_rate": float(self.hits) / self.lookups if self.lookups else 0.0,
+                "learned": self.learned,
+                "evicted": self.evicted}
+
+    def warm(self, chunk_size=10000):
+        """ Load the newest max_terms terms from the terms table.
+
+        The terms are read in byte order and packed as they arrive, in a
+        database thread, and are merged with any terms learned meanwhile in
+        another thread.
+
+        Returns:
+            A Deferred that fires with the number of terms loaded.
+        """
+        loaded = self.dbpool.runInteraction(self._warm, chunk_size)
+        loaded.addCallback(lambda packed: self.merging.run(self._warmed, packed))
+        return loaded
+
+    def _warm(self, txn, chunk_size):
+        # The C collation sorts UTF-8 text by its bytes, like PackedTerms
+        rows = fetch_chunks(txn, 'SELECT term, id FROM (SELECT term, id FROM terms '
+                            'ORDER BY id DESC LIMIT %s) AS newest ORDER BY term COLLATE "C"',
+                            chunk_size, (self.max_terms,))
+        return PackedTerms((_encode(term), term_id)
+                           for chunk in rows for term, term_id in chunk)
+
+    def _warmed(self, packed):
+        if not len(self.packed):
+            self.packed = packed
+            return succeed(len(packed))
+        # Keep anything packed while the terms were being read
+        merged = deferToThread(packed.merged, list(self.packed.items()), self.max_terms)
+        merged.addCallback(self._replace, [])
+        merged.addCallback(lambda _: len(packed))
+        return merged
@@ -0,0 +1,607 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+"""An append-only, segmented store of term occurrences.
+
+Every term found in an article is kept as a record of (entry, term id,
+timestamp, language). The entry is the article's keyword hash, the value
+EntryParser stores in entries.term_file, and the term id is the term's id
+in the terms table (terms.id).
+
+Layout of the store directory:
+    languages.dict   Every language code seen, in the order ids were given out.
+    segments/00000001.seg, ...
+                     Sealed segments of records, oldest first.
+    segments/00000002.log
+                     Records of the segment being filled, appended as
+                     they are added and removed once the segment is sealed.
+
+A segment holds its records column by column, sorted by term id:
+
+    header     magic, version, count, first and last timestamp
+    terms      count x uint64 term ids
+    entries    count x 16 byte keyword hashes
+    timestamps count x uint32 seconds since the epoch
+    languages  count x uint16 language ids
+
+Segments are never changed once written. They are read through mmap, so
+a query only pages in the parts of a segment it touches, and a segment
+whose time range misses the query is not read at all.
+
+Run as a script to migrate the old per-article keyword files or to query
+the store. Terms are looked up in the database set in the RKC_DB_*
+environment variables:
+
+    python termstore.py migrate /var/opt/rss_keyword/keywords/ STORE_DIR --remove
+    python termstore.py query STORE_DIR "election" --days 7
+"""
+
+import argparse
+import binascii
+from bisect import bisect_left
+import codecs
+from datetime import datetime
+import mmap
+from os import environ, fsync, listdir, makedirs, path, remove, rename
+import struct
+import sys
+import time
+
+from twisted.internet import task, threads
+from twisted.internet.defer import Deferred, DeferredLock, succeed
+from twisted.python.failure import Failure
+
+from db import TERM_LENGTH
+
+MAGIC = b"RKCT"
+VERSION = 1
+HEADER = struct.Struct("<4sHIII")
+# terms.id is a bigserial
+TERM_ID = struct.Struct("<Q")
+# Length prefix of a dictionary entry
+LENGTH = struct.Struct("<H")
+ENTRY_BYTES = 16
+# A record in a segment's log: term id, entry, timestamp, language id
+LOG_RECORD = struct.Struct("<Q16sIH")
+
+
+class Dictionary(object):
+    """ An append-only mapping of strings (language codes) to small integer ids.
+
+    Ids are given out in order and written to the dictionary file before any
+    segment that uses them, so a segment never refers to an unknown id.
+    """
+
+    def __init__(self, file_path):
+        self.path = file_path
+        self.ids = {}
+        self.values = []
+        self._load()
+        # Number of values in the file
+        self.saved = len(self.values)
+
+    def _load(self):
+        if not path.exists(self.path):
+            return
+        with open(self.path, "rb") as stored:
+            data = stored.read()
+        position = 0
+        while position + LENGTH.size <= len(data):
+            length, = LENGTH.unpack_from(data, position)
+            end = position + LENGTH.size + length
+            if end > len(data):
+                break
+            self._add(data[position + LENGTH.size:end].decode("utf-8"))
+            position = end
+        if position < len(data):
+            # A write was cut short, drop the partial value
+            with open(self.path, "r+b") as stored:
+                stored.truncate(position)
+
+    def _add(self, value):
+        self.ids[value] = len(self.values)
+        self.values.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, value):
+        """The id of a value, or None if it was never added."""
+        return self.ids.get(value)
+
+    def id(self, value):
+        """The id of a value, adding it if needed."""
+        value_id = self.ids.get(value)
+        if value_id is None:
+            self._add(value)
+            value_id = len(self.values) - 1
+        return value_id
+
+    def save(self, count=None):
+        """ Write the values added since the last save and sync the file.
+
+        Values are only ever appended, so a thread can save the first count
+        values while more are added.
+        """
+        count = len(self.values) if count is None else count
+        if count <= self.saved:
+            return
+        with open(self.path, "ab") as stored:
+            for value in self.values[self.saved:count]:
+                encoded = value.encode("utf-8")
+                stored.write(LENGTH.pack(len(encoded)) + encoded)
+            stored.flush()
+            fsync(stored.fileno())
+        self.saved = count
+
+
+class Segment(object):
+    """A memory-mapped reader of one sealed segment."""
+
+    def __init__(self, file_path):
+        self.path = file_path
+        with open(file_path, "rb") as segment_file:
+            self.map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.first, self.last = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{0} is not a term store segment".format(file_path))
+        self.terms_at = HEADER.size
+        self.entries_at = self.terms_at + TERM_ID.size * self.count
+        self.timestamps_at = self.entries_at + ENTRY_BYTES * self.count
+        self.languages_at = self.timestamps_at + 4 * self.count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        # Lets bisect search the sorted term id column in place
+        return TERM_ID.unpack_from(self.map, self.terms_at + TERM_ID.size * index)[0]
+
+    def overlaps(self, start, end):
+        return self.last >= start and self.first < end
+
+    def find(self, term_id):
+        """The (start, end) index range of a term's records."""
+        start = bisect_left(self, term_id)
+        end = bisect_left(self, term_id + 1, start)
+        return start, end
+
+    def records(self, start, end):
+        """Yield (entry, timestamp, language id) for the records in an index range."""
+        for index in range(start, end):
+            entry = self.map[self.entries_at + ENTRY_BYTES * index:
+                             self.entries_at + ENTRY_BYTES * (index + 1)]
+            timestamp, = struct.unpack_from("<I", self.map, self.timestamps_at + 4 * index)
+            language, = struct.unpack_from("<H", self.map, self.languages_at + 2 * index)
+            yield entry, timestamp, language
+
+    def close(self):
+        self.map.close()
+
+
+def write_segment(segment_path, records):
+    """ Write records to a new segment.
+
+    Args:
+    segment_path (str): Path of the segment, which must not exist yet.
+    records (list): (term id, entry, timestamp, language id) tuples.
+    """
+    records = sorted(records)
+    timestamps = [record[2] for record in records]
+    with open(segment_path + ".tmp", "wb") as segment_file:
+        segment_file.write(HEADER.pack(MAGIC, VERSION, len(records),
+                                       min(timestamps), max(timestamps)))
+        segment_file.write(struct.pack("<{0}Q".format(len(records)),
+                                       *[record[0] for record in records]))
+        segment_file.write(b"".join(record[1] for record in records))
+        segment_file.write(struct.pack("<{0}I".format(len(records)), *timestamps))
+        segment_file.write(struct.pack("<{0}H".format(len(records)),
+                                       *[record[3] for record in records]))
+        segment_file.flush()
+        fsync(segment_file.fileno())
+    rename(segment_path + ".tmp", segment_path)
+
+
+class TermStore(object):
+    """ Term occurrences of every parsed article.
+
+    add() appends an article's records to the log of the segment being
+    filled, and its Deferred fires once they are synced to disk. Records
+    added while a log write is under way are written together by the next
+    one. Records are also kept in memory, and sealed into the segment once
+    segment_records have been added, flush() is called or (after start())
+    on a timer. Logs are written and segments sealed in a thread, one at a
+    time. Records not yet in a segment are still returned by queries, and
+    are sealed from their log when the store is opened again after a crash.
+    """
+
+    def __init__(self, root, segment_records=100000):
+        """
+        Args:
+        root (str): Directory holding the store. Created if missing.
+        segment_records (int): Number of records buffered before a segment is written.
+        """
+        self.root = path.abspath(root)
+        self.segment_records = segment_records
+        self.segment_dir = path.join(self.root, "segments")
+        if not path.exists(self.segment_dir):
+            makedirs(self.segment_dir)
+        self.languages = Dictionary(path.join(self.root, "languages.dict"))
+        self.segments = [Segment(path.join(self.segment_dir, name))
+                         for name in sorted(listdir(self.segment_dir))
+                         if name.endswith(".seg")]
+        # (term id, entry, timestamp, language id) not yet in a segment
+        self.pending = []
+        # Lists of records being sealed into a segment
+        self.sealing = []
+        self._recover()
+        numbers = [int(path.basename(segment.path)[:-len(".seg")])
+                   for segment in self.segments]
+        # Number of the segment being filled
+        self.number = max(numbers or [0]) + 1
+        # (records, Deferreds of their add() calls) for the next log write
+        self.log_batch = None
+        # Log writes and seals run one at a time, in the order asked for
+        self.writing = DeferredLock()
+        self.loop = None
+
+    def _path(self, number, extension):
+        return path.join(self.segment_dir, "{0:08d}.{1}".format(number, extension))
+
+    def _recover(self):
+        """Seal the logs of segments a stopped process did not seal."""
+        for name in sorted(listdir(self.segment_dir)):
+            if not name.endswith(".log"):
+                continue
+            number = int(name[:-len(".log")])
+            if path.exists(self._path(number, "seg")):
+                # Sealed, but stopped before the log was removed
+                remove(self._path(number, "log"))
+                continue
+            with open(self._path(number, "log"), "rb") as log:
+                data = log.read()
+            # A write that was cut short was never reported stored, so its
+            # partial record is dropped
+            records = [LOG_RECORD.unpack_from(data, position)
+                       for position in range(0, len(data) - LOG_RECORD.size + 1,
+                                             LOG_RECORD.size)]
+            self._write_segment(number, records)
+            if records:
+                self.segments.append(Segment(self._path(number, "seg")))
+        self.segments.sort(key=lambda segment: segment.path)
+
+    def records(self, entry, term_ids, language=None, timestamp=None):
+        """ The records of the terms found in an article.
+
+        Args:
+        entry (str): The article's keyword hash (32 hex digits).
+        term_ids (list): The ids of the article's terms in the terms table.
+        language (str): The article's language code.
+        timestamp (float): When the article was parsed, defaults to now.
+
+        Returns:
+            A list of (term id, entry, timestamp, language id) tuples.
+        """
+        entry = binascii.unhexlify(entry)
+        if len(entry) != ENTRY_BYTES:
+            raise ValueError("Entries are keyword hashes of 32 hex digits")
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        language_id = self.languages.id(language or u"")
+        return [(term_id, entry, timestamp, language_id) for term_id in set(term_ids)]
+
+    def add(self, entry, term_ids, language=None, timestamp=None):
+        """ Record the terms found in an article, arguments as for records().
+
+        Returns:
+            A Deferred that fires once the records are synced to the log.
+        """
+        records = self.records(entry, term_ids, language, timestamp)
+        self.pending.extend(records)
+        stored = Deferred()
+        if self.log_batch is None:
+            self.log_batch = (records, [stored])
+            self.writing.run(self._write_log, self.number, self.log_batch)
+        else:
+            self.log_batch[0].extend(records)
+            self.log_batch[1].append(stored)
+        if len(self.pending) >= self.segment_records:
+            self.flush()
+        return stored
+
+    def _write_log(self, number, batch):
+        if self.log_batch is batch:
+            self.log_batch = None
+        records, waiting = batch
+        written = threads.deferToThread(self._append_log, number, records,
+                                        len(self.languages))
+        written.addBoth(self._logged, records, waiting)
+        return written
+
+    def _append_log(self, number, records, languages):
+        # Language ids have to be on disk before a record refers to them
+        self.languages.save(languages)
+        with open(self._path(number, "log"), "ab") as log:
+            size = log.tell()
+            try:
+                log.write(b"".join(LOG_RECORD.pack(*record) for record in records))
+                log.flush()
+                fsync(log.fileno())
+            except EnvironmentError:
+                # Reported as not stored, so they must not be recovered
+                log.truncate(size)
+                raise
+
+    def _logged(self, result, records, waiting):
+        if isinstance(result, Failure):
+            # The entries are retried under a new keyword hash, so these
+            # records must not be sealed. Their seal waits on this write, so
+            # they are still pending or waiting to be sealed.
+            dropped = set(id(record) for record in records)
+            self.pending = [record for record in self.pending if id(record) not in dropped]
+            for sealing in self.sealing:
+                sealing[:] = [record for record in sealing if id(record) not in dropped]
+        for stored in waiting:
+            if isinstance(result, Failure):
+                stored.errback(result)
+            else:
+                stored.callback(None)
+
+    def flush(self):
+        """ Seal the records not yet in a segment into a new one, in a thread.
+
+        Returns:
+            A Deferred that fires once the segment is written.
+        """
+        if not self.pending:
+            return self.writing.run(succeed, None)
+        records, self.pending = self.pending, []
+        number = self.number
+        self.number += 1
+        # Records added from now on go to the next segment's log
+        self.log_batch = None
+        self.sealing.append(records)
+        return self.writing.run(self._seal, number, records)
+
+    def _seal(self, number, records):
+        sealed = threads.deferToThread(self._write_segment, number, records)
+        sealed.addBoth(self._sealed, number, records)
+        return sealed
+
+    def _write_segment(self, number, records):
+        if records:
+            write_segment(self._path(number, "seg"), records)
+        if path.exists(self._path(number, "log")):
+            remove(self._path(number, "log"))
+
+    def _sealed(self, result, number, records):
+        if isinstance(result, Failure):
+            # The records stay in their log, and in memory for queries,
+            # and are sealed when the store is next opened
+            print(u"Could not seal term store segment {0}: {1}".format(
+                number, result.getErrorMessage()))
+            return None
+        self.sealing = [sealing for sealing in self.sealing if sealing is not records]
+        if records:
+            self.segments.append(Segment(self._path(number, "seg")))
+
+    def write(self, records):
+        """ Seal records into a new segment straight away, without a log.
+
+        For scripts, which add records without running the reactor.
+        """
+        self.languages.save()
+        write_segment(self._path(self.number, "seg"), records)
+        self.segments.append(Segment(self._path(self.number, "seg")))
+        self.number += 1
+
+    def start(self, interval):
+        """Seal the records added every interval seconds."""
+        if self.loop is None:
+            self.loop = task.LoopingCall(self.flush)
+            self.loop.start(interval, now=False)
+
+    def occurrences(self, term_id, start=0, end=2 ** 32):
+        """ Every record of a term in a time window.
+
+        Args:
+        term_id (int): The term's id in the terms table.
+        start (float): Start of the window, in seconds since the epoch.
+        end (float): End of the window (not included).
+
+        Yields:
+            Tuples (entry, timestamp, language).
+        """
+        for segment in self.segments:
+            if not segment.overlaps(start, end):
+                continue
+            first, last = segment.find(term_id)
+            for entry, timestamp, language in segment.records(first, last):
+                if start <= timestamp < end:
+                    yield (binascii.hexlify(entry).decode("ascii"), timestamp,
+                           self.languages.values[language])
+        for records in self.sealing + [self.pending]:
+            for record_term, entry, timestamp, language in records:
+                if record_term == term_id and start <= timestamp < end:
+                    yield (binascii.hexlify(entry).decode("ascii"), timestamp,
+                           self.languages.values[language])
+
+    def entries_with(self, term_id, start=0, end=2 ** 32):
+        """The keyword hashes of the articles containing a term in a time window."""
+        return set(entry for entry, _, _ in self.occurrences(term_id, start, end))
+
+    def stats(self):
+        return {"segments": len(self.segments),
+                "records": sum(len(segment) for segment in self.segments),
+                "pending": len(self.pending) + sum(len(records) for records in self.sealing)}
+
+    def close(self):
+        """ Seal the records added and close the segments.
+
+        Returns:
+            A Deferred that fires once every log write and seal is done.
+        """
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.loop = None
+        closed = self.flush()
+        closed.addCallback(lambda _: self._close_segments())
+        return closed
+
+    def _close_segments(self):
+        for segment in self.segments:
+            segment.close()
+
+
+def read_keyword_file(file_path):
+    """ Read a keyword file written before the term store.
+
+    Returns:
+        Tuple (url, timestamp, terms).
+    """
+    url, timestamp, terms = None, None, []
+    with codecs.open(file_path, encoding="utf-8") as keyword_file:
+        for line in keyword_file:
+            line = line.rstrip(u"\n")
+            if line.startswith(u"# "):
+                if url is None:
+                    url = line[2:]
+                elif timestamp is None:
+                    try:
+                        parsed = datetime.strptime(line[2:], "%Y-%m-%d %H:%M:%S.%f")
+                        timestamp = time.mktime(parsed.timetuple())
+                    except ValueError:
+                        pass
+            elif line:
+                terms.append(line)
+    if timestamp is None:
+        timestamp = path.getmtime(file_path)
+    return url, timestamp, terms
+
+
+def stored_term_ids(cursor, terms):
+    """ The ids of terms in the terms table, adding the missing ones.
+
+    Terms are truncated to the column size first, as TermDictionary does.
+
+    Args:
+    cursor: A psycopg2 cursor.
+    terms (iterable): Terms to look up.
+
+    Returns:
+        A dict of truncated term to id.
+    """
+    terms = sorted(set(term[:TERM_LENGTH] for term in terms))
+    if not terms:
+        return {}
+    cursor.execute("INSERT INTO terms (term, censored) "
+                   "SELECT unnest(%s::varchar[]), false "
+                   "ON CONFLICT (term) DO NOTHING", (terms,))
+    cursor.execute("SELECT term, id FROM terms WHERE term = ANY(%s)", (terms,))
+    # psycopg2 returns text as UTF-8 bytes on Python 2
+    return dict((term.decode("utf-8") if isinstance(term, bytes) else term, term_id)
+                for term, term_id in cursor.fetchall())
+
+
+def migrate(keyword_dir, store, term_ids, remove_files=False):
+    """ Move the per-article keyword files of a directory into a term store.
+
+    The files carry no language, so their records get an empty one. With
+    remove_files the files are deleted once every record is in a segment.
+
+    Args:
+    keyword_dir (str): Directory of keyword files.
+    store (TermStore): The store to add them to.
+    term_ids (callable): Called with a list of terms, returns a dict of
+                         (truncated) term to id, as stored_term_ids does.
+    remove_files (bool): Delete the files once migrated.
+
+    Returns:
+        The number of files migrated.
+    """
+    migrated = []
+    records = []
+    for name in sorted(listdir(keyword_dir)):
+        file_path = path.join(keyword_dir, name)
+        if len(name) != 2 * ENTRY_BYTES or not path.isfile(file_path):
+            continue
+        try:
+            binascii.unhexlify(name)
+        except (TypeError, ValueError):
+            continue
+        url, timestamp, terms = read_keyword_file(file_path)
+        ids = term_ids(terms)
+        records += store.records(name, [ids[term[:TERM_LENGTH]] for term in terms],
+                                 timestamp=timestamp)
+        migrated.append(file_path)
+        if len(records) >= store.segment_records:
+            store.write(records)
+            records = []
+    if records:
+        store.write(records)
+    if remove_files:
+        for file_path in migrated:
+            remove(file_path)
+    return len(migrated)
+
+
+def connect():
+    import psycopg2
+    return psycopg2.connect(host=environ['RKC_DB_HOST'],
+                            port=environ['RKC_DB_PORT'],
+                            database=environ['RKC_DB_NAME'],
+                            user=environ['RKC_DB_USER'],
+                            password=environ['RKC_DB_PASS'])
+
+
+def main(args):
+    connection = connect()
+    cursor = connection.cursor()
+    term_ids = lambda terms: stored_term_ids(cursor, terms)
+    store = TermStore(args.store)
+    if args.command == "migrate":
+        start = time.time()
+        migrated = migrate(args.keyword_dir, store, term_ids, args.remove)
+        connection.commit()
+        print(u"Migrated {0} keyword files in {1:.1f}s: "
+              u"{records} records in {segments} segments".format(
+                  migrated, time.time() - start, **store.stats()))
+    else:
+        end = time.time()
+        start = end - args.days * 24 * 60 * 60
+        term = args.term.decode("utf-8") if isinstance(args.term, bytes) else args.term
+        cursor.execute("SELECT id FROM terms WHERE term = %s", (term[:TERM_LENGTH],))
+        for term_id, in cursor.fetchall():
+            for entry, timestamp, language in sorted(store.occurrences(term_id, start, end),
+                                                     key=lambda record: record[1]):
+                print(u"{0} {1} {2}".format(datetime.fromtimestamp(timestamp),
+                                            entry, language))
+    store.close()
+    connection.close()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    migrate_command = commands.add_parser("migrate", help="Import old keyword files.")
+    migrate_command.add_argument("keyword_dir")
+    migrate_command.add_argument("store")
+    migrate_command.add_argument("--remove", action="store_true",
+                                 help="Delete the keyword files once migrated.")
+    query_command = commands.add_parser("query", help="List the articles containing a term.")
+    query_command.add_argument("store")
+    query_command.add_argument("term")
+    query_command.add_argument("--days", type=float, default=7)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+from collections import Counter
+from datetime import datetime
+import time
+
+from twisted.internet.defer import succeed
+
+from db import TERM_LENGTH, insert_many
+
+# Bucket sizes trend queries can group by, in seconds
+BUCKETS = {"hour": 60 * 60,
+           "day": 24 * 60 * 60}
+
+
+class TermTrends(object):
+    """ Hourly counts of the articles each term appeared in.
+
+    Counts are added up in memory as articles are parsed and flushed to the
+    term_counts table in batches, one row per term id (terms.id) and hour.
+    A trend over 90 days reads at most 2160 rows of one term from the
+    primary key index.
+    """
+
+    def __init__(self, dbconn, batch_size=1000, flush_at=50000):
+        """
+        Args:
+        dbconn (adbapi.ConnectionPool): Pool used to write and query the counts.
+        batch_size (int): Maximum number of counts sent in one INSERT.
+        flush_at (int): Number of (term, hour) counts held in memory before
+                        they are flushed without waiting for flush().
+        """
+        self.dbpool = dbconn
+        self.batch_size = batch_size
+        self.flush_at = flush_at
+        self.counts = Counter()
+        self.flushed = 0
+
+    @staticmethod
+    def bucket(timestamp, size=BUCKETS["hour"]):
+        """The start of the bucket a timestamp falls in, in seconds since the epoch."""
+        return int(timestamp) - int(timestamp) % size
+
+    def add(self, term_ids, timestamp=None):
+        """ Count one article's terms.
+
+        Args:
+        term_ids (list): The ids of the article's terms, each is counted once.
+        timestamp (float): When the article was seen, defaults to now.
+        """
+        hour = self.bucket(time.time() if timestamp is None else timestamp)
+        for term_id in set(term_ids):
+            self.counts[(term_id, hour)] += 1
+        if len(self.counts) >= self.flush_at:
+            self.flush()
+
+    def flush(self):
+        """ Add the counts held in memory to the term_counts table.
+
+        Counts that could not be written are kept for the next flush.
+
+        Returns:
+            A Deferred that fires with the number of rows written.
+        """
+        if not self.counts:
+            return succeed(0)
+        counts, self.counts = self.counts, Counter()
+        # Always write in the same order so that concurrent writers lock
+        # rows in the same order and cannot deadlock each other.
+        rows = sorted((term_id, datetime.utcfromtimestamp(hour), count)
+                      for (term_id, hour), count in counts.items())
+        written = self.dbpool.runInteraction(self._write, rows)
+        written.addCallbacks(self._written, self._failed, errbackArgs=(counts,))
+        return written
+
+    def _written(self, rows):
+        self.flushed += rows
+        return rows
+
+    def _failed(self, failure, counts):
+        print(u"Could not write term counts: {0}".format(failure.getErrorMessage()))
+        self.counts.update(counts)
+        return 0
+
+    def _write(self, txn, rows):
+        for start in range(0, len(rows), self.batch_size):
+            insert_many(txn,
+                        "INSERT INTO term_counts (term_id, bucket, count) VALUES",
+                        "(%s, %s AT TIME ZONE 'UTC', %s)",
+                        rows[start:start + self.batch_size],
+                        "ON CONFLICT (term_id, bucket) DO UPDATE "
+                        "SET count = term_counts.count + EXCLUDED.count")
+        return len(rows)
+
+    def trend(self, term, days=90, bucket="day"):
+        """ The number of articles a term appeared in per bucket.
+
+        Counts still held in memory are not included.
+
+        Args:
+        term (str): The term to look up.
+        days (int): How many days back to look.
+        bucket (str): "hour" or "day".
+
+        Returns:
+            A Deferred that fires with a list of (bucket start, count) rows,
+            oldest first. Buckets without the term are left out.
+        """
+        if bucket not in BUCKETS:
+            raise ValueError("{0} is not a valid bucket".format(bucket))
+        return self.dbpool.runQuery("SELECT date_trunc(%s, bucket), sum(count) "
+                                    "FROM term_counts "
+                                    "WHERE term_id = (SELECT id FROM terms WHERE term = %s) "
+                                    "AND bucket >= now() - %s * interval '1 day' "
+                                    "GROUP BY 1 ORDER BY 1",
+                                    (bucket, term[:TERM_LENGTH], days))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+
+"""Pages are parsed whatever charset they declare."""
+
+from os import path
+import sys
+import unittest
+
+HERE = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(HERE, "..", "rss_keyword_collector"))
+
+from twisted.web.http_headers import Headers
+
+from fetch import sniff
+
+# parse needs polyglot, and Python 2 cannot skip a module at import
+try:
+    from parse import ExtractText
+    MISSING = None
+except ImportError as err:
+    MISSING = u"parse could not be imported: {0}".format(err)
+
+PAGE = (u"<html><head><meta charset=\"{0}\"><title>{1}</title></head>"
+        u"<body><p>{1}</p></body></html>")
+KOREAN = u"한국 선거"
+JAPANESE = u"日本の選挙"
+
+
+def extract(raw, headers=None):
+    encoding, lang = sniff(raw, headers)
+    return ExtractText(u"http://example.org/story", raw, encoding, lang)
+
+
+class SniffTest(unittest.TestCase):
+
+    def test_labels_are_kept_as_declared(self):
+        for label in ["euc-kr", "euc-jp", "shift_jis", "windows-1256", "utf-8"]:
+            raw = PAGE.format(label, u"x").encode("ascii")
+            self.assertEqual(sniff(raw)[0], label)
+
+    def test_header_charset(self):
+        headers = Headers({b"content-type": [b"text/html; charset=EUC-KR"]})
+        self.assertEqual(sniff(b"<html></html>", headers)[0], "euc-kr")
+
+    def test_unknown_charset(self):
+        raw = PAGE.format(u"x-no-such-charset", u"x").encode("ascii")
+        self.assertEqual(sniff(raw)[0], None)
+
+
+@unittest.skipIf(MISSING, MISSING)
+class DeclaredCharsetTest(unittest.TestCase):
+
+    def test_multibyte_charsets(self):
+        for label, text in [("euc-kr", KOREAN), ("euc-jp", JAPANESE),
+                            ("shift_jis", JAPANESE)]:
+            page = extract(PAGE.format(label, text).encode(label))
+            self.assertEqual(page.text, text + u"\n" + text)
+
+    def test_mislabelled_utf8(self):
+        # Declared utf-8, but with a stray latin-1 byte
+        raw = PAGE.format(u"utf-8", u"Iran").encode("utf-8").replace(
+            b"<p>Iran", b"<p>caf\xe9 Iran")
+        page = extract(raw)
+        self.assertEqual(page.text, u"Iran\ncaf\xe9 Iran")
+
+    def test_wrong_charset_header(self):
+        headers = Headers({b"content-type": [b"text/html; charset=euc-jp"]})
+        raw = PAGE.format(u"utf-8", KOREAN).encode("utf-8")
+        page = extract(raw, headers)
+        self.assertEqual(page.text, KOREAN + u"\n" + KOREAN)
+        self.assertEqual(page.title, KOREAN)
+
+    def test_xml_declaration(self):
+        raw = (u"<?xml version=\"1.0\" encoding=\"euc-kr\"?>" +
+               PAGE.format(u"euc-kr", KOREAN)).encode("euc-kr")
+        self.assertEqual(extract(raw).text, KOREAN + u"\n" + KOREAN)
+
+
+if __name__ == "__main__":
+    unittest.main()
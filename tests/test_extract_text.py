@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+
+"""ExtractText.extractor_generic gives the text of the old extractor."""
+
+from os import path
+import sys
+import unittest
+
+HERE = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(HERE, "..", "rss_keyword_collector"))
+sys.path.insert(0, path.join(HERE, "..", "benchmarks"))
+
+# parse needs polyglot, and Python 2 cannot skip a module at import
+try:
+    from extract_text_benchmark import (current_extractor_generic,
+                                        legacy_extractor_generic, load_pages)
+    MISSING = None
+except ImportError as err:
+    MISSING = u"parse could not be imported: {0}".format(err)
+
+PAGES = path.join(HERE, "pages")
+
+
+@unittest.skipIf(MISSING, MISSING)
+class GenericExtractorTest(unittest.TestCase):
+
+    def test_pages_match_legacy_extractor(self):
+        pages = load_pages(PAGES)
+        self.assertTrue(pages)
+        for name, raw in pages:
+            self.assertEqual(current_extractor_generic(raw),
+                             legacy_extractor_generic(raw), name)
+
+    def test_text_after_removed_nodes_stays_apart(self):
+        raw = (b"<html><body><p>Iran<!-- x -->censorship and"
+               b"<style>p {}</style>elections<script>f()</script>"
+               b"count</p></body></html>")
+        self.assertEqual(current_extractor_generic(raw).split(u"\n"),
+                         [u"Iran", u"censorship and", u"elections", u"count"])
+
+
+if __name__ == "__main__":
+    unittest.main()
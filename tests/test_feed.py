@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+
+"""stream_entries reads the fields of RSS and Atom items."""
+
+from os import path
+import sys
+import unittest
+
+HERE = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(HERE, "..", "rss_keyword_collector"))
+
+from feed import stream_entries
+
+RSS = b"""<?xml version="1.0"?>
+<rss version="2.0" xmlns:media="http://search.yahoo.com/mrss/"
+     xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd"
+     xmlns:dc="http://purl.org/dc/elements/1.1/">
+<channel><language>en</language>
+<item>
+  <media:title>Episode 12</media:title>
+  <itunes:summary>Listen now</itunes:summary>
+  <title>Election results</title>
+  <description>Votes are counted</description>
+  <dc:creator>Jane Doe</dc:creator>
+  <link>http://example.org/election</link>
+</item>
+</channel></rss>"""
+
+ATOM = b"""<?xml version="1.0"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<entry>
+  <source><title>Wire service</title><updated>2016-01-01T00:00:00Z</updated></source>
+  <updated>2016-05-02T08:00:00Z</updated>
+  <title>Election results</title>
+  <author><name>Bob</name><email>b@x</email></author>
+  <published>2016-05-01T12:00:00Z</published>
+  <link rel="alternate" href="http://example.org/election"/>
+  <id>urn:example:1</id>
+</entry>
+<entry>
+  <title>Correction</title>
+  <updated>2016-05-03T08:00:00Z</updated>
+  <id>urn:example:2</id>
+</entry>
+</feed>"""
+
+
+class StreamEntriesTest(unittest.TestCase):
+
+    def test_extension_elements_are_ignored(self):
+        entries, language, stopped = stream_entries(RSS)
+        self.assertEqual(language, "en")
+        self.assertEqual(entries, [{"title": u"Election results",
+                                    "description": u"Votes are counted",
+                                    "author": u"Jane Doe",
+                                    "link": u"http://example.org/election"}])
+
+    def test_atom_author_is_its_name(self):
+        entries, _, _ = stream_entries(ATOM)
+        self.assertEqual(entries[0]["author"], u"Bob")
+
+    def test_published_is_preferred_to_updated(self):
+        entries, _, _ = stream_entries(ATOM)
+        self.assertEqual(entries[0]["pubDate"], u"2016-05-01T12:00:00Z")
+        # An entry without a publication date falls back to its update
+        self.assertEqual(entries[1]["pubDate"], u"2016-05-03T08:00:00Z")
+
+    def test_elements_of_an_atom_source_are_ignored(self):
+        entries, _, _ = stream_entries(ATOM)
+        self.assertEqual(entries[0]["title"], u"Election results")
+        self.assertEqual(entries[0]["guid"], u"urn:example:1")
+
+    def test_seen_entries_stop_the_read(self):
+        entries, _, stopped = stream_entries(ATOM, seen=set([u"urn:example:1"]),
+                                             stop_after=1)
+        self.assertEqual(entries, [])
+        self.assertTrue(stopped)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+
+"""BatchTagger finds the same entities as polyglot's own tagger."""
+
+from os import path
+import sys
+import unittest
+
+HERE = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(HERE, "..", "rss_keyword_collector"))
+
+from language import resources
+
+# parse needs polyglot, and Python 2 cannot skip a module at import
+try:
+    from parse import ExtractTerms
+    MISSING = None
+except ImportError as err:
+    MISSING = u"parse could not be imported: {0}".format(err)
+
+# Capitalised words, numbers and words missing from the embeddings, which
+# the tagger looks up through the case and digit expansions
+SAMPLE = [
+    u"Voters in Tehran and Isfahan went to the polls on Friday, officials said.",
+    u"IRAN said 2015 turnout reached 62 percent in 31 provinces, up from 1997.",
+    u"The Guardian Council approved 6,229 candidates for the March 2016 election.",
+    u"tehran TEHRAN Tehran tEhRaN iran Iran IRAN w1 W1 w12 City3 CITY3 city3",
+    u"Unknownword Anotherunknown 12345 123 12 1 x1 A1 a1 Q2 w2 W2 W299 zzz",
+]
+
+
+@unittest.skipIf(MISSING, MISSING)
+class BatchTaggerTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            resources.ner_batch_tagger("en")
+        except Exception as err:
+            self.skipTest(u"No English NER model: {0}".format(err))
+
+    def test_entities_match_polyglot(self):
+        expected = [ExtractTerms.get_entities(text, min_text_length=0, language="en")
+                    for text in SAMPLE]
+        found = ExtractTerms.get_entities_batch(SAMPLE, "en", min_text_length=0)
+        self.assertEqual(found, expected)
+
+    def test_tags_match_polyglot(self):
+        tagger = resources.ner_tagger("en")
+        batch_tagger = resources.ner_batch_tagger("en")
+        words = [text.split() for text in SAMPLE]
+        expected = [[tag for _, tag in tagger.annotate(text_words)]
+                    for text_words in words]
+        self.assertEqual(batch_tagger.annotate(words), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
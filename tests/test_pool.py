@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+
+"""ProcessPool fails jobs that run too long and replaces their workers."""
+
+from os import path
+import sys
+import time
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+HERE = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(HERE, "..", "rss_keyword_collector"))
+
+from pool import JobTimeout, ProcessPool
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+class ProcessPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ProcessPool(workers=2, timeout=1)
+
+    def tearDown(self):
+        self.pool.stop()
+
+    @inlineCallbacks
+    def test_jobs_return_their_result(self):
+        result = yield self.pool.submit(sleep, 0)
+        self.assertEqual(result, 0)
+
+    @inlineCallbacks
+    def test_stuck_job_times_out(self):
+        stuck = self.pool.submit(sleep, 60)
+        # Running next to the stuck job, so lost with its workers
+        other = self.pool.submit(sleep, 30)
+        start = time.time()
+        yield self.assertFailure(stuck, JobTimeout)
+        yield self.assertFailure(other, JobTimeout)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(self.pool.pending, 0)
+        # The pool carries on with new workers
+        result = yield self.pool.submit(sleep, 0)
+        self.assertEqual(result, 0)
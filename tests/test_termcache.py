@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+
+"""TermDictionary gives every term the id it has in the terms table."""
+
+from os import path
+import sys
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+HERE = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(HERE, "..", "rss_keyword_collector"))
+sys.path.insert(0, path.join(HERE, "..", "benchmarks"))
+
+from standin_db import StandInPool
+from termcache import TermDictionary
+
+
+def stored_ids(pool, terms):
+    return [pool.terms[term][0] for term in terms]
+
+
+class TermDictionaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = StandInPool([])
+
+    @inlineCallbacks
+    def test_every_new_term_is_stored(self):
+        dictionary = TermDictionary(self.pool)
+        terms = [u"term{0}".format(i) for i in range(5000)]
+        ids = yield dictionary.ids(terms + terms[:10])
+        self.assertEqual(sorted(self.pool.terms), sorted(terms))
+        self.assertEqual(ids, stored_ids(self.pool, terms + terms[:10]))
+
+    @inlineCallbacks
+    def test_terms_stored_by_another_parser(self):
+        first, second = TermDictionary(self.pool), TermDictionary(self.pool)
+        yield first.ids([u"election", u"iran"])
+        ids = yield second.ids([u"iran", u"vote", u"election"])
+        self.assertEqual(ids, stored_ids(self.pool, [u"iran", u"vote", u"election"]))
+        self.assertEqual(len(self.pool.terms), 3)
+
+    @inlineCallbacks
+    def test_known_terms_skip_the_database(self):
+        dictionary = TermDictionary(self.pool, hot_terms=2)
+        yield dictionary.ids([u"a", u"b", u"c"])
+        statements = self.pool.statements
+        ids = yield dictionary.ids([u"c", u"b", u"a"])
+        self.assertEqual(self.pool.statements, statements)
+        self.assertEqual(ids, stored_ids(self.pool, [u"c", u"b", u"a"]))
+
+    @inlineCallbacks
+    def test_warm_keeps_terms_learned_meanwhile(self):
+        yield TermDictionary(self.pool).ids([u"old{0}".format(i) for i in range(100)])
+        dictionary = TermDictionary(self.pool, compact_at=10)
+        yield dictionary.ids([u"new{0}".format(i) for i in range(25)])
+        loaded = yield dictionary.warm(chunk_size=7)
+        self.assertEqual(loaded, 125)
+        statements = self.pool.statements
+        terms = list(self.pool.terms)
+        ids = yield dictionary.ids(terms)
+        self.assertEqual(self.pool.statements, statements)
+        self.assertEqual(ids, stored_ids(self.pool, terms))
+
+    @inlineCallbacks
+    def test_compaction_keeps_at_most_max_terms(self):
+        dictionary = TermDictionary(self.pool, hot_terms=0, compact_at=10, max_terms=15)
+        yield dictionary.ids([u"often{0}".format(i) for i in range(10)])
+        yield dictionary.compact()
+        for _ in range(3):
+            yield dictionary.ids([u"often{0}".format(i) for i in range(5)])
+        yield dictionary.ids([u"new{0}".format(i) for i in range(10)])
+        yield dictionary.compact()
+        self.assertEqual(len(dictionary.packed), 15)
+        self.assertEqual(dictionary.stats()["evicted"], 5)
+        statements = self.pool.statements
+        yield dictionary.ids([u"often{0}".format(i) for i in range(5)])
+        self.assertEqual(self.pool.statements, statements)
+        # Evicted terms are looked up again, under their stored id
+        terms = [u"often{0}".format(i) for i in range(10)]
+        ids = yield dictionary.ids(terms)
+        self.assertEqual(ids, stored_ids(self.pool, terms))
+        self.assertEqual(len(self.pool.terms), 20)
+
+    @inlineCallbacks
+    def test_warm_loads_the_newest_max_terms(self):
+        yield TermDictionary(self.pool).ids([u"term{0}".format(i) for i in range(30)])
+        dictionary = TermDictionary(self.pool, max_terms=10)
+        loaded = yield dictionary.warm(chunk_size=4)
+        self.assertEqual(loaded, 10)
+        self.assertEqual(dictionary.packed.get(b"term29"), self.pool.terms[u"term29"][0])
+        self.assertIsNone(dictionary.packed.get(b"term0"))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This file is part of rss_keyword_parser, a simple term extractor from rss feeds.
+# Copyright © 2015 seamus tuohy, <stuohy@internews.org>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the included LICENSE file for details.
+
+
+"""The term store keeps term occurrences by their id in the terms table."""
+
+import codecs
+from os import listdir, path
+import shutil
+import sys
+import tempfile
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+HERE = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(HERE, "..", "rss_keyword_collector"))
+
+import termstore
+from termstore import TermStore
+
+ENTRY = "0123456789abcdef0123456789abcdef"
+OTHER = "fedcba9876543210fedcba9876543210"
+
+
+class TermIds(object):
+    """Gives out ids like the terms table, starting high to need 64 bits."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def __call__(self, terms):
+        for term in terms:
+            self.ids.setdefault(term, 2 ** 40 + len(self.ids))
+        return dict((term, self.ids[term]) for term in terms)
+
+
+class TermStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    @inlineCallbacks
+    def test_occurrences_by_term_id(self):
+        store = TermStore(self.root, segment_records=3)
+        yield store.add(ENTRY, [2 ** 40, 7, 7], u"en", timestamp=1000)
+        adding = store.add(OTHER, [2 ** 40], u"fa", timestamp=2000)
+        # Queries see records while they are sealed
+        self.assertEqual(sorted(store.occurrences(2 ** 40)),
+                         [(ENTRY, 1000, u"en"), (OTHER, 2000, u"fa")])
+        yield adding
+        yield store.flush()
+        self.assertEqual(store.stats()["segments"], 1)
+        self.assertEqual(sorted(store.occurrences(2 ** 40)),
+                         [(ENTRY, 1000, u"en"), (OTHER, 2000, u"fa")])
+        self.assertEqual(store.entries_with(7), set([ENTRY]))
+        self.assertEqual(store.entries_with(2 ** 40, 1500), set([OTHER]))
+        yield store.close()
+        store = TermStore(self.root)
+        self.assertEqual(store.stats()["records"], 3)
+        self.assertEqual(store.entries_with(2 ** 40), set([ENTRY, OTHER]))
+        self.assertEqual(store.entries_with(8), set())
+        yield store.close()
+
+    @inlineCallbacks
+    def test_added_records_survive_a_crash(self):
+        store = TermStore(self.root)
+        yield store.add(ENTRY, [1, 2], u"en", timestamp=1000)
+        yield store.add(OTHER, [2], u"fa", timestamp=2000)
+        self.assertEqual(store.stats()["segments"], 0)
+        # Not closed, as if the process was killed
+        recovered = TermStore(self.root)
+        self.assertEqual(recovered.stats(), {"segments": 1, "records": 3, "pending": 0})
+        self.assertEqual(sorted(recovered.occurrences(2)),
+                         [(ENTRY, 1000, u"en"), (OTHER, 2000, u"fa")])
+        self.assertEqual(listdir(path.join(self.root, "segments")), ["00000001.seg"])
+        # New records go to the next segment
+        yield recovered.add(ENTRY, [3], u"en", timestamp=3000)
+        yield recovered.close()
+        self.assertEqual(TermStore(self.root).entries_with(3), set([ENTRY]))
+
+    @inlineCallbacks
+    def test_records_that_fail_to_log_are_not_sealed(self):
+        store = TermStore(self.root)
+
+        def full(number, records, languages):
+            raise IOError(28, "No space left on device")
+        store._append_log = full
+        failing = store.add(ENTRY, [1, 2], u"en", timestamp=1000)
+        sealing = store.flush()
+        yield self.assertFailure(failing, IOError)
+        yield sealing
+        del store._append_log
+        yield store.add(OTHER, [2], u"en", timestamp=2000)
+        yield store.close()
+        store = TermStore(self.root)
+        self.assertEqual(store.entries_with(2), set([OTHER]))
+        self.assertEqual(store.entries_with(1), set())
+        yield store.close()
+
+    @inlineCallbacks
+    def test_log_of_a_sealed_segment_is_dropped(self):
+        store = TermStore(self.root)
+        yield store.add(ENTRY, [1], u"en", timestamp=1000)
+        with open(path.join(self.root, "segments", "00000001.log"), "rb") as log:
+            logged = log.read()
+        yield store.close()
+        # As if stopped between sealing the segment and removing its log,
+        # with half a record written to it after the last sync
+        with open(path.join(self.root, "segments", "00000001.log"), "wb") as log:
+            log.write(logged + logged[:10])
+        store = TermStore(self.root)
+        self.assertEqual(store.stats()["records"], 1)
+        self.assertEqual(listdir(path.join(self.root, "segments")), ["00000001.seg"])
+        yield store.close()
+
+    def test_migrate_keyword_files(self):
+        keyword_dir = path.join(self.root, "keywords")
+        store_dir = path.join(self.root, "store")
+        termstore.makedirs(keyword_dir)
+        with codecs.open(path.join(keyword_dir, ENTRY), "w", encoding="utf-8") as keywords:
+            keywords.write(u"# http://example.org/\n# 2016-05-01 12:00:00.000000\n"
+                           u"election\nایران\n")
+        term_ids = TermIds()
+        store = TermStore(store_dir)
+        self.assertEqual(termstore.migrate(keyword_dir, store, term_ids, True), 1)
+        self.assertEqual(listdir(keyword_dir), [])
+        self.assertEqual(store.entries_with(term_ids.ids[u"ایران"]),
+                         set([ENTRY]))
+        self.assertEqual(store.stats()["segments"], 1)
+        store.close()